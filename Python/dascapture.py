@@ -0,0 +1,207 @@
+#!/usr/bin/python
+
+###
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Defines the Capture class, used by the DASReader (see dasreader.py) to save the samples around each trigger.
+# The raw samples of all channels are kept in a time-major capture-ring, large enough to hold twice the
+# 'pre' + 'post' trigger period. When a trigger occurs, the region from 'pre' seconds before the trigger
+# to 'post' seconds after it is frozen; once the 'post' samples have come in, the region is handed to
+# the Capture-thread as one or two views (slabs) of the ring. These are written straight from the ring
+# to a capture-file, so no samples are copied, and the Analysis- and Trigger-threads never wait for the disk.
+# After writing, the Capture-thread checks that the ring has not wrapped around onto the region in the meantime.
+#
+# A capture-file starts with a text-header: a 'PIEQF-CAPTURE <version>' line, followed by 'key=value' lines
+# with the trigger's metadata, and an empty line. The samples follow, in the same format as a sample-file
+# (see dassource.py), so capture-files can be played back with a ReplaySource.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+
+import os, time, types, threading, Queue
+import numpy
+
+# the first word of a capture-file's header
+magic = "PIEQF-CAPTURE"
+version = 1
+
+
+def readHeader(fd):
+	"""Read the header of a capture-file from the file-object 'fd'
+	Returns a dict of the header's 'key=value' pairs, with 'fd' positioned at the start of the samples,
+	or 'None' if the file is not a capture-file, with 'fd' positioned at the start of the file.
+	"""
+	start = fd.tell()
+	line = fd.readline()
+	if not line.startswith(magic):
+		fd.seek(start)
+		return None
+
+	header = {}
+	line = fd.readline()
+	while len(line.strip()):
+		(key, sep, value) = line.strip().partition('=')
+		header[key] = value
+		line = fd.readline()
+
+	return header
+
+
+class Capture(object):
+	"""Captures the samples of all channels around triggers, and writes them to capture-files in the background
+	"""
+	# format of the capture-file names (trigger-time, milliseconds, channel-number)
+	filename = "capture-%s-%03d-ch%d.dat"
+
+	def __init__(self, num_ch, sps, directory, pre=5., post=10., log=None, err=None):
+		"""Instantiate a Capture for 'num_ch' channels, sampled at 'sps' samples per second.
+		The capture-files are written to 'directory'.
+		'pre' and 'post' are the periods (in seconds) before and after each trigger to capture
+		'log' and 'err' are functions for writing informational messages and errors
+		"""
+		self.num_ch = num_ch
+		self.directory = directory
+		self.sps = sps
+		self.pre = int(pre * sps)
+		self.post = int(post * sps)
+		self.log = log
+		self.err = err
+
+		# the capture-ring, a write-pointer into it, and the total number of samples (per channel) written to it
+		self.length = max(2 * (self.pre + self.post), 1)
+		self.ring = numpy.zeros(shape=(self.length, num_ch), dtype='<u2')
+		self.ptr = 0
+		self.count = 0
+
+		# a list of (start, end, metadata) tuples of captures that wait for their 'post' samples,
+		# and a lock to guard it
+		self.pending = []
+		self.lock = threading.Lock()
+
+		# the queue of completed captures, to be written by the Capture-thread
+		self.queue = Queue.Queue()
+		self.thread = threading.Thread(None, self._writeLoop, "DASCaptureThread")
+
+		# the number of captures written, and lost because the ring wrapped around before they were written
+		self.written = 0
+		self.lost = 0
+
+	def store(self, off, block):
+		"""Store a block of raw samples (an array of shape (n_ch x n)) of channels 'off' .. 'off' + n_ch in the ring,
+		at the current write-pointer
+		"""
+		idx = numpy.arange(self.ptr, self.ptr + block.shape[1]) % self.length
+		self.ring[idx, off:off + block.shape[0]] = block.T
+
+	def advance(self, n):
+		"""Advance the write-pointer by 'n' samples, after the blocks of all channels have been stored.
+		Hands the captures that are now complete over to the Capture-thread.
+		"""
+		with self.lock:
+			self.ptr = (self.ptr + n) % self.length
+			self.count += n
+
+			done = [p for p in self.pending if p[1] <= self.count]
+			if len(done):
+				self.pending = [p for p in self.pending if p[1] > self.count]
+
+		for (start, end, meta) in done:
+			self.queue.put((start, end, meta, self._slabs(start, end)))
+
+	def _slabs(self, start, end):
+		"""Returns a list of one or two views of the ring, holding the samples 'start' .. 'end'
+		"""
+		n = end - start
+		first = start % self.length
+		slabs = [self.ring[first:min(first + n, self.length)]]
+		if len(slabs[0]) < n:
+			slabs.append(self.ring[:(n - len(slabs[0]))])
+
+		return slabs
+
+	def trigger(self, meta):
+		"""Start a capture around the current sample, with the given metadata (a dict)
+		"""
+		with self.lock:
+			start = max(self.count - self.pre, 0)
+			end = self.count + self.post
+			meta = dict(meta)
+			meta['trigger_sample'] = self.count - start
+			self.pending.append((start, end, meta))
+
+	def _message(self, func, msg):
+		if func:
+			func(msg)
+
+	def _write(self, start, end, meta, slabs):
+		"""Write a capture-file with the given metadata and slabs of samples
+		"""
+		t = meta.get('time', time.time())
+		stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime(t))
+		filename = os.path.join(self.directory, self.filename % (stamp, int((t % 1) * 1000), meta.get('ch', 0)))
+
+		fd = open(filename, 'wb')
+		try:
+			fd.write("%s %d\n" % (magic, version))
+			fd.write("num_ch=%d\n" % self.num_ch)
+			fd.write("sps=%f\n" % self.sps)
+			fd.write("samples=%d\n" % (end - start))
+			for key in sorted(meta.keys()):
+				if type(meta[key]) == types.FloatType:
+					fd.write("%s=%r\n" % (key, meta[key]))
+				else:
+					fd.write("%s=%s\n" % (key, str(meta[key])))
+			fd.write("\n")
+
+			for slab in slabs:
+				slab.tofile(fd)
+		finally:
+			fd.close()
+
+		# check that the ring has not wrapped around onto the region while it was being written
+		if (self.count - start) > self.length:
+			os.remove(filename)
+			self.lost += 1
+			self._message(self.err, "Warning: Capture %s lost; the capture-ring was overwritten before it was written" % filename)
+		else:
+			self.written += 1
+			self._message(self.log, "Captured %d samples to %s" % (end - start, filename))
+
+	def _writeLoop(self):
+		"""MainLoop of the Capture-thread
+		Write the completed captures, until a 'None' is taken from the queue
+		"""
+		while True:
+			item = self.queue.get()
+			if item == None:
+				break
+
+			try:
+				self._write(*item)
+			except (IOError, OSError), e:
+				self.lost += 1
+				self._message(self.err, "Error: Failed to write capture: %s" % str(e))
+
+	def start(self):
+		"""Starts the Capture-thread. Creates the capture-directory if it does not exist
+		"""
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+
+		self.thread.start()
+
+	def stop(self):
+		"""Writes the pending captures with the samples captured so far, and stops the Capture-thread.
+		Waits for the thread to finish.
+		"""
+		with self.lock:
+			pending = self.pending
+			self.pending = []
+
+		for (start, end, meta) in pending:
+			if self.count > start:
+				self.queue.put((start, self.count, meta, self._slabs(start, self.count)))
+
+		self.queue.put(None)
+		if self.thread.isAlive():
+			self.thread.join()
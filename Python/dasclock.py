@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+###
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Defines the timing used by the DASReader (see dasreader.py).
+# monotonic() returns the time of the system's monotonic clock (through clock_gettime(CLOCK_MONOTONIC), using ctypes),
+# which does not jump when the wall-clock is set or slewed by NTP. If it is not available, time.time() is used instead.
+#
+# The SampleClock class keeps the (sample-index, monotonic-time, wall-clock-time) stamps of the last blocks read
+# from a source, and fits a straight line through the monotonic times against the sample-indices (least-squares,
+# over the whole window at once). The slope of the line gives the true sample-rate of the source and its drift
+# against the nominal rate; the line itself gives the exact time of any recent sample.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+
+import time
+import numpy
+
+try:
+	import ctypes, ctypes.util
+except ImportError:
+	ctypes = None
+
+# the clock-id of the monotonic clock (see <linux/time.h>)
+CLOCK_MONOTONIC = 1
+
+_clock_gettime = None
+if ctypes != None:
+	class _timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+	try:
+		# clock_gettime() lives in librt on older systems, in libc on newer ones
+		_librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+		_clock_gettime = _librt.clock_gettime
+		_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+		if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(_timespec())) != 0:
+			_clock_gettime = None
+	except (OSError, AttributeError):
+		_clock_gettime = None
+
+
+def monotonic():
+	"""Returns the time (in seconds) of the monotonic clock, or the wall-clock time if there is no monotonic clock.
+	"""
+	if _clock_gettime == None:
+		return time.time()
+
+	ts = _timespec()
+	_clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+	return ts.tv_sec + (ts.tv_nsec * 1e-9)
+
+
+class SampleClock(object):
+	"""Estimates the true sample-rate of a source, and the times of its samples,
+	from the time-stamps of the last 'window' blocks read from it
+	"""
+	def __init__(self, nominal, window=64):
+		"""Instantiate a SampleClock for a source with the 'nominal' sample-rate
+		"""
+		self.nominal = float(nominal)
+		self.window = max(window, 2)
+
+		# ring-arrays of the time-stamps: the index of the last sample in each block, and the monotonic-
+		# and wall-clock times at which the block was read
+		self.index = numpy.zeros(shape=(self.window,), dtype='float')
+		self.mono = numpy.zeros(shape=(self.window,), dtype='float')
+		self.wall = numpy.zeros(shape=(self.window,), dtype='float')
+		self.ptr = 0
+		self.count = 0
+
+		# the fitted line: mono = t0 + (index - i0) / rate, and the offset of the wall-clock from the monotonic clock
+		self.rate = self.nominal
+		self.i0 = 0.
+		self.t0 = 0.
+		self.offset = 0.
+
+	def add(self, index, mono, wall):
+		"""Add the time-stamps of a block; the index of its last sample, and its monotonic- and wall-clock times
+		"""
+		self.index[self.ptr] = index
+		self.mono[self.ptr] = mono
+		self.wall[self.ptr] = wall
+		self.ptr = (self.ptr + 1) % self.window
+		self.count = min(self.count + 1, self.window)
+
+	def update(self):
+		"""Fit the line through the time-stamps in the window
+		"""
+		if self.count < 1:
+			return
+
+		n = self.index[:self.count]
+		t = self.mono[:self.count]
+		self.i0 = n.mean()
+		self.t0 = t.mean()
+		self.offset = numpy.median(self.wall[:self.count] - t)
+
+		dn = n - self.i0
+		var = (dn * dn).sum()
+		if (self.count >= 2) and (var > 0):
+			slope = (dn * (t - self.t0)).sum() / var
+			if slope > 0:
+				self.rate = 1. / slope
+
+	def drift(self):
+		"""Returns the drift of the sample-rate from the nominal rate, in parts-per-million
+		"""
+		return ((self.rate - self.nominal) / self.nominal) * 1e6
+
+	def monoTime(self, index):
+		"""Returns the monotonic time of the sample(s) with the given index (or array of indices)
+		"""
+		return self.t0 + ((index - self.i0) / self.rate)
+
+	def wallTime(self, index):
+		"""Returns the wall-clock time of the sample(s) with the given index (or array of indices)
+		"""
+		return self.monoTime(index) + self.offset
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+
+###
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Defines the signal-processing used by the DASReader (see dasreader.py).
+# The BlockFilter class is a cascade of biquad (2nd order IIR) filter-sections, applied to whole blocks of samples
+# of all channels at once. Rather than running the filter's recursion sample by sample, the cascade is written
+# as a state-space system, and its response to a block of N samples is expressed exactly as two matrix-products:
+#	y = x . T' + z . O'			(the block's output, from its input and the filter-state at its start)
+#	z = x . S' + z . P'			(the filter-state at the end of the block)
+# where T is the (N x N) matrix of the cascade's impulse-response, O maps the state onto the output,
+# S maps the input onto the state, and P = A^N. These matrices are pre-calculated once for each block-size,
+# and the filter-state carries over from block to block, so the output is identical to sample-by-sample filtering.
+#
+# The Spectrum class calculates spectral features (dominant frequency, spectral centroid and band-energies)
+# of all channels at once, with one batched FFT over the DASReader's input-buffer.
+#
+# The design-functions return the (b, a) coefficients of single biquad-sections,
+# after the 'Cookbook formulae for audio EQ biquad filter coefficients' by R. Bristow-Johnson
+#
+# Run as a script to benchmark the BlockFilter.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+
+import math
+import numpy
+
+
+def _biquad(b0, b1, b2, a0, a1, a2):
+	"""Returns the normalized (b, a) coefficient-arrays of a biquad-section
+	"""
+	return (numpy.array([b0, b1, b2]) / a0, numpy.array([a0, a1, a2]) / a0)
+
+def highpass(fc, fs, Q=math.sqrt(0.5)):
+	"""Returns a 2nd order high-pass section with cut-off frequency 'fc', at sample-rate 'fs'
+	"""
+	w0 = 2 * math.pi * fc / fs
+	alpha = math.sin(w0) / (2 * Q)
+	cw = math.cos(w0)
+	return _biquad((1 + cw) / 2, -(1 + cw), (1 + cw) / 2, 1 + alpha, -2 * cw, 1 - alpha)
+
+def lowpass(fc, fs, Q=math.sqrt(0.5)):
+	"""Returns a 2nd order low-pass section with cut-off frequency 'fc', at sample-rate 'fs'
+	"""
+	w0 = 2 * math.pi * fc / fs
+	alpha = math.sin(w0) / (2 * Q)
+	cw = math.cos(w0)
+	return _biquad((1 - cw) / 2, 1 - cw, (1 - cw) / 2, 1 + alpha, -2 * cw, 1 - alpha)
+
+def bandpass(f0, fs, Q=1.):
+	"""Returns a 2nd order band-pass section (0 dB peak-gain) with center-frequency 'f0', at sample-rate 'fs'
+	"""
+	w0 = 2 * math.pi * f0 / fs
+	alpha = math.sin(w0) / (2 * Q)
+	cw = math.cos(w0)
+	return _biquad(alpha, 0., -alpha, 1 + alpha, -2 * cw, 1 - alpha)
+
+def notch(f0, fs, Q=10.):
+	"""Returns a 2nd order notch section with center-frequency 'f0', at sample-rate 'fs'
+	"""
+	w0 = 2 * math.pi * f0 / fs
+	alpha = math.sin(w0) / (2 * Q)
+	cw = math.cos(w0)
+	return _biquad(1., -2 * cw, 1., 1 + alpha, -2 * cw, 1 - alpha)
+
+def design(fs, highpass_fc=None, lowpass_fc=None, notch_f0=None):
+	"""Returns a list of biquad-sections for sample-rate 'fs':
+	A high-pass section if 'highpass_fc' is given, a low-pass section if 'lowpass_fc' is given
+	(both make a band-pass filter), and a notch-section if 'notch_f0' is given (e.g. to remove mains-hum).
+	A low-pass cut-off at or above the Nyquist-frequency (fs / 2) is ignored, since there is nothing to remove there.
+	(Raises ValueError if the high-pass cut-off or the notch-frequency is at or above the Nyquist-frequency)
+	"""
+	nyquist = fs / 2.
+	if highpass_fc and (highpass_fc >= nyquist):
+		raise ValueError("High-pass cut-off of %g Hz must be below the Nyquist-frequency of %g Hz" % (highpass_fc, nyquist))
+	if notch_f0 and (notch_f0 >= nyquist):
+		raise ValueError("Notch-frequency of %g Hz must be below the Nyquist-frequency of %g Hz" % (notch_f0, nyquist))
+
+	sections = []
+	if highpass_fc:
+		sections.append(highpass(highpass_fc, fs))
+	if lowpass_fc and (lowpass_fc < nyquist):
+		sections.append(lowpass(lowpass_fc, fs))
+	if notch_f0:
+		sections.append(notch(notch_f0, fs))
+
+	return sections
+
+
+class BlockFilter(object):
+	"""A cascade of biquad-sections, filtering blocks of samples of a number of channels at once
+	"""
+	def __init__(self, sections, num_ch=1):
+		"""Instantiate a BlockFilter for 'num_ch' channels, from a list of (b, a) biquad-sections
+		"""
+		if not len(sections):
+			raise ValueError("A BlockFilter needs at least one biquad-section")
+
+		self.sections = sections
+		self.num_ch = num_ch
+
+		# build the state-space system (A, B, C, D) of the cascade, section by section.
+		# each section is in transposed direct-form II, with 2 state-variables
+		order = 2 * len(sections)
+		A = numpy.zeros(shape=(order, order))
+		B = numpy.zeros(shape=(order,))
+		C = numpy.zeros(shape=(order,))
+		D = 1.
+		for (i, (b, a)) in enumerate(sections):
+			s = 2 * i
+			# the section's input is the output of the cascade so far: C . z + D . x
+			A[s:s + 2, :s] = numpy.outer([b[1] - a[1] * b[0], b[2] - a[2] * b[0]], C[:s])
+			A[s:s + 2, s:s + 2] = [[-a[1], 1.], [-a[2], 0.]]
+			B[s:s + 2] = numpy.array([b[1] - a[1] * b[0], b[2] - a[2] * b[0]]) * D
+			# and its output is b0 . input + the section's first state-variable
+			C[:s] *= b[0]
+			C[s] = 1.
+			D *= b[0]
+
+		self.A = A
+		self.B = B
+		self.C = C
+		self.D = D
+
+		# the block-matrices, per block-size
+		self.matrices = {}
+		# the filter-state of each channel. 'None' until the first block is filtered
+		self.z = None
+
+	def _matrices(self, n):
+		"""Returns the block-matrices (T, O, S, P) for blocks of 'n' samples
+		"""
+		if n in self.matrices:
+			return self.matrices[n]
+
+		order = len(self.B)
+		# O holds C . A^k, and S holds A^(n-1-k) . B, for k = 0 .. n-1
+		O = numpy.zeros(shape=(n, order))
+		S = numpy.zeros(shape=(order, n))
+		Ak = numpy.eye(order)
+		for k in range(n):
+			O[k] = numpy.dot(self.C, Ak)
+			S[:, n - 1 - k] = numpy.dot(Ak, self.B)
+			Ak = numpy.dot(self.A, Ak)
+		P = Ak
+
+		# the impulse-response h[0] = D, h[k] = C . A^(k-1) . B, laid out as a lower-triangular Toeplitz matrix
+		h = numpy.concatenate(([self.D], numpy.dot(O[:-1], self.B)))
+		idx = numpy.arange(n)
+		lag = idx[:, numpy.newaxis] - idx[numpy.newaxis, :]
+		T = numpy.where(lag >= 0, h[lag.clip(0, n - 1)], 0.)
+
+		self.matrices[n] = (T.T.copy(), O.T.copy(), S.T.copy(), P.T.copy())
+		return self.matrices[n]
+
+	def reset(self, x0=None):
+		"""Reset the filter-state. If 'x0' (an array of one value per channel) is given, the state is set to
+		the steady-state for a constant input of 'x0', so that a DC-offset in the input does not cause a transient.
+		"""
+		order = len(self.B)
+		if x0 is None:
+			self.z = numpy.zeros(shape=(self.num_ch, order))
+			return
+
+		# the steady-state z = A . z + B . x0  =>  z = (I - A)^-1 . B . x0
+		zss = numpy.linalg.solve(numpy.eye(order) - self.A, self.B)
+		self.z = numpy.outer(numpy.asarray(x0, dtype='float'), zss)
+
+	def process(self, x):
+		"""Filter a block of samples 'x' (an array of shape (num_ch x n)), and return the filtered block.
+		On the first call, the filter-state is set to the steady-state for the block's first samples.
+		"""
+		(T, O, S, P) = self._matrices(x.shape[1])
+		if self.z is None:
+			self.reset(x[:, 0])
+
+		y = numpy.dot(x, T) + numpy.dot(self.z, O)
+		self.z = numpy.dot(x, S) + numpy.dot(self.z, P)
+		return y
+
+
+class Spectrum(object):
+	"""Calculates spectral features of a number of channels at once, from a (ring-)buffer of samples:
+	a Hann-windowed FFT per channel, from which the dominant frequency, the spectral centroid and
+	the energy in a number of frequency-bands are derived
+	"""
+	# the default frequency-bands (in Hz)
+	bands = ((0., 2.), (2., 8.), (8., 50.))
+
+	def __init__(self, size, fs, bands=None):
+		"""Instantiate a Spectrum for buffers of 'size' samples per channel, at sample-rate 'fs'
+		'bands' is a list of (low, high) frequency-bands (in Hz) to calculate the energy in
+		"""
+		if bands:
+			self.bands = bands
+
+		self.size = size
+		self.fs = float(fs)
+		self.window = numpy.hanning(size)
+		self.freqs = numpy.fft.rfftfreq(size, 1. / fs)
+
+		# a (bands x freqs) matrix selecting the frequency-bins in each band
+		self.band_mask = numpy.zeros(shape=(len(self.bands), len(self.freqs)))
+		for (i, (lo, hi)) in enumerate(self.bands):
+			self.band_mask[i] = (self.freqs >= lo) & (self.freqs < hi)
+
+	def features(self, buf, ptr=0, fs=None):
+		"""Calculate the features of the channels in 'buf' (an array of shape (num_ch x size)),
+		a ring-buffer whose oldest samples are at index 'ptr'.
+		'fs' is the actual sample-rate, if it differs from the rate given at instantiation.
+		Returns an array of shape (num_ch x (2 + bands)), holding per channel:
+		the dominant frequency, the spectral centroid, and the energy in each band
+		"""
+		# unroll the ring-buffer, remove the DC-offset and apply the window
+		x = numpy.roll(buf, -ptr, axis=1)
+		x = (x - x.mean(axis=1)[:, numpy.newaxis]) * self.window
+
+		power = abs(numpy.fft.rfft(x, axis=1))**2
+		total = power.sum(axis=1)
+
+		freqs = self.freqs
+		if fs:
+			freqs = freqs * (fs / self.fs)
+
+		out = numpy.empty(shape=(buf.shape[0], 2 + len(self.bands)))
+		# the DC-bin is ignored for the dominant frequency
+		out[:, 0] = freqs[power[:, 1:].argmax(axis=1) + 1]
+		out[:, 1] = numpy.dot(power, freqs) / numpy.where(total > 0, total, 1.)
+		out[:, 2:] = numpy.dot(power, self.band_mask.T) / self.size
+		return out
+
+
+if __name__ == '__main__':
+	import time
+	from optparse import OptionParser
+
+	op = OptionParser(usage="%prog [options]\nBenchmarks the BlockFilter against sample-by-sample filtering")
+	op.add_option("-c", "--channels", action='store', type='int', dest='channels', metavar='N',
+					help="filter N channels [default = %default]")
+	op.add_option("-r", "--rate", action='store', type='float', dest='rate', metavar='SPS',
+					help="sample-rate [default = %default]")
+	op.add_option("-s", "--blocksize", action='store', type='int', dest='blocksize', metavar='SIZE',
+					help="filter blocks of SIZE samples [default = %default]")
+	op.add_option("-n", "--blocks", action='store', type='int', dest='blocks', metavar='N',
+					help="filter N blocks [default = %default]")
+
+	op.set_defaults(channels=8)
+	op.set_defaults(rate=1000.)
+	op.set_defaults(blocksize=100)
+	op.set_defaults(blocks=1000)
+
+	(opts, args) = op.parse_args()
+
+	# a 1 Hz high-pass and 20 Hz low-pass (i.e. band-pass), plus a 50 Hz notch
+	sections = design(opts.rate, 1., 20., 50.)
+	print "%d channels at %.0f sps, %d blocks of %d samples, %d biquad-sections" % (opts.channels, opts.rate, opts.blocks, opts.blocksize, len(sections))
+
+	x = numpy.random.normal(2048., 10., (opts.channels, opts.blocks * opts.blocksize))
+
+	bf = BlockFilter(sections, opts.channels)
+	bf.process(x[:, :opts.blocksize])
+	bf.reset(x[:, 0])
+
+	y = numpy.empty_like(x)
+	t0 = time.time()
+	for i in range(opts.blocks):
+		s = slice(i * opts.blocksize, (i + 1) * opts.blocksize)
+		y[:, s] = bf.process(x[:, s])
+	t = time.time() - t0
+
+	print "BlockFilter:       %8.1f us per block, %6.3f %% of real-time" % (t * 1e6 / opts.blocks, t * 100. * opts.rate / (opts.blocks * opts.blocksize))
+
+	# the reference: a sample-by-sample transposed direct-form II cascade, over a subset of the samples
+	n = min(x.shape[1], 10 * opts.blocksize)
+	ref = x[:, :n].copy()
+	t0 = time.time()
+	for (b, a) in sections:
+		z1 = numpy.zeros(opts.channels)
+		z2 = numpy.zeros(opts.channels)
+		out = numpy.empty_like(ref)
+		for k in range(n):
+			out[:, k] = b[0] * ref[:, k] + z1
+			z1 = b[1] * ref[:, k] - a[1] * out[:, k] + z2
+			z2 = b[2] * ref[:, k] - a[2] * out[:, k]
+		ref = out
+	t = time.time() - t0
+
+	print "sample-by-sample:  %8.1f us per block, %6.3f %% of real-time" % (t * 1e6 * opts.blocksize / n, t * 100. * opts.rate / n)
+
+	# the reference starts from a zero state, so compare from a fresh BlockFilter with a zero state
+	bf.reset()
+	chk = numpy.concatenate([bf.process(x[:, i:i + opts.blocksize]) for i in range(0, n, opts.blocksize)], axis=1)
+	print "max. difference:   %g" % abs(chk - ref).max()
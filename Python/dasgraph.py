@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+###
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Defines the MagGraph class, an animated line-graph of the DASReader's channels' magnitudes (see dasreader.py)
+# The datapoints are kept in fixed-size numpy ring-arrays, so adding a datapoint costs the same regardless of the graph's size.
+# Drawing is throttled to a maximum frame-rate, independent of the rate at which datapoints are added.
+# Before drawing, the datapoints are decimated to the graph's width in pixels, keeping the minimum and maximum
+# of the datapoints that fall on each pixel-column, so no peaks are lost.
+# Where the backend supports it, only the lines are redrawn on each frame (blitting) on top of a saved background
+# with the axes, titles and labels. The whole figure is only redrawn when the axes need rescaling, or the window was resized.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+
+import time
+import numpy
+import pylab
+
+
+class MagGraph(object):
+	"""An animated line-graph of the magnitudes of a number of channels, one subplot per channel,
+	with each channel's threshold drawn as a dotted red line
+	"""
+	def __init__(self, num_ch, xsize=500, fps=10.):
+		"""Instantiate a MagGraph for 'num_ch' channels, showing the last 'xsize' datapoints of each channel,
+		redrawn at most 'fps' times per second
+		"""
+		self.num_ch = num_ch
+		self.xsize = max(xsize, 2)
+		self.fps = fps
+
+		# the ring-arrays of time-points and magnitudes, a write-pointer and the number of datapoints in the rings
+		self.tm = numpy.zeros(shape=(self.xsize,), dtype='float')
+		self.mag = numpy.zeros(shape=(num_ch, self.xsize), dtype='float')
+		self.ptr = 0
+		self.count = 0
+
+		# the time of the last frame, the current x-range (in seconds) and the current top of each y-axis
+		self.last = 0.
+		self.span = 0.
+		self.top = numpy.ones(shape=(num_ch,), dtype='float')
+
+		# put pylab in 'interactive mode', and define a 'figure' (this creates the window for the graph(s))
+		pylab.ion()
+		self.fig = pylab.figure(figsize=(1 + (min(self.xsize, 1000) // 50), 1 + (2 * num_ch)))
+		pylab.ioff()
+
+		self.blit = hasattr(self.fig.canvas, 'copy_from_bbox')
+		self.size = None
+		self.background = None
+
+		# define the graph(s)
+		self.axes = []
+		self.lines = []
+		self.th_lines = []
+		for ch in range(num_ch):
+			ax = self.fig.add_subplot(num_ch, 1, ch + 1)
+			(line,) = ax.plot([], [], 'b-', animated=self.blit)
+			(th_line,) = ax.plot([], [], 'r:', animated=self.blit)
+			ax.set_title('channel %d' % ch)
+			ax.set_ylabel('magnitude')
+			self.axes.append(ax)
+			self.lines.append(line)
+			self.th_lines.append(th_line)
+
+		# only label X-axis of the bottom graph
+		self.axes[-1].set_xlabel('seconds ago')
+
+	def append(self, tm, mag):
+		"""Add a datapoint at time 'tm' (in seconds), with the given array of magnitudes
+		"""
+		self.tm[self.ptr] = tm
+		self.mag[:, self.ptr] = mag
+		self.ptr = (self.ptr + 1) % self.xsize
+		self.count = min(self.count + 1, self.xsize)
+
+	def _decimate(self, tm, mag, bins):
+		"""Decimate the datapoints to (about) 2 x 'bins' points, keeping the minimum and maximum magnitude in each bin
+		"""
+		if len(tm) <= (2 * bins):
+			return (tm, mag)
+
+		# use the most recent multiple of 'bins' datapoints
+		n = (len(tm) // bins) * bins
+		tb = tm[-n:].reshape((bins, -1))
+		mb = mag[:, -n:].reshape((self.num_ch, bins, -1))
+
+		tm = numpy.column_stack((tb[:, 0], tb[:, -1])).ravel()
+		mag = numpy.concatenate((mb.min(axis=2)[:, :, numpy.newaxis], mb.max(axis=2)[:, :, numpy.newaxis]), axis=2)
+		return (tm, mag.reshape((self.num_ch, 2 * bins)))
+
+	def _redraw(self):
+		"""Rescale the axes and redraw the whole figure. Save the background for blitting
+		"""
+		for ch in range(self.num_ch):
+			self.axes[ch].axis([-self.span, 0, 0, self.top[ch]])
+
+		self.fig.canvas.draw()
+		self.size = self.fig.canvas.get_width_height()
+		if self.blit:
+			self.background = [self.fig.canvas.copy_from_bbox(ax.bbox) for ax in self.axes]
+
+	def draw(self, thresh):
+		"""Draw a frame, with the channels' thresholds (a scalar or an array) as red lines,
+		unless the last frame was drawn less than 1 / fps seconds ago.
+		Returns 'True' if a frame was drawn
+		"""
+		now = time.time()
+		if ((now - self.last) < (1. / self.fps)) or (self.count < 2):
+			return False
+		self.last = now
+
+		# unroll the rings, with the time-points relative to the most recent one
+		idx = numpy.arange(self.ptr - self.count, self.ptr) % self.xsize
+		tm = self.tm[idx] - self.tm[idx[-1]]
+		mag = self.mag[:, idx]
+		thresh = numpy.ones(shape=(self.num_ch,)) * thresh
+
+		# the axes are rescaled (with some headroom) when the datapoints no longer fit
+		redraw = (self.background == None) or (self.size != self.fig.canvas.get_width_height())
+		if -tm[0] > self.span:
+			self.span = -tm[0] * 1.2
+			redraw = True
+		top = numpy.maximum(mag.max(axis=1), thresh)
+		if (top > self.top).any():
+			self.top = numpy.maximum(self.top, top * 1.5)
+			redraw = True
+
+		(tm, mag) = self._decimate(tm, mag, max(int(self.axes[0].bbox.width), 1))
+
+		for ch in range(self.num_ch):
+			self.lines[ch].set_data(tm, mag[ch])
+			self.th_lines[ch].set_data([-self.span, 0], [thresh[ch], thresh[ch]])
+
+		if redraw or not self.blit:
+			self._redraw()
+
+		if self.blit:
+			for ch in range(self.num_ch):
+				ax = self.axes[ch]
+				self.fig.canvas.restore_region(self.background[ch])
+				ax.draw_artist(self.lines[ch])
+				ax.draw_artist(self.th_lines[ch])
+				self.fig.canvas.blit(ax.bbox)
+
+		try:
+			self.fig.canvas.flush_events()
+		except (AttributeError, NotImplementedError):
+			pass
+
+		return True
+
+	def close(self):
+		"""Close the figure
+		"""
+		pylab.close(self.fig)
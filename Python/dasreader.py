@@ -3,20 +3,41 @@
 ###
 # Parkfield Interventional Earth-Quake Fieldwork
 # 
-# Defines the DASReader class for sampling the inputs of a PCI-DAS08 A/D converter card.
-# Blocks of samples are read from each input and after each read block, the standard-deviation
+# Defines the DASReader class for sampling the inputs of one or more PCI-DAS08 A/D converter cards,
+# or any other sample-source(s) (see dassource.py).
+# Each card (source) is read by its own Reader-thread, which hands each block of samples over to the Analysis-thread
+# through a queue of pre-allocated block-buffers, so sampling continues while the previous block is being analysed.
+# The Analysis-thread only takes blocks with the same sample-index from all cards together, so the cards' channels stay
+# in step when a Reader-thread has dropped blocks.
+# The Analysis-thread optionally filters the blocks (see dasdsp.py), and stores the blocks of all cards
+# in one wide input-buffer, then the standard-deviation
 # over each channel's sample buffer is caluclated and scaled down (/ 100) to a pseudo-magnitude value.
 # if the pseudo-magnitude exceeds a settable threshold, a 'Trigger' callback-function is called
 # with the channel-number, the pseudo-magnitude value and a duration calculated from the magnitude as arguments.
+# A triggered channel cannot re-trigger until its duration has passed and its pseudo-magnitude has fallen
+# below the 'off' threshold (see dastrigger.py)
 # The channels' bufsize is >= the blocksize 
 # 
+# Each block of samples is time-stamped with the monotonic- and wall-clock time at which it was read, from which
+# the true sample-rate of each source is estimated (see dasclock.py), so all timing uses the samples' own times.
+# 
+# The DASProcess class runs the DASReader's loops in a separate (child-)process, optionally pinned to one CPU,
+# so that the sampling is not disturbed by other threads in the main process (QDMParser, StpRunner, ...)
+# 
 #	Stock, V2_Lab Rotterdam, June 2008
 ###
 from __future__ import with_statement
 
-import sys, time, struct, signal, threading
+import sys, os, time, types, signal, subprocess, threading, Queue
 import numpy
 
+import dassource, dastrigger, dasdsp, dascapture, dasclock
+
+try:
+	import multiprocessing		# Python >= 2.6
+except ImportError:
+	multiprocessing = None
+
 
 class DASReader(object):
 	"""Continuously reads samples from the channels of a PCI-DAS08 card.
@@ -26,48 +47,136 @@ class DASReader(object):
 	pseudo-magnitude and duration (calculated from the magnitude) as arguments.
 	"""
 	threshold = 0.1
+	# the 'off' threshold (below which a triggered channel is re-armed), as a fraction of the threshold
+	hysteresis = 0.8
+	
+	# the number of pre-allocated block-buffers between each Reader-thread and the Analysis-thread
+	queue_len = 8
+	
+	# the number of blocks over which each source's true sample-rate is estimated
+	rate_window = 64
+	
+	# the interval (in seconds) at which the adaptive noise-estimate is saved (see setAdaptive())
+	noise_save_interval = 60.
 	
 	# file-objects fro informational messages & warnings/errors
 	logfd = sys.stdout
 	errfd = sys.stderr
 	
-	def __init__(self, inputs=1, bufsize=15, blocksize=10):
-		"""Instantiate a DASReader for the first 'inputs' inputs of the card
-		(where 1 <= inputs <= 8)
+	def __init__(self, inputs=1, bufsize=15, blocksize=10, source=None):
+		"""Instantiate a DASReader for the first 'inputs' inputs of the card(s)
+		(8 inputs per card. Inputs 8 - 15 are on the second card, etc.)
 		'bufsize' sets the size of the sample-buffer used to calulate the pseudo-magnitude
 		'blocksize' sets the number of samples read in-between each calculation
 		(bufsize >= blocksize)
+		'source' is the sample-source, or a list of sample-sources (one per card), to read from (see dassource.py).
+		If not given, DeviceSources for the first 'inputs' inputs of the card(s) are used, otherwise 'inputs' is ignored.
 		"""
-		self.num_ch = min(max(1, inputs), 8)
+		if source == None:
+			source = dassource.openSource(inputs)
+		if type(source) not in (types.ListType, types.TupleType):
+			source = [source]
+		self.sources = list(source)
+		
+		# the sources' channels are laid out one after the other in the buffer and the magnitudes-array
+		self.ch_offset = []
+		self.num_ch = 0
+		for src in self.sources:
+			self.ch_offset.append(self.num_ch)
+			self.num_ch += src.num_ch
+		
 		self.blocksize = blocksize
 		self.bufsize = max(bufsize, blocksize)
 		
 		# define an array of size (num_ch x bufsize) as input-buffer
-		self.buf = numpy.ndarray(shape=(self.num_ch, self.bufsize), dtype='int')
+		# (of floats, since it holds the filtered samples if a filter is set. See setFilter())
+		self.buf = numpy.ndarray(shape=(self.num_ch, self.bufsize), dtype='float')
+		# a filter per source, or 'None' if the samples are not filtered
+		self.filters = None
+		# a Spectrum per source, or 'None' if no spectral features are calculated (see setSpectral()),
+		# the number of read-cycles in-between each calculation, and an array to store the channels' features
+		self.spectra = None
+		self.spectral_every = 0
+		self.feat = None
+		# the pre/post-trigger Capture, or 'None' if triggers are not captured (see setCapture())
+		self.capture = None
 		# a list of write-pointers into the buffer
 		self.buf_ptr = [0] * self.num_ch
+		self.queue_len = max(2, self.queue_len)
+		
+		# an array of size (queue_len x src.num_ch x blocksize) per source to read the blocks of samples into,
+		# and per source a queue of free block-buffers and a queue of filled block-buffers (as indices into the array)
+		self.blocks = []
+		self.free = []
+		self.filled = []
+		for src in self.sources:
+			self.blocks.append(numpy.ndarray(shape=(self.queue_len, src.num_ch, self.blocksize), dtype='int'))
+			self.free.append(Queue.Queue())
+			self.filled.append(Queue.Queue())
+			for i in range(self.queue_len):
+				self.free[-1].put(i)
+		
+		# keep track of the number of queued blocks, and of the number of blocks dropped because the queue was full
+		# (or skipped to keep the sources in step), per source. The Reader- and Analysis-threads both count drops
+		self.queue_depth = numpy.zeros(shape=(len(self.sources),), dtype='int')
+		self.dropped = numpy.zeros(shape=(len(self.sources),), dtype='int')
+		self.drop_lock = threading.Lock()
 		
 		# an array of sixe (num_ch x 1) to store the channels' magnitudes
 		self.mag = numpy.ndarray(shape=(self.num_ch,), dtype='float')
 		# define a lock to guarantee atomic operations on the magnitudes-array
 		self.mag_lock = threading.Lock()
 		
-		# define events to signal the completion of cycles between threads 
-		self.ready = threading.Event()
+		# count the completed read-cycles, and signal each completion to the threads waiting for one (see waitCycle()).
+		# Each waiting thread compares the count with the last count it saw, so no thread resets the signal for the others
+		self.cycles = 0
+		self.cycle_cond = threading.Condition()
+		self.seen = threading.local()
+		# define an event to signal triggers between threads
 		self.trigger = threading.Event()
 		
-		# keep track of the samples-per-second count
+		# an array to store the channels' background-noise estimates (see setAdaptive())
+		self.noise = numpy.zeros(shape=(self.num_ch,), dtype='float')
+		
+		# keep track of the samples-per-second count, per source and of the slowest source
+		self.card_sps = numpy.zeros(shape=(len(self.sources),), dtype='float')
 		self.sps = 0.
 		
-		# run the two loops each in its own thread
-		self.read_thread = threading.Thread(None, self._readLoop, "DASReaderThread")
+		# per source, the number of samples read, and an array of (last-sample-index, monotonic-time, wall-clock-time)
+		# time-stamps of each block-buffer, and a SampleClock estimating the true sample-rate from the time-stamps
+		self.sample_index = [0] * len(self.sources)
+		self.block_stamp = []
+		self.clocks = []
+		for src in self.sources:
+			self.block_stamp.append(numpy.zeros(shape=(self.queue_len, 3), dtype='float'))
+			self.clocks.append(dasclock.SampleClock(src.sps, self.rate_window))
+		
+		# the estimated sample-rates and their drift from the nominal rate (in ppm), per source
+		self.card_rate = numpy.zeros(shape=(len(self.sources),), dtype='float')
+		self.card_drift = numpy.zeros(shape=(len(self.sources),), dtype='float')
+		# the monotonic- and wall-clock time of the newest sample the current magnitudes were calculated over
+		self.mag_time = numpy.zeros(shape=(2,), dtype='float')
+		
+		# run the Reader-loop for each source, the Analysis-loop and the Trigger-loop, each in its own thread
+		self.read_threads = []
+		for i in range(len(self.sources)):
+			if len(self.sources) == 1:
+				name = "DASReaderThread"
+			else:
+				name = "DASReaderThread%d" % i
+			self.read_threads.append(threading.Thread(None, self._readLoop, name, [i]))
+		self.analysis_thread = threading.Thread(None, self._analysisLoop, "DASAnalysisThread")
 		self.trig_thread = threading.Thread(None, self._triggerLoop, "DASTriggerThread")
 		self.run = False
 		
-		# build a list of device-file names
-		self.dev = []
-		for i in range(self.num_ch):
-			self.dev.append("/dev/das08/ad0_%d" % i)
+		# the k-of-n coincidence-trigger (see setCoincidence()). If 'None', each channel triggers on its own
+		self.coincidence = None
+		# the adaptive noise-floor (see setAdaptive()), and the file it is saved to.
+		# If 'None', the fixed threshold is used for all channels
+		self.adaptive = None
+		self.noise_file = None
+		# 'True' if the trigger-function accepts the 'info' argument
+		self.trig_info = True
 		
 	
 	def logMessage(self, msg):
@@ -86,87 +195,258 @@ class DASReader(object):
 		except Exception, e:
 			sys.stderr.write("Error writing to file '%s': %s\n" % (self.errfd.name, str(e)))
 	
-	def _read(self):
-		"""Read one sample from each channel, in round-robin fashion, 'blocksize' times.
-		i.e. Read one block of samples from all channels, interleaved.
+	def _store(self, card, block):
+		"""Store a block of samples from the given source (card) in the source's part of the input-buffer.
+		"""
+		off = self.ch_offset[card]
+		n = self.sources[card].num_ch
+		
+		if self.filters != None:
+			block = self.filters[card].process(block)
+		
+		# store the block in the correct place in the buffer, and increment the write-pointers
+		# (all channels of a source are read equally often, so their write-pointers are always equal)
+		ptr = self.buf_ptr[off]
+		idx = numpy.arange(ptr, ptr + self.blocksize) % self.bufsize
+		self.buf[off:off + n, idx] = block
+		self.buf_ptr[off:off + n] = [(ptr + self.blocksize) % self.bufsize] * n
+		
+	def _stamp(self, card, i):
+		"""Time-stamp block-buffer 'i' of the given source (card), which was just filled
+		"""
+		self.sample_index[card] += self.blocksize
+		self.block_stamp[card][i] = (self.sample_index[card] - 1, dasclock.monotonic(), time.time())
+	
+	def _readLoop(self, card=0):
+		"""MainLoop of a Reader-thread
+		Loop forever, reading one block of samples from all channels of the given source (card) into a free block-buffer,
+		then pass the block-buffer on to the Analysis-thread. Repeat
+		If no free block-buffer is available (i.e. the Analysis-thread lags behind), the oldest queued block is dropped.
+		Stops the DASReader when the sample-source runs out of samples.
 		"""
-		start_time = time.time()
-		for i in range(self.blocksize):
-			for ch in range(self.num_ch):
-				fd = None
+		src = self.sources[card]
+		last_time = dasclock.monotonic()
+		while self.run:
+			i = None
+			while self.run and (i == None):
 				try:
-					# the DAS08 driver requires that each channel is opened before reading,
-					# in order to control the 8-input multiplexer. The card only has ONE actual ADC.
-					fd = open(self.dev[ch], 'rb', 0)
-					bytes = fd.read(2)
-				finally:
-					if fd:
-						fd.close()
-				
-				# store the read integer in the correct place in the buffer
-				self.buf[ch, self.buf_ptr[ch]] = struct.unpack('<H', bytes)[0]
-				# increment the write-pointer
-				self.buf_ptr[ch] = (self.buf_ptr[ch] + 1) % self.bufsize
+					i = self.free[card].get_nowait()
+				except Queue.Empty:
+					try:
+						# re-use the oldest block-buffer that was not analysed yet
+						i = self.filled[card].get_nowait()
+						with self.drop_lock:
+							self.dropped[card] += 1
+					except Queue.Empty:
+						# the Analysis-thread holds the only block-buffer(s). wait for it to release one
+						try:
+							i = self.free[card].get(True, 0.5)
+						except Queue.Empty:
+							pass
 			
-			# wait 10ms after reading 1 sample from all channels.
-			# the aim is to get 100 sps on all channels.
-			time.sleep(0.01)
-				
-		# calculate the sps rate
-		self.sps = self.blocksize / (time.time() - start_time)
+			if i == None:
+				break
+			
+			if not src.read(self.blocks[card][i]):
+				self.logMessage("End of samples from %s %d" % (src.__class__.__name__, card))
+				self.run = False
+				self._cycleDone()
+				break
 			
+			self._stamp(card, i)
+			now = self.block_stamp[card][i][1]
+			self.filled[card].put(i)
+			
+			# calculate the sps rate, over the time between the end of the previous block and the end of this one
+			# (a source that returns a block within the clock's resolution keeps its previous rate)
+			if now > last_time:
+				self.card_sps[card] = self.blocksize / (now - last_time)
+				self.sps = self.card_sps.min()
+			last_time = now
+	
+	def _takeBlock(self, card):
+		"""Take the oldest filled block-buffer from the given source's (card's) queue, waiting for one if necessary.
+		Returns the index of the block-buffer, or 'None' if the DASReader is stopping
+		"""
+		while self.run:
+			try:
+				return self.filled[card].get(True, 0.5)
+			except Queue.Empty:
+				pass
 		
-	def _readLoop(self):
-		"""Loop forever, reading one block of samples from all channels,
-		then calculate the pseudo-magnitude for each channel. Repeat
+		return None
+	
+	def _takeBlocks(self):
+		"""Take one block-buffer from each source's queue, such that all blocks end at the same sample-index
+		(see _stamp()). A source whose block is older than the newest of the others (because another source's
+		Reader-thread dropped blocks) has its block skipped, until the newest complete set of blocks is found.
+		Returns a list of the block-buffers' indices, or 'None' if the DASReader is stopping
 		"""
+		held = [None] * len(self.sources)
+		while True:
+			for card in range(len(self.sources)):
+				if held[card] == None:
+					held[card] = self._takeBlock(card)
+					if held[card] == None:
+						return None
+			
+			index = [self.block_stamp[card][held[card]][0] for card in range(len(self.sources))]
+			newest = max(index)
+			if min(index) == newest:
+				return held
+			
+			for card in range(len(self.sources)):
+				if index[card] < newest:
+					self.free[card].put(held[card])
+					held[card] = None
+					with self.drop_lock:
+						self.dropped[card] += 1
+	
+	def _analysisLoop(self):
+		"""MainLoop of the Analysis-thread
+		Loop forever, taking a block of samples from each source's queue (see _takeBlocks()) and storing it in
+		the input-buffer, then calculate the pseudo-magnitude for each channel (and every so many cycles,
+		the spectral features). Repeat
+		"""
+		# calculate the spectral features on the first cycle
+		cycle = self.spectral_every
 		while self.run:
-			self._read()
-				
+			held = self._takeBlocks()
+			if held == None:
+				break
+			
+			for card in range(len(self.sources)):
+				i = held[card]
+				self.queue_depth[card] = self.filled[card].qsize()
+				if self.capture != None:
+					self.capture.store(self.ch_offset[card], self.blocks[card][i])
+				self._store(card, self.blocks[card][i])
+				self.clocks[card].add(*self.block_stamp[card][i])
+				self.free[card].put(i)
+			
+			mag_time = self._updateClocks()
+			
+			if self.capture != None:
+				self.capture.advance(self.blocksize)
+			
+			mag = self.buf.std(axis=1) / 100
+			
+			feat = None
+			cycle += 1
+			if (self.spectra != None) and (cycle >= self.spectral_every):
+				cycle = 0
+				feat = self._spectralFeatures()
+			
 			with self.mag_lock:
-				for ch in range(self.num_ch):
-					self.mag[ch] = self.buf[ch].std() / 100
-				
+				self.mag[:] = mag
+				self.mag_time[:] = mag_time
+				if feat is not None:
+					self.feat[:] = feat
+			
 			# siganl completion of one read-cycle
-			self.ready.set()
+			self._cycleDone()
+		
+		# wake up any thread waiting for the next read-cycle
+		self._cycleDone()
 				
 	
+	def _updateClocks(self):
+		"""Update the sources' estimated sample-rates.
+		Returns the monotonic- and wall-clock time of the newest sample in the input-buffer
+		"""
+		for card in range(len(self.clocks)):
+			self.clocks[card].update()
+			self.card_rate[card] = self.clocks[card].rate
+			self.card_drift[card] = self.clocks[card].drift()
+		
+		clk = self.clocks[0]
+		newest = clk.index[(clk.ptr - 1) % clk.window]
+		return (clk.monoTime(newest), clk.wallTime(newest))
+	
+	def _spectralFeatures(self):
+		"""Returns an array of the spectral features of all channels, calculated over the input-buffer (see dasdsp.Spectrum)
+		"""
+		feat = numpy.empty(shape=self.feat.shape)
+		for card in range(len(self.sources)):
+			off = self.ch_offset[card]
+			n = self.sources[card].num_ch
+			# use the estimated rate of real-time sources. (sources played back at another speed keep their nominal rate)
+			fs = None
+			if self.sources[card].speed == 1:
+				fs = self.card_rate[card]
+			feat[off:off + n] = self.spectra[card].features(self.buf[off:off + n], self.buf_ptr[off], fs)
+		
+		return feat
+	
 	def start(self):
-		"""Starts the Reader-thread and the Trigger-thread,
+		"""Starts the Reader-thread(s), the Analysis-thread and the Trigger-thread,
 		but first pre-loads the input-buffer with valid data.
 		"""
 		# pre-fill buffer, before any calculations can take place
 		for i in range(max(self.bufsize // self.blocksize, 1)):
-			self._read()
+			for card in range(len(self.sources)):
+				if not self.sources[card].read(self.blocks[card][0]):
+					raise ValueError("Not enough samples from %s %d to fill the buffer" % (self.sources[card].__class__.__name__, card))
+				self._stamp(card, 0)
+				self._store(card, self.blocks[card][0])
+				self.clocks[card].add(*self.block_stamp[card][0])
+		
+		if self.capture != None:
+			self.capture.start()
 		
 		self.run = True
-		self.read_thread.start()
+		for t in self.read_threads:
+			t.start()
+		self.analysis_thread.start()
 		self.trig_thread.start()
 		
 	
 	def stop(self):
-		"""Stops the Reader-loop and the Trigger-loop.
-		Waits for both threads to finish.
+		"""Stops the Reader-loop(s), the Analysis-loop and the Trigger-loop.
+		Waits for all threads to finish.
 		"""
 		self.run = False
-		for t in (self.trig_thread, self.read_thread):
-			if isinstance(t, threading.Thread) and t.isAlive():
+		for t in [self.trig_thread, self.analysis_thread] + self.read_threads:
+			if isinstance(t, threading.Thread) and t.isAlive() and (t != threading.currentThread()):
 				self.logMessage("Waiting for %s to finish..." % t.getName())
 				t.join()
-			
+		
+		for src in self.sources:
+			src.close()
+		self._saveNoise()
+		if self.capture != None:
+			self.capture.stop()
 		self.logMessage("Done")
 		
 	
+	def _cycleDone(self):
+		"""Count a completed read-cycle, and wake up all threads waiting for one
+		"""
+		with self.cycle_cond:
+			self.cycles += 1
+			self.cycle_cond.notify_all()
+	
+	def waitCycle(self, seen, timeout=None):
+		"""Wait until more than 'seen' read-cycles were completed, or for 'timeout' seconds at most.
+		Returns the number of read-cycles completed (to pass as 'seen' to the next call)
+		"""
+		with self.cycle_cond:
+			if self.cycles == seen:
+				self.cycle_cond.wait(timeout)
+			return self.cycles
+	
 	def isReady(self):
-		"""Returns 'True' if a read-cycle was completed, and no (other) thread is waiting for the next read-cycle to complete.
+		"""Returns 'True' if a read-cycle was completed since the calling thread last called waitMag()
 		"""
-		return self.ready.isSet()
+		return self.cycles != getattr(self.seen, 'cycles', 0)
 	
 	def waitMag(self, timeout=None):
-		"""Wait for a read-cycle to be completed. When this call returns, the pseudo-magnitudes will also have been calculated.
+		"""Wait for the next read-cycle to be completed. When this call returns, the pseudo-magnitudes will also have
+		been calculated. Other threads waiting for read-cycles (e.g. the Trigger-thread) are not affected
 		"""
-		self.ready.clear()
-		self.ready.wait(timeout)
+		with self.cycle_cond:
+			seen = self.cycles
+		self.seen.cycles = self.waitCycle(seen, timeout)
 	
 	def getMag(self):
 		"""Returns the current array of pseudo-magnitudes
@@ -174,46 +454,266 @@ class DASReader(object):
 		with self.mag_lock:
 			return self.mag
 	
+	def getFeatures(self):
+		"""Returns a dict with the channels' latest spectral features (see setSpectral()),
+		or 'None' if no spectral features are calculated:
+		'freq': a list of the dominant frequencies, 'centroid': a list of the spectral centroids,
+		and 'bands': a list of lists of the energies in each frequency-band, per channel
+		"""
+		if self.feat is None:
+			return None
+		
+		with self.mag_lock:
+			feat = self.feat.copy()
+		return self._featureDict(feat)
+	
+	def _featureDict(self, feat, chans=None):
+		"""Returns a dict of the features in the array 'feat', for the given channels (or all channels)
+		"""
+		if chans is not None:
+			feat = feat[chans]
+		return {'freq':feat[:, 0].tolist(), 'centroid':feat[:, 1].tolist(), 'bands':feat[:, 2:].tolist()}
+	
 	def getSPS(self):
-		"""Returns the current samples-per-second rate
+		"""Returns the current samples-per-second rate (of the slowest source)
 		"""
 		return self.sps
 	
-	def setThreshold(self, thresh):
+	def getCardSPS(self):
+		"""Returns a list of the current samples-per-second rates of each source (card)
+		"""
+		return self.card_sps.tolist()
+	
+	def getRate(self):
+		"""Returns a list of the true samples-per-second rates of each source (card),
+		estimated by a least-squares fit over the time-stamps of the last 'rate_window' blocks (see dasclock.SampleClock)
+		"""
+		return self.card_rate.tolist()
+	
+	def getDrift(self):
+		"""Returns a list of the drift of each source's (card's) estimated rate from its nominal rate, in parts-per-million
+		"""
+		return self.card_drift.tolist()
+	
+	def getMagTime(self):
+		"""Returns a tuple of the monotonic- and wall-clock time of the newest sample
+		the current pseudo-magnitudes were calculated over
+		"""
+		with self.mag_lock:
+			return tuple(self.mag_time.tolist())
+	
+	def getQueueDepth(self):
+		"""Returns a list of the number of blocks waiting to be analysed, per source (card)
+		"""
+		return self.queue_depth.tolist()
+	
+	def getDropped(self):
+		"""Returns a list of the number of blocks dropped because the Analysis-thread lagged behind (or skipped to keep
+		the sources in step), per source (card)
+		"""
+		return self.dropped.tolist()
+	
+	def getNoise(self):
+		"""Returns a list of the channels' background-noise estimates (see setAdaptive())
+		"""
+		return self.noise.tolist()
+	
+	def setThreshold(self, thresh, off=None):
 		"""Set the trigger-threshold, in pseudo-magnitude units (0.0 < thresh <= 10.0)
+		'off' sets the threshold below which a triggered channel is re-armed (0.0 < off <= thresh)
+		If 'off' is not given, the current hysteresis-fraction of the threshold is used.
 		"""
 		if thresh <= 0:
 			raise ValueError("Threshold value must be > 0")
+		if (off != None) and ((off <= 0) or (off > thresh)):
+			raise ValueError("Off-threshold value must be > 0 and <= threshold")
 		
+		if off != None:
+			self.hysteresis = float(off) / thresh
 		self.threshold = thresh
 	
+	def setFilter(self, highpass=None, lowpass=None, notch=None):
+		"""Filter the samples of all channels before the pseudo-magnitudes are calculated (see dasdsp.BlockFilter):
+		with a high-pass filter at 'highpass' Hz, a low-pass filter at 'lowpass' Hz (both make a band-pass filter),
+		and/or a notch-filter at 'notch' Hz (e.g. to remove mains-hum). The filters are designed for each source's nominal sps-rate.
+		If no frequencies are given, the samples are not filtered.
+		Must be called before start()
+		(Raises ValueError if the high-pass or notch-frequency is at or above a source's Nyquist-frequency)
+		"""
+		filters = []
+		for src in self.sources:
+			sections = dasdsp.design(src.sps, highpass, lowpass, notch)
+			if not len(sections):
+				filters = None
+				break
+			filters.append(dasdsp.BlockFilter(sections, src.num_ch))
+		
+		self.filters = filters
+	
+	def setSpectral(self, every=1, bands=None):
+		"""Calculate spectral features (dominant frequency, spectral centroid and the energy in frequency-bands)
+		of all channels, over the input-buffer, every 'every' read-cycles (see dasdsp.Spectrum).
+		'bands' is a list of (low, high) frequency-bands in Hz. If not given, the Spectrum's default bands are used.
+		The features are available through getFeatures(), and are passed to the trigger-function in its 'info' argument.
+		If 'every' is 0 or 'None', no spectral features are calculated.
+		Must be called before start()
+		"""
+		if not every:
+			self.spectra = None
+			self.feat = None
+			return
+		
+		self.spectra = []
+		for src in self.sources:
+			self.spectra.append(dasdsp.Spectrum(self.bufsize, src.sps, bands))
+		self.spectral_every = every
+		self.feat = self._newFeatures(2 + len(self.spectra[0].bands))
+	
+	def _newFeatures(self, n):
+		"""Returns a new array to store the 'n' spectral features of each channel in
+		"""
+		return numpy.zeros(shape=(self.num_ch, n), dtype='float')
+	
+	def setCapture(self, directory, pre=5., post=10.):
+		"""Capture the raw samples of all channels from 'pre' seconds before to 'post' seconds after each trigger,
+		and write them to a capture-file in 'directory' (see dascapture.Capture).
+		If 'directory' is 'None', triggers are not captured.
+		Must be called before start()
+		"""
+		if not directory:
+			self.capture = None
+			return
+		if (pre < 0) or (post < 0):
+			raise ValueError("Pre- and post-trigger periods must be >= 0")
+		
+		self.capture = dascapture.Capture(self.num_ch, self.sources[0].sps, directory, pre, post, self.logMessage, self.errMessage)
+	
+	def setCoincidence(self, k, channels=None, window=1.):
+		"""Enable k-of-n coincidence-triggering (see dastrigger.Coincidence):
+		An event is only triggered when at least 'k' of the given 'channels' (or of all channels, if not given)
+		have crossed the threshold within 'window' seconds. The trigger-function is then called once for the event,
+		with the strongest contributing channel, and the mean magnitude of all contributing channels.
+		If 'k' is 0 or 'None', coincidence-triggering is disabled, and each channel triggers on its own.
+		"""
+		if not k:
+			self.coincidence = None
+			return
+		if window <= 0:
+			raise ValueError("Coincidence window must be > 0")
+		
+		self.coincidence = dastrigger.Coincidence(self.num_ch, k, channels, window)
+	
+	def setAdaptive(self, k, rate=0.002, floor=0.01, filename=None):
+		"""Enable adaptive thresholds (see dastrigger.NoiseFloor):
+		Each channel's background-noise level is estimated from its recent pseudo-magnitudes (while it is not triggered),
+		and its trigger-threshold is set to 'k' times this noise-level, but never below 'floor'.
+		The 'off' threshold remains the hysteresis-fraction of the trigger-threshold.
+		'rate' is the fractional step by which the estimate moves per read-cycle
+		If 'filename' is given, the estimate is loaded from this file, and is saved to it periodically and on stop().
+		If 'k' is 0 or 'None', adaptive thresholds are disabled, and the fixed threshold is used for all channels.
+		"""
+		if not k:
+			self.adaptive = None
+			return
+		if (k <= 0) or (floor <= 0):
+			raise ValueError("Noise-multiple and floor must be > 0")
+		
+		self.adaptive = dastrigger.NoiseFloor(self.noise, k, rate, floor)
+		self.noise_file = filename
+		if filename:
+			try:
+				if self.adaptive.load(filename):
+					self.logMessage("Loaded noise-estimate from '%s'" % filename)
+			except (IOError, ValueError), e:
+				self.errMessage("Warning: Failed to load noise-estimate from '%s': %s" % (filename, str(e)))
+	
+	def _saveNoise(self):
+		"""Save the adaptive noise-estimate to its file, if any
+		"""
+		if (self.adaptive == None) or (not self.noise_file):
+			return
+		
+		try:
+			self.adaptive.save(self.noise_file)
+		except (IOError, OSError), e:
+			self.errMessage("Warning: Failed to save noise-estimate to '%s': %s" % (self.noise_file, str(e)))
+	
 	def _triggerLoop(self):
 		"""MainLoop of the Trigger-thread
 		Wait for the read-cycle to complete and pseudo-magnitudes to be calculated.
-		Compare each channels'pseudo-magnitude with the current threshold.
-		For each channel which isn't already triggered, and has a pseudo-magnitude > thresh,
-		The duration is caluclated fro mthe magnitude, and the trigger-function is called with 
-		the channel-number, the magnitude and the duration as arguments.
-		Re-triggering of a triggered channel cannot occur for the calulated duration
-		"""
-		end = numpy.ndarray(shape=(self.num_ch,), dtype='float')
-		end.fill(time.time())
-		#end = [0] * self.num_ch
+		Update the channels' trigger-states (see dastrigger.TriggerState) with the new pseudo-magnitudes.
+		For each ARMED channel with a pseudo-magnitude > thresh, the duration is caluclated from the magnitude,
+		and the trigger-function is called with the channel-number, the magnitude and the duration as arguments.
+		Re-triggering of a triggered channel cannot occur for the calulated duration,
+		nor until its pseudo-magnitude has fallen below the 'off' threshold.
+		If coincidence-triggering is enabled, the fired channels are passed to the coincidence-trigger instead,
+		and the trigger-function is only called when it declares an event.
+		If adaptive thresholds are enabled, each channel's threshold follows its background-noise estimate,
+		which is updated for all channels that are not triggered.
+		All timing is done on the (monotonic) time-stamps of the samples, so it is not affected by changes of the wall-clock.
+		"""
+		ts = dastrigger.TriggerState(self.num_ch)
+		saved = dasclock.monotonic()
+		seen = self.cycles
 		while self.run:
-			self.waitMag()
-			mag = self.getMag()
-			for ch in range(self.num_ch):
-				now = time.time()
-				if (now > end[ch]) and (mag[ch] > self.threshold):
-					duration = 10**((mag[ch] + 1.05) / 2.22)
-					end[ch] = now + 1 # duration
-					
-					self.trig_func(ch, mag[ch], duration)
-					self.trigger.set()
+			seen = self.waitCycle(seen)
+			with self.mag_lock:
+				mag = self.mag.copy()
+				(now, wall) = self.mag_time.tolist()
+				if self.feat is not None:
+					feat = self.feat.copy()
+			
+			if self.adaptive != None:
+				# channels in HOLDOFF are included, so that a channel whose noise has risen above its threshold
+				# is not held off forever
+				self.adaptive.update(mag, ts.state != dastrigger.TRIGGERED)
+				if (now - saved) >= self.noise_save_interval:
+					self._saveNoise()
+					saved = now
+				on = self.adaptive.level()
+			else:
+				on = self.threshold
+			(fired, duration) = ts.update(mag, now, on, on * self.hysteresis)
+			
+			if self.coincidence == None:
+				for i in range(len(fired)):
+					ch = fired[i]
+					info = {'chans':[int(ch)], 'mags':[float(mag[ch])], 'time':wall}
+					if self.feat is not None:
+						info['features'] = self._featureDict(feat, [ch])
+					if self.capture != None:
+						self.capture.trigger({'time':wall, 'rate':float(self.card_rate[0]), 'ch':int(ch), 'mag':float(mag[ch]), 'dur':float(duration[i])})
+					self._callTrigFunc(ch, mag[ch], duration[i], info)
 				
-			if (time.time() > end).all() and (mag < self.threshold).all():
-				self.trigger.clear()
+				if len(fired):
+					self.trigger.set()
+				elif ts.isArmed():
+					self.trigger.clear()
+				continue
 			
+			event = self.coincidence.update(fired, mag, now, ts.state)
+			if event != None:
+				(chans, mags, agg, dur) = event
+				# report the strongest contributing channel
+				ch = chans[mags.argmax()]
+				info = {'chans':chans.tolist(), 'mags':mags.tolist(), 'time':wall}
+				if self.feat is not None:
+					info['features'] = self._featureDict(feat, chans)
+				if self.capture != None:
+					self.capture.trigger({'time':wall, 'rate':float(self.card_rate[0]), 'ch':int(ch), 'mag':float(agg), 'dur':float(dur), 'chans':",".join([str(c) for c in info['chans']])})
+				self._callTrigFunc(ch, agg, dur, info)
+				self.trigger.set()
+			elif ts.isArmed():
+				self.trigger.clear()
+	
+	def _callTrigFunc(self, ch, mag, dur, info):
+		"""Call the trigger-function, with or without the 'info' argument
+		"""
+		if self.trig_info:
+			self.trig_func(ch, mag, dur, info)
+		else:
+			self.trig_func(ch, mag, dur)
+	
 	def waitTrig(self, timeout=None):
 		"""Waits for any channel to be triggered
 		"""
@@ -225,27 +725,235 @@ class DASReader(object):
 		"""
 		return self.trigger.isSet()
 	
-	def trig_func(self, ch, mag, dur):
+	def trig_func(self, ch, mag, dur, info=None):
 		"""A simple (example) trigger-function
 		Prints 'Ch <c> triggered at mag= <m.mmm> for dur= <d.ddd> s"
-		Alternative implementations must accept 3 arguments: (channel-number, magnitude, duration)
+		Alternative implementations must accept 3 arguments: (channel-number, magnitude, duration),
+		or 4 arguments: (channel-number, magnitude, duration, info), where 'info' is a dict with
+		the numbers ('chans') and magnitudes ('mags') of the channels that contributed to the trigger,
+		the wall-clock time of the newest sample the magnitudes were calculated over ('time'),
+		and their spectral features ('features', see getFeatures()) if these are calculated.
 		"""
-		self.logMessage("Ch %d triggered at mag= %.3f for dur= %.3f s" % (ch, mag, dur))
+		if info and (len(info['chans']) > 1):
+			self.logMessage("Ch %s triggered at mag= %.3f for dur= %.3f s" % (",".join([str(c) for c in info['chans']]), mag, dur))
+		else:
+			self.logMessage("Ch %d triggered at mag= %.3f for dur= %.3f s" % (ch, mag, dur))
 		
 	def setTrigFunc(self, func):
 		"""Register a trigger-function.
 		Checks if the supplied argument is callable (ie. a method or function) and accepts the correct number of arguments.
 		"""
 		if hasattr(func, 'im_func'):
-			if func.im_func.func_code.co_argcount != 4:
-				raise AttributeError("Trigger callback function '%s' must take 4 arguments (self, channel, magnitude, duration)" % repr(func))
+			argc = func.im_func.func_code.co_argcount - 1
 		elif hasattr(func, 'func_code'):
-			if func.func_code.co_argcount != 3:
-				raise AttributeError("Trigger callback function '%s' must take 3 arguments (channel, magnitude, duration)" % repr(func))
+			argc = func.func_code.co_argcount
 		else:
 			raise TypeError("Trigger callback function '%s' is not callable" % repr(func))
 		
+		if argc not in (3, 4):
+			raise AttributeError("Trigger callback function '%s' must take 3 arguments (channel, magnitude, duration) or 4 arguments (channel, magnitude, duration, info)" % repr(func))
+		
 		self.trig_func = func
+		self.trig_info = (argc == 4)
+	
+
+class DASProcess(DASReader):
+	"""A DASReader that runs its Reader-loop and Trigger-loop in a child-process, optionally pinned to one CPU.
+	The pseudo-magnitudes, the samples-per-second rate and the threshold are kept in shared memory,
+	the read-cycle count and its condition and the 'trigger' event are shared between the processes, and each trigger is passed back
+	through a pipe to the parent-process, where the registered trigger-function is called.
+	The API on the parent-side (setTrigFunc(), getMag(), waitMag(), waitTrig(), ...) is the same as the DASReader's,
+	except that setFilter(), setSpectral(), setCapture(), setCoincidence() and setAdaptive() must be called before start()
+	(in a DASProcess, the capture-files are written by the child-process)
+	"""
+	def __init__(self, inputs=1, bufsize=15, blocksize=10, source=None, cpu=None):
+		"""Instantiate a DASProcess for the first 'inputs' inputs of the card
+		'bufsize', 'blocksize' and 'source' are as for the DASReader.
+		'cpu' is the number of the CPU (core) the child-process is pinned to. If 'None', the process is not pinned.
+		"""
+		if multiprocessing == None:
+			raise ImportError("The DASProcess requires the 'multiprocessing' module (Python >= 2.6)")
+		
+		# the shared values have to exist before DASReader.__init__() sets the sps-rate and the read-cycle count
+		self.shm_sps = multiprocessing.Value('d', 0., lock=False)
+		self.shm_cycles = multiprocessing.Value('l', 0, lock=False)
+		self.shm_thresh = multiprocessing.Value('d', DASReader.threshold, lock=False)
+		self.shm_hyst = multiprocessing.Value('d', DASReader.hysteresis, lock=False)
+		
+		super(DASProcess, self).__init__(inputs, bufsize, blocksize, source)
+		
+		# replace the magnitudes-array by an array in shared memory, guarded by its own (inter-process) lock
+		self.shm_mag = multiprocessing.Array('d', self.num_ch)
+		self.mag = numpy.frombuffer(self.shm_mag.get_obj(), dtype='float')
+		self.mag_lock = self.shm_mag.get_lock()
+		
+		# likewise for the sources' sps-rates, queue-depths and dropped-block counts
+		self.shm_card_sps = multiprocessing.Array('d', len(self.sources), lock=False)
+		self.card_sps = numpy.frombuffer(self.shm_card_sps, dtype='float')
+		self.shm_card_rate = multiprocessing.Array('d', len(self.sources), lock=False)
+		self.card_rate = numpy.frombuffer(self.shm_card_rate, dtype='float')
+		self.shm_card_drift = multiprocessing.Array('d', len(self.sources), lock=False)
+		self.card_drift = numpy.frombuffer(self.shm_card_drift, dtype='float')
+		# the magnitudes' time-stamps are guarded by the magnitudes-array's lock
+		self.shm_mag_time = multiprocessing.Array('d', 2, lock=False)
+		self.mag_time = numpy.frombuffer(self.shm_mag_time, dtype='float')
+		self.shm_queue_depth = multiprocessing.Array('l', len(self.sources), lock=False)
+		self.queue_depth = numpy.frombuffer(self.shm_queue_depth, dtype='int')
+		self.shm_dropped = multiprocessing.Array('l', len(self.sources), lock=False)
+		self.dropped = numpy.frombuffer(self.shm_dropped, dtype='int')
+		self.shm_noise = multiprocessing.Array('d', self.num_ch, lock=False)
+		self.noise = numpy.frombuffer(self.shm_noise, dtype='float')
+		
+		# the condition signalling the completion of read-cycles (guarding the shared read-cycle count),
+		# and the events signalling triggers and halting, shared between the processes
+		self.cycle_cond = multiprocessing.Condition()
+		self.trigger = multiprocessing.Event()
+		self.halt = multiprocessing.Event()
+		
+		# a one-way pipe for passing triggers from the child- to the parent-process
+		(self.trig_conn, self.child_conn) = multiprocessing.Pipe(False)
+		
+		self.cpu = cpu
+		self.proc = multiprocessing.Process(None, self._childMain, "DASReaderProcess")
+		self.dispatch_thread = threading.Thread(None, self._dispatchLoop, "DASDispatchThread")
+	
+	def _getSPS(self):
+		return self.shm_sps.value
+	
+	def _setSPS(self, sps):
+		self.shm_sps.value = sps
+	
+	# the sps-rate is calculated in the child-process, and read in the parent-process
+	sps = property(_getSPS, _setSPS)
+	
+	def _getCycles(self):
+		return self.shm_cycles.value
+	
+	def _setCycles(self, cycles):
+		self.shm_cycles.value = cycles
+	
+	# likewise for the read-cycle count
+	cycles = property(_getCycles, _setCycles)
+	
+	def _getThreshold(self):
+		return self.shm_thresh.value
+	
+	def _setThreshold(self, thresh):
+		self.shm_thresh.value = thresh
+	
+	# the threshold is set in the parent-process, and used in the child-process
+	threshold = property(_getThreshold, _setThreshold)
+	
+	def _getHysteresis(self):
+		return self.shm_hyst.value
+	
+	def _setHysteresis(self, hyst):
+		self.shm_hyst.value = hyst
+	
+	# likewise for the hysteresis-fraction
+	hysteresis = property(_getHysteresis, _setHysteresis)
+	
+	def _newFeatures(self, n):
+		"""Returns a new array in shared memory to store the 'n' spectral features of each channel in
+		(guarded by the magnitudes-array's lock)
+		"""
+		self.shm_feat = multiprocessing.Array('d', self.num_ch * n, lock=False)
+		return numpy.frombuffer(self.shm_feat, dtype='float').reshape((self.num_ch, n))
+	
+	def _pinCPU(self, cpu):
+		"""Pin the calling process to the given CPU, using the 'taskset' utility
+		"""
+		devnull = open(os.devnull, 'w')
+		try:
+			ret = subprocess.call(["taskset", "-p", "-c", "%d" % cpu, "%d" % os.getpid()], stdout=devnull, stderr=devnull)
+		except OSError, e:
+			ret = str(e)
+		devnull.close()
+		
+		if ret == 0:
+			self.logMessage("Process %d pinned to CPU %d" % (os.getpid(), cpu))
+		else:
+			self.errMessage("Warning: Failed to pin process %d to CPU %d (%s)" % (os.getpid(), cpu, str(ret)))
+	
+	def _sendTrig(self, ch, mag, dur, info):
+		"""The trigger-function used in the child-process; passes the trigger to the parent-process
+		"""
+		self.child_conn.send((int(ch), float(mag), float(dur), info))
+	
+	def _childMain(self):
+		"""MainLoop of the child-process
+		Starts the Reader-thread and the Trigger-thread, and waits until the parent-process sets the 'halt' event,
+		or until the Reader-thread exits. Then stops both threads.
+		"""
+		# the signal-handlers are inherited from the parent-process, which stops us by setting 'halt'
+		for sig in (signal.SIGINT, signal.SIGQUIT, signal.SIGHUP):
+			signal.signal(sig, signal.SIG_IGN)
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		
+		if self.cpu != None:
+			self._pinCPU(self.cpu)
+		
+		self.trig_func = self._sendTrig
+		self.trig_info = True
+		DASReader.start(self)
+		
+		while (not self.halt.is_set()) and self.run:
+			self.halt.wait(1)
+		
+		DASReader.stop(self)
+		self.child_conn.close()
+	
+	def _dispatchLoop(self):
+		"""MainLoop of the Dispatch-thread in the parent-process
+		Receives the triggers from the child-process, and calls the trigger-function for each.
+		Stops the DASProcess if the child-process exits.
+		"""
+		while self.run:
+			if not self.trig_conn.poll(0.5):
+				if self.run and not self.proc.is_alive():
+					if self.proc.exitcode == 0:
+						self.logMessage("%s exited" % self.proc.name)
+					else:
+						self.errMessage("Error: %s exited with code %s" % (self.proc.name, str(self.proc.exitcode)))
+					self.run = False
+				continue
+			
+			try:
+				(ch, mag, dur, info) = self.trig_conn.recv()
+			except EOFError:
+				continue
+			
+			self._callTrigFunc(ch, mag, dur, info)
+	
+	def start(self):
+		"""Starts the child-process (which pre-loads the input-buffer, then starts the Reader- and Trigger-threads),
+		and the Dispatch-thread.
+		"""
+		self.run = True
+		self.proc.start()
+		self.dispatch_thread.start()
+	
+	def stop(self):
+		"""Stops the child-process and the Dispatch-thread.
+		Waits for both to finish.
+		"""
+		self.run = False
+		self.halt.set()
+		if self.proc.is_alive():
+			self.logMessage("Waiting for %s to finish..." % self.proc.name)
+			self.proc.join()
+		
+		t = self.dispatch_thread
+		if t.isAlive() and (t != threading.currentThread()):
+			self.logMessage("Waiting for %s to finish..." % t.getName())
+			t.join()
+		
+		self.logMessage("Done")
+	
+	def hasTrigger(self):
+		"""Returns 'True' if a channel has triggerd, and no (other) thread is waiting for the next trigger.
+		"""
+		return self.trigger.is_set()
 	
 
 if __name__ == '__main__':
@@ -267,14 +975,50 @@ if __name__ == '__main__':
 					help="draw a graph of the received signal using pylab")
 	op.add_option("-x", "--xsize", action='store', type='int', dest='xsize', metavar='SIZE', 
 					help="set X-axis length of the graph (implies -g) [default = %d]" % default_xsize)
+	op.add_option("-F", "--fps", action='store', type='float', dest='fps', metavar='FPS',
+					help="redraw the graph at most FPS times per second [default = %default]")
 	op.add_option("-c", "--channels", action='store', type='int', dest='channels', metavar='N',
-					help="set number of channels to sample [default = %d]" % default_channels)
+					help="set number of channels to sample (8 per card) [default = %d]" % default_channels)
 	op.add_option("-b", "--bufsize", action='store', type='int', dest='bufsize', metavar='SIZE',
 					help="set size of sample buffer [default = %d]" % default_bufsize)
 	op.add_option("-s", "--blocksize", action='store', type='int', dest='blocksize', metavar='SIZE',
 					help="set size of sample block [default = %d]" % default_blksize)
 	op.add_option("-t", "--threshold", action='store', type='float', dest='thresh', metavar='MAG',
 					help="set trigger threshold magnitude [default = %.1f]" % default_thresh)
+	op.add_option("-T", "--off-threshold", action='store', type='float', dest='off', metavar='MAG',
+					help="set the threshold magnitude below which a triggered channel is re-armed [default = 0.8 x threshold]")
+	op.add_option("-R", "--replay", action='store', type='string', dest='replay', metavar='FILE',
+					help="read samples from sample-file FILE instead of the DAS08-inputs")
+	op.add_option("-Y", "--synth", action='store_true', dest='synth',
+					help="read synthetic samples (noise and quake-like bursts) instead of the DAS08-inputs")
+	op.add_option("-S", "--speed", action='store', type='float', dest='speed', metavar='X',
+					help="replay or synthesize samples at X times real-time (0 = as fast as possible) [default = 1]")
+	op.add_option("-W", "--record", action='store', type='string', dest='record', metavar='FILE',
+					help="record all samples read to sample-file FILE")
+	op.add_option("-K", "--coincidence", action='store', type='int', dest='coinc', metavar='K',
+					help="only trigger when at least K channels cross the threshold within the coincidence-window")
+	op.add_option("-w", "--window", action='store', type='float', dest='window', metavar='SEC',
+					help="set the coincidence-window [default = %default s]")
+	op.add_option("--coinc-channels", action='store', type='string', dest='coinc_chans', metavar='LIST',
+					help="comma-separated list of the channels taking part in the coincidence [default = all]")
+	op.add_option("-a", "--adaptive", action='store', type='float', dest='adaptive', metavar='K',
+					help="adapt each channel's threshold to K times its background-noise level (never below 0.01)")
+	op.add_option("--noise-file", action='store', type='string', dest='noise_file', metavar='FILE',
+					help="load and save the background-noise estimate from/to FILE")
+	op.add_option("--highpass", action='store', type='float', dest='highpass', metavar='HZ',
+					help="high-pass filter the samples at HZ before calculating the magnitudes")
+	op.add_option("--lowpass", action='store', type='float', dest='lowpass', metavar='HZ',
+					help="low-pass filter the samples at HZ before calculating the magnitudes")
+	op.add_option("--notch", action='store', type='float', dest='notch', metavar='HZ',
+					help="notch-filter the samples at HZ (e.g. mains-hum) before calculating the magnitudes")
+	op.add_option("--spectral", action='store', type='int', dest='spectral', metavar='N',
+					help="calculate spectral features every N read-cycles")
+	op.add_option("--capture", action='store', type='string', dest='capture', metavar='DIR',
+					help="write the samples around each trigger to a capture-file in DIR")
+	op.add_option("--pre", action='store', type='float', dest='pre', metavar='SEC',
+					help="capture SEC seconds before each trigger [default = %default]")
+	op.add_option("--post", action='store', type='float', dest='post', metavar='SEC',
+					help="capture SEC seconds after each trigger [default = %default]")
 	
 	# Set defaults
 	op.set_defaults(graph=False)
@@ -282,6 +1026,12 @@ if __name__ == '__main__':
 	op.set_defaults(bufsize=default_bufsize)
 	op.set_defaults(blocksize=default_blksize)
 	op.set_defaults(thresh=default_thresh)
+	op.set_defaults(synth=False)
+	op.set_defaults(speed=1.)
+	op.set_defaults(window=1.)
+	op.set_defaults(fps=10.)
+	op.set_defaults(pre=5.)
+	op.set_defaults(post=10.)
 	
 	# Parse command-line options
 	(opts, args) = op.parse_args()
@@ -302,11 +1052,40 @@ if __name__ == '__main__':
 				except ValueError:
 					sys.stderr.write("Invalid verbosity argument '%s'" % opts.verbose)
 
+	# Open the sample-source, and wrap it in a RecordingSource if requested
+	source = dassource.openSource(opts.channels, opts.replay, opts.synth, opts.speed)
+	if opts.record and (type(source) == types.ListType):
+		# record each card to its own file
+		for i in range(len(source)):
+			source[i] = dassource.RecordingSource(source[i], "%s.%d" % (opts.record, i))
+	elif opts.record:
+		source = dassource.RecordingSource(source, opts.record)
+	
 	# Instatntiate DASReader with the provided (or default) paramters
-	dr = DASReader(opts.channels, opts.bufsize, opts.blocksize)
+	dr = DASReader(opts.channels, opts.bufsize, opts.blocksize, source)
 	
 	# Set the threshold
-	dr.setThreshold(opts.thresh)
+	dr.setThreshold(opts.thresh, opts.off)
+	
+	# Enable coincidence-triggering
+	if opts.coinc:
+		chans = None
+		if opts.coinc_chans:
+			chans = [int(c) for c in opts.coinc_chans.split(',')]
+		dr.setCoincidence(opts.coinc, chans, opts.window)
+	
+	# Enable adaptive thresholds
+	if opts.adaptive:
+		dr.setAdaptive(opts.adaptive, filename=opts.noise_file)
+	
+	# Filter the samples
+	dr.setFilter(opts.highpass, opts.lowpass, opts.notch)
+	
+	# Calculate spectral features
+	dr.setSpectral(opts.spectral)
+	
+	# Capture the samples around triggers
+	dr.setCapture(opts.capture, opts.pre, opts.post)
 	
 	# Define a signal-handler for stopping the DASReader's threads
 	def stophandler(sig, frame):
@@ -317,8 +1096,10 @@ if __name__ == '__main__':
 	signal.signal(signal.SIGINT, stophandler)
 	
 	# Define an alternative trigger-function
-	def trig_func(ch, mag, dur):
-		print("Channel %d triggered at mag= %.3f for dur= %.3f" % (ch, mag, dur))
+	def trig_func(ch, mag, dur, info):
+		print("Channel %d triggered at mag= %.3f for dur= %.3f (channels %s)" % (ch, mag, dur, str(info['chans'])))
+		if 'features' in info:
+			print("  dominant freq. %s Hz, centroid %s Hz" % (str(info['features']['freq']), str(info['features']['centroid'])))
 		
 	# Register trigger-function
 	dr.setTrigFunc(trig_func)
@@ -327,44 +1108,18 @@ if __name__ == '__main__':
 	dr.start()
 	
 	if opts.graph or opts.xsize:
-		# use 'pylab' module to draw an animated line-graph of the channels' magnitudes
+		# use 'pylab' module (through the MagGraph) to draw an animated line-graph of the channels' magnitudes
+		graph = None
 		try:
-			import pylab as p
+			import dasgraph
 			
 			# Set max nr of datapoints for the graph(s)
 			if opts.xsize and (opts.xsize >= 50):
 				xsize = opts.xsize
 			else:
 				xsize = default_xsize
-				
-			# Define initail datapoints at t = 0 as '0'
-			tm = [0]
-			mg = []
-			for ch in range(dr.num_ch):
-				mg.append([0])
-			
-			# draw the currently defined threshold as a dotted red line
-			th = [dr.threshold]
-			
-			# put pylab in 'interactive mode'
-			p.ion()
 			
-			# define a 'figure' (this creates the window for the grph(s))
-			fig = p.figure(figsize=(1 + (xsize // 50), 1 + (2 * dr.num_ch)))
-			
-			# 'interactive mode' off
-			p.ioff()
-			
-			# define the graph(s)
-			graph = [[]] * dr.num_ch
-			for ch in range(dr.num_ch):
-				p.subplot(dr.num_ch, 1, ch + 1)
-				graph[ch] = p.plot(tm, mg[ch], 'b-', th, 'r:')
-				p.title('channel %d' %ch)
-				p.ylabel('magnitude')
-				
-			# only label X-axis of the bottom graph
-			p.xlabel('seconds')
+			graph = dasgraph.MagGraph(dr.num_ch, xsize, opts.fps)
 			
 			start_time = time.time()
 			# run this loop until the dr is stopped
@@ -373,35 +1128,17 @@ if __name__ == '__main__':
 				dr.waitMag()
 				mag = dr.getMag()
 				
-				# append current magnitudes to each list of datapoints
-				for ch in range(dr.num_ch):
-					mg[ch].append(mag[ch])
-					if len(mg[ch]) > xsize:
-						# discared oldest datapoint
-						del mg[ch][0]
-				
-				# append elapsed time to list of time-points 
-				tm.append(time.time() - start_time)
-				if len(tm) > xsize:
-					# discared oldest time-point
-					del tm[0]
-				
-				# draw current threshold as a horizontal line
-				th = [dr.threshold] * len(tm)
+				# add the current magnitudes at the elapsed time
+				graph.append(time.time() - start_time, mag)
 				
-				for ch in range(dr.num_ch):
-					graph[ch][0].set_data(tm, mg[ch])	# set new datapoints
-					graph[ch][1].set_data(tm, th)		# set threshold points
-				
-					top = max(mg[ch])
-					p.subplot(dr.num_ch, 1, ch + 1)
-					# scale each graph's axes
-					p.axis([tm[0], tm[-1], 0, max(top, 1)])
-				
-				p.draw()
+				# draw the current threshold(s) as a horizontal line. The graph is only redrawn 'fps' times per second
+				if dr.adaptive != None:
+					graph.draw(dr.adaptive.level())
+				else:
+					graph.draw(dr.threshold)
 				
 				if (verbose & 1) != 0:
-					print "%.1f s/s" % dr.getSPS()
+					print "%.1f s/s, rate %s, drift %s ppm, queued %s, dropped %s" % (dr.getSPS(), ["%.3f" % r for r in dr.getRate()], ["%.0f" % d for d in dr.getDrift()], dr.getQueueDepth(), dr.getDropped())
 				elif (verbose & 2) != 0:
 					if dr.hasTrigger():
 						star = '*'
@@ -415,10 +1152,8 @@ if __name__ == '__main__':
 				
 		finally:
 			dr.stop()
-			try:
-				p.close()
-			except NameError:
-				pass
+			if graph != None:
+				graph.close()
 			
 			exit(0)
 	
@@ -433,12 +1168,12 @@ if __name__ == '__main__':
 			# calculate some integer values for drawing an 'ascii-art' 90-deg rotated graph
 			top = max(int(mag.max() + 1), top)
 			scale = top / 100.
-			mg = mag // scale
+			mg = (mag // scale).astype('int')
 			rm = 100 - mg
 			
 			if (verbose & 1) != 0:
 				# only print the sps rate
-				print "%.1f s/s" % dr.getSPS()
+				print "%.1f s/s, rate %s, drift %s ppm, queued %s, dropped %s" % (dr.getSPS(), ["%.3f" % r for r in dr.getRate()], ["%.0f" % d for d in dr.getDrift()], dr.getQueueDepth(), dr.getDropped())
 			elif (verbose & 2) != 0:
 				# print the ascii-graph
 				if dr.hasTrigger():
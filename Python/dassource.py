@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+###
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Defines the sample-sources the DASReader (see dasreader.py) can read its samples from:
+#	DeviceSource	reads the inputs of a PCI-DAS08 A/D converter card (via /dev/das08/ad0_N)
+#	ReplaySource	plays back a recorded sample-file, at the nominal sample-rate or faster
+#	SyntheticSource	generates noise with injected quake-like bursts, at the nominal sample-rate or faster
+#	RecordingSource	wraps another source, and writes all samples read from it to a sample-file
+#
+# A sample-file contains the raw samples as little-endian unsigned 16-bit integers,
+# one frame of 'num_ch' interleaved samples per sample-period.
+# Capture-files (see dascapture.py) are sample-files with a header, from which the ReplaySource takes the number of
+# channels and the sample-rate.
+# The Replay- and Synthetic sources allow testing triggers, tuning thresholds and benchmarking
+# without the PCI-DAS08 card, faster than real-time if so desired.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+
+import os, time, struct
+import numpy
+
+import dascapture
+
+
+class SampleSource(object):
+	"""Base-class for the DASReader's sample-sources.
+	Subclasses must implement read()
+	"""
+	# nominal samples-per-second rate
+	sps = 100.
+
+	def __init__(self, inputs=1, sps=None, speed=1.):
+		"""Instantiate a sample-source with 'inputs' channels
+		'sps' sets the nominal samples-per-second rate
+		'speed' sets the play-back speed as a multiple of the nominal rate. (speed <= 0 means 'as fast as possible')
+		"""
+		self.num_ch = max(1, inputs)
+		if sps:
+			self.sps = float(sps)
+		self.speed = speed
+
+		self.t0 = None
+		self.count = 0
+
+	def _pace(self, n):
+		"""Sleep until the 'n' samples just produced are due, at 'speed' times the nominal sample-rate
+		"""
+		if self.speed <= 0:
+			return
+
+		if self.t0 == None:
+			self.t0 = time.time()
+
+		self.count += n
+		delay = self.t0 + (self.count / (self.sps * self.speed)) - time.time()
+		if delay > 0:
+			time.sleep(delay)
+
+	def read(self, out):
+		"""Fill 'out' (an array of shape (num_ch x n)) with the next 'n' samples of each channel.
+		Returns 'False' if there are no more samples, 'True' otherwise
+		"""
+		raise NotImplementedError("%s.read()" % self.__class__.__name__)
+
+	def close(self):
+		"""Release any resources held by the source
+		"""
+		pass
+
+
+class DeviceSource(SampleSource):
+	"""Reads samples from the first 'inputs' inputs of a PCI-DAS08 card
+	"""
+	# format of the device-file names (card-number, input-number)
+	devpath = "/dev/das08/ad%d_%d"
+
+	def __init__(self, inputs=1, card=0, devpath=None):
+		"""Instantiate a DeviceSource for the first 'inputs' inputs of card number 'card'
+		(where 1 <= inputs <= 8)
+		'devpath' is the format of the device-file names, with the card- and input-number as arguments.
+		"""
+		super(DeviceSource, self).__init__(min(max(1, inputs), 8))
+
+		if devpath:
+			self.devpath = devpath
+		self.card = card
+
+		# build a list of device-file names
+		self.dev = []
+		for i in range(self.num_ch):
+			self.dev.append(self.devpath % (card, i))
+
+	def read(self, out):
+		"""Read one sample from each channel, in round-robin fashion, 'n' times.
+		i.e. Read one block of samples from all channels, interleaved.
+		"""
+		for i in range(out.shape[1]):
+			for ch in range(self.num_ch):
+				fd = None
+				try:
+					# the DAS08 driver requires that each channel is opened before reading,
+					# in order to control the 8-input multiplexer. The card only has ONE actual ADC.
+					fd = open(self.dev[ch], 'rb', 0)
+					bytes = fd.read(2)
+				finally:
+					if fd:
+						fd.close()
+
+				out[ch, i] = struct.unpack('<H', bytes)[0]
+
+			# wait 10ms after reading 1 sample from all channels.
+			# the aim is to get 100 sps on all channels.
+			time.sleep(0.01)
+
+		return True
+
+
+class ReplaySource(SampleSource):
+	"""Plays back a recorded sample-file
+	"""
+	def __init__(self, filename, inputs=1, sps=None, speed=1., loop=False):
+		"""Instantiate a ReplaySource for a sample-file containing 'inputs' channels.
+		'sps' is the samples-per-second rate the file was recorded at
+		'speed' sets the play-back speed as a multiple of this rate. (speed <= 0 means 'as fast as possible')
+		If 'loop' == True, the file is played back over and over again
+		The 'num_ch' and 'sps' in the header of a capture-file override 'inputs' and 'sps'
+		"""
+		super(ReplaySource, self).__init__(inputs, sps, speed)
+
+		self.filename = filename
+		self.loop = loop
+		self.fd = open(filename, 'rb')
+
+		# skip the header of a capture-file, and take the file's layout from it
+		self.header = dascapture.readHeader(self.fd)
+		self.data_start = self.fd.tell()
+		if self.header != None:
+			try:
+				if 'num_ch' in self.header:
+					self.num_ch = max(1, int(self.header['num_ch']))
+				if float(self.header.get('sps', 0)) > 0:
+					self.sps = float(self.header['sps'])
+			except ValueError:
+				pass
+
+	def read(self, out):
+		"""Read the next block of frames from the file.
+		Returns 'False' at the end of the file (unless looping)
+		"""
+		n = out.shape[1]
+		data = numpy.fromfile(self.fd, dtype='<u2', count=(n * self.num_ch))
+		while self.loop and (len(data) < (n * self.num_ch)):
+			self.fd.seek(self.data_start)
+			more = numpy.fromfile(self.fd, dtype='<u2', count=((n * self.num_ch) - len(data)))
+			if not len(more):
+				break
+			data = numpy.concatenate((data, more))
+
+		if len(data) < (n * self.num_ch):
+			return False
+
+		out[:] = data.reshape((n, self.num_ch)).T
+		self._pace(n)
+		return True
+
+	def close(self):
+		self.fd.close()
+
+
+class SyntheticSource(SampleSource):
+	"""Generates Gaussian noise around a DC-offset, with randomly injected quake-like bursts.
+	The duration of a burst follows the same magnitude -> duration law the DASReader uses,
+	and its amplitude is such that its pseudo-magnitude (standard-deviation / 100) roughly matches the magnitude.
+	"""
+	def __init__(self, inputs=1, sps=None, speed=1., noise=3., offset=2048, interval=60., mags=(0.5, 4.0), seed=None):
+		"""Instantiate a SyntheticSource with 'inputs' channels.
+		'sps' and 'speed' are as for the SampleSource.
+		'noise' is the standard-deviation of the background noise (in ADC counts)
+		'offset' is the DC-offset of the signal (in ADC counts)
+		'interval' is the mean interval between bursts (in seconds of sample-time). If 0, no bursts are generated
+		'mags' is the (min, max) range of the magnitudes of the bursts
+		'seed' seeds the random-generator, for repeatable runs
+		"""
+		super(SyntheticSource, self).__init__(inputs, sps, speed)
+
+		self.noise = noise
+		self.offset = offset
+		self.interval = interval
+		self.mags = mags
+		self.random = numpy.random.RandomState(seed)
+
+		# the sample-index of the next sample to generate
+		self.t = 0
+		# a list of active bursts as (start-sample, magnitude, duration-in-samples, channel-gains) tuples
+		self.bursts = []
+		self.next_burst = self._nextBurst(0)
+
+	def _nextBurst(self, after):
+		"""Returns the sample-index of the next random burst after sample-index 'after'
+		"""
+		if self.interval <= 0:
+			return None
+
+		return after + int(self.random.exponential(self.interval) * self.sps)
+
+	def burst(self, mag, start=None):
+		"""Inject a burst of the given magnitude, starting at sample-index 'start' (or at the next sample)
+		"""
+		if start == None:
+			start = self.t
+		duration = 10**((mag + 1.05) / 2.22)
+		gains = self.random.uniform(0.8, 1.2, self.num_ch)
+		self.bursts.append((start, mag, int(duration * self.sps), gains))
+
+	def read(self, out):
+		"""Generate the next block of samples
+		"""
+		n = out.shape[1]
+
+		while (self.next_burst != None) and (self.next_burst < (self.t + n)):
+			self.burst(self.random.uniform(*self.mags), self.next_burst)
+			self.next_burst = self._nextBurst(self.next_burst)
+
+		block = self.random.normal(self.offset, self.noise, (self.num_ch, n))
+
+		idx = numpy.arange(self.t, self.t + n)
+		active = []
+		for (start, mag, dur, gains) in self.bursts:
+			if (start + dur) <= self.t:
+				# this burst has ended
+				continue
+			active.append((start, mag, dur, gains))
+			if start >= (self.t + n):
+				continue
+
+			# a short linear rise, followed by an exponential decay over the burst's duration
+			age = (idx - start).clip(0, dur)
+			rise = max(1., self.sps * 0.1)
+			env = numpy.minimum(age / rise, 1.) * numpy.exp(-3. * age / dur)
+			env[idx < start] = 0.
+			env[idx >= (start + dur)] = 0.
+			block += self.random.normal(0., 100. * mag, (self.num_ch, n)) * env * gains[:, numpy.newaxis]
+
+		self.bursts = active
+		out[:] = block.clip(0, 4095)
+		self.t += n
+		self._pace(n)
+		return True
+
+
+class RecordingSource(SampleSource):
+	"""Wraps another sample-source and writes all samples read from it to a sample-file,
+	which can be played back with a ReplaySource
+	"""
+	def __init__(self, source, filename):
+		"""Instantiate a RecordingSource, recording the given 'source' to the file 'filename'
+		"""
+		super(RecordingSource, self).__init__(source.num_ch, source.sps, source.speed)
+
+		self.source = source
+		self.fd = open(filename, 'wb')
+
+	def read(self, out):
+		if not self.source.read(out):
+			return False
+
+		out.T.astype('<u2').tofile(self.fd)
+		return True
+
+	def close(self):
+		self.source.close()
+		self.fd.close()
+
+
+def openSource(inputs=1, replayfile=None, synthetic=False, speed=1., devpath=None):
+	"""Returns a sample-source for 'inputs' channels:
+	A ReplaySource if 'replayfile' is given, a SyntheticSource if 'synthetic' == True,
+	or a list of DeviceSources, one for every 8 inputs (i.e. one per card), otherwise.
+	'speed' sets the play-back speed of the Replay- or Synthetic source
+	'devpath' is the format of the device-file names (see DeviceSource)
+	"""
+	if replayfile:
+		return ReplaySource(replayfile, inputs, speed=speed)
+	if synthetic:
+		return SyntheticSource(inputs, speed=speed)
+
+	sources = []
+	for card in range((max(1, inputs) + 7) // 8):
+		sources.append(DeviceSource(min(inputs - (card * 8), 8), card, devpath))
+
+	return sources
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+
+###
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Defines the trigger-logic used by the DASReader (see dasreader.py).
+# The TriggerState class is a per-channel state-machine, evaluated on whole arrays of pseudo-magnitudes at once:
+#	ARMED		-> TRIGGERED	when the channel's magnitude rises above the 'on' threshold.
+#					The duration is calculated from the magnitude, and the channel is reported as 'fired'
+#	TRIGGERED	-> HOLDOFF	when the calculated duration has passed
+#	HOLDOFF		-> ARMED	when the channel's magnitude has fallen below the 'off' threshold
+# so a channel cannot re-trigger while its quake is being played, nor until its signal has calmed down again.
+# The Coincidence class combines the channels' triggers into events: an event is only declared when
+# at least 'k' of 'n' configured channels have fired within a time-window, and is reported once, with
+# the mean magnitude of all contributing channels.
+# The NoiseFloor class tracks each channel's background-noise level, for adaptive per-channel trigger-levels.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+
+import os
+import numpy
+
+# trigger-states
+ARMED = 0
+TRIGGERED = 1
+HOLDOFF = 2
+
+
+def magDuration(mag):
+	"""Returns the duration (in seconds) of a quake of the given magnitude(s)
+	"""
+	return 10**((mag + 1.05) / 2.22)
+
+
+class TriggerState(object):
+	"""The trigger-states of a number of channels
+	"""
+	def __init__(self, num_ch):
+		"""Instantiate a TriggerState for 'num_ch' channels. All channels start ARMED
+		"""
+		self.num_ch = num_ch
+
+		# the state of each channel
+		self.state = numpy.zeros(shape=(num_ch,), dtype='int')
+		# the time at which each TRIGGERED channel's duration ends
+		self.end = numpy.zeros(shape=(num_ch,), dtype='float')
+
+	def update(self, mag, now, on, off):
+		"""Update the channels' states with a new array of magnitudes 'mag', calculated at time 'now'.
+		'on' and 'off' are the trigger-threshold and the re-arm threshold, either as scalars or as per-channel arrays.
+		Returns a tuple of two arrays; the numbers of the channels that fired, and their durations
+		"""
+		# TRIGGERED channels whose duration has passed go into HOLDOFF
+		self.state[(self.state == TRIGGERED) & (now >= self.end)] = HOLDOFF
+
+		# HOLDOFF channels whose magnitude has fallen below the 'off' threshold are re-armed
+		self.state[(self.state == HOLDOFF) & (mag < off)] = ARMED
+
+		# ARMED channels whose magnitude exceeds the 'on' threshold fire
+		fired = ((self.state == ARMED) & (mag > on)).nonzero()[0]
+		duration = magDuration(mag[fired])
+
+		self.state[fired] = TRIGGERED
+		self.end[fired] = now + duration
+
+		return (fired, duration)
+
+	def isArmed(self):
+		"""Returns 'True' if all channels are ARMED
+		"""
+		return not self.state.any()
+
+	def reset(self):
+		"""Re-arm all channels
+		"""
+		self.state.fill(ARMED)
+
+
+class Coincidence(object):
+	"""A k-of-n coincidence-trigger over a set of channels:
+	Declares one event when at least 'k' of the configured channels have fired within 'window' seconds.
+	No further events are declared until the event's duration has passed, and all configured channels are re-armed.
+	"""
+	def __init__(self, num_ch, k=2, channels=None, window=1.):
+		"""Instantiate a Coincidence-trigger for 'k' out of the given 'channels' (a list of channel-numbers),
+		or out of all 'num_ch' channels if 'channels' is not given.
+		'window' is the time (in seconds) within which the channels must have fired
+		"""
+		self.mask = numpy.zeros(shape=(num_ch,), dtype='bool')
+		if channels == None:
+			self.mask[:] = True
+		else:
+			bad = [ch for ch in channels if (ch < 0) or (ch >= num_ch)]
+			if len(bad):
+				raise ValueError("Coincidence channels must be >= 0 and < the number of channels (%d): %s" % (num_ch, str(bad)))
+			self.mask[channels] = True
+
+		if (k < 1) or (k > self.mask.sum()):
+			raise ValueError("Coincidence count must be >= 1 and <= the number of channels (%d)" % self.mask.sum())
+
+		self.k = k
+		self.window = window
+
+		# the time at which, and the magnitude with which, each channel last fired
+		self.fired_at = numpy.zeros(shape=(num_ch,), dtype='float')
+		self.fired_at.fill(-numpy.inf)
+		self.fired_mag = numpy.zeros(shape=(num_ch,), dtype='float')
+
+		# the time at which the current event's duration ends (if an event is active)
+		self.active = False
+		self.end = 0.
+
+	def update(self, fired, mag, now, state):
+		"""Update the coincidence-trigger with the channels that 'fired' at time 'now' (see TriggerState.update()),
+		the current magnitudes 'mag' and the channels' trigger-states 'state' (TriggerState.state)
+		Returns a tuple (channels, magnitudes, aggregate-magnitude, duration) if an event is declared, 'None' otherwise.
+		"""
+		self.fired_at[fired] = now
+		self.fired_mag[fired] = mag[fired]
+
+		if self.active:
+			if (now < self.end) or (state[self.mask] != ARMED).any():
+				return None
+			self.active = False
+
+		recent = (self.mask & ((now - self.fired_at) <= self.window)).nonzero()[0]
+		if len(recent) < self.k:
+			return None
+
+		# an event is declared. its magnitude is the mean of the contributing channels' magnitudes
+		mags = self.fired_mag[recent]
+		agg = mags.mean()
+		duration = magDuration(agg)
+
+		self.fired_at[recent] = -numpy.inf
+		self.active = True
+		self.end = now + duration
+
+		return (recent, mags, agg, duration)
+
+
+class NoiseFloor(object):
+	"""A per-channel estimate of the background-noise level of the pseudo-magnitudes,
+	from which per-channel trigger-levels are derived (k x noise, but never below a fixed floor).
+	The estimate is a streaming median: on each update, a channel's estimate is multiplied or divided by (1 + rate),
+	depending on whether its magnitude is above or below the estimate. This converges on the median of recent magnitudes,
+	follows slow changes in the ambient noise, and costs the same for every update.
+	"""
+	def __init__(self, noise, k=3., rate=0.002, floor=0.01):
+		"""Instantiate a NoiseFloor that keeps its estimate in the array 'noise' (one value per channel, updated in place).
+		Channels with an estimate of 0 take their first magnitude as estimate.
+		'k' is the trigger-level as a multiple of the noise-level
+		'rate' is the fractional step by which the estimate moves per update
+		'floor' is the minimum trigger-level
+		"""
+		self.noise = noise
+		self.k = k
+		self.rate = rate
+		self.floor = floor
+
+	def update(self, mag, mask=None):
+		"""Update the estimate with a new array of magnitudes 'mag', for the channels selected by the boolean array 'mask'
+		(all channels if not given)
+		"""
+		if mask is None:
+			mask = numpy.ones(shape=self.noise.shape, dtype='bool')
+
+		new = mask & (self.noise <= 0)
+		self.noise[new] = mag[new]
+
+		up = mask & (mag > self.noise)
+		down = mask & (mag < self.noise)
+		self.noise[up] *= (1. + self.rate)
+		self.noise[down] /= (1. + self.rate)
+
+	def level(self):
+		"""Returns an array of the channels' trigger-levels
+		"""
+		return numpy.maximum(self.noise * self.k, self.floor)
+
+	def load(self, filename):
+		"""Load the estimate from the file 'filename' (as written by save())
+		Returns 'False' if the file does not exist, or does not contain an estimate for each channel.
+		"""
+		if not os.path.exists(filename):
+			return False
+
+		fd = open(filename, 'r')
+		try:
+			noise = [float(line) for line in fd if len(line.strip())]
+		finally:
+			fd.close()
+
+		if len(noise) != len(self.noise):
+			return False
+
+		self.noise[:] = noise
+		return True
+
+	def save(self, filename):
+		"""Save the estimate to the file 'filename', one value per line.
+		The file is replaced atomically, so it is never left half-written.
+		"""
+		tmpname = filename + ".tmp"
+		fd = open(tmpname, 'w')
+		try:
+			for n in self.noise:
+				fd.write("%.6f\n" % n)
+		finally:
+			fd.close()
+
+		os.rename(tmpname, filename)
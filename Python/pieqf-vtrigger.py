@@ -24,7 +24,7 @@
 
 import os, sys, time, stat, signal
 
-import dasreader
+import dasreader, dassource
 
 from optparse import OptionParser
 	
@@ -59,8 +59,40 @@ if __name__ == '__main__':
 					help="set size of sample block [default = %d]" % default_blksize)
 	op.add_option("-t", "--threshold", action='store', type='float', dest='thresh', metavar='MAG',
 					help="set trigger threshold magnitude [default = %.1f]" % default_thresh)
+	op.add_option("-T", "--off-threshold", action='store', type='float', dest='off', metavar='MAG',
+					help="set the threshold magnitude below which a triggered channel is re-armed [default = 0.8 x threshold]")
 	op.add_option("-u", "--utc", action='store_true', dest='utctime',
 					help="log trigger events in UTC [default = local time]")
+	op.add_option("-R", "--replay", action='store', type='string', dest='replay', metavar='FILE',
+					help="read samples from sample-file FILE instead of the DAS08-inputs")
+	op.add_option("-Y", "--synth", action='store_true', dest='synth',
+					help="read synthetic samples (noise and quake-like bursts) instead of the DAS08-inputs")
+	op.add_option("-S", "--speed", action='store', type='float', dest='speed', metavar='X',
+					help="replay or synthesize samples at X times real-time (0 = as fast as possible) [default = 1]")
+	op.add_option("-K", "--coincidence", action='store', type='int', dest='coinc', metavar='K',
+					help="only trigger when at least K inputs cross the threshold within the coincidence-window")
+	op.add_option("-w", "--window", action='store', type='float', dest='window', metavar='SEC',
+					help="set the coincidence-window [default = %default s]")
+	op.add_option("--coinc-channels", action='store', type='string', dest='coinc_chans', metavar='LIST',
+					help="comma-separated list of the inputs taking part in the coincidence [default = all]")
+	op.add_option("-a", "--adaptive", action='store', type='float', dest='adaptive', metavar='K',
+					help="adapt each input's threshold to K times its background-noise level (never below 0.01)")
+	op.add_option("--noise-file", action='store', type='string', dest='noise_file', metavar='FILE',
+					help="load and save the background-noise estimate from/to FILE")
+	op.add_option("--highpass", action='store', type='float', dest='highpass', metavar='HZ',
+					help="high-pass filter the samples at HZ before calculating the magnitudes")
+	op.add_option("--lowpass", action='store', type='float', dest='lowpass', metavar='HZ',
+					help="low-pass filter the samples at HZ before calculating the magnitudes")
+	op.add_option("--notch", action='store', type='float', dest='notch', metavar='HZ',
+					help="notch-filter the samples at HZ (e.g. mains-hum) before calculating the magnitudes")
+	op.add_option("--spectral", action='store', type='int', dest='spectral', metavar='N',
+					help="calculate spectral features every N read-cycles, and log the dominant frequency of triggers")
+	op.add_option("--capture", action='store', type='string', dest='capture', metavar='DIR',
+					help="write the samples around each trigger to a capture-file in DIR")
+	op.add_option("--pre", action='store', type='float', dest='pre', metavar='SEC',
+					help="capture SEC seconds before each trigger [default = %default]")
+	op.add_option("--post", action='store', type='float', dest='post', metavar='SEC',
+					help="capture SEC seconds after each trigger [default = %default]")
 		
 	# Set defaults
 	op.set_defaults(logfile=default_logfile)
@@ -70,15 +102,41 @@ if __name__ == '__main__':
 	op.set_defaults(blocksize=default_blksize)
 	op.set_defaults(thresh=default_thresh)
 	op.set_defaults(utctime=False)
+	op.set_defaults(synth=False)
+	op.set_defaults(speed=1.)
+	op.set_defaults(window=1.)
+	op.set_defaults(pre=5.)
+	op.set_defaults(post=10.)
 	
 	# Parse command-line options
 	(opts, args) = op.parse_args()
 	
 	# Instantiate DASReader with given (or default) parameters
-	dr = dasreader.DASReader(opts.channels, opts.bufsize, opts.blocksize)
+	source = dassource.openSource(opts.channels, opts.replay, opts.synth, opts.speed)
+	dr = dasreader.DASReader(opts.channels, opts.bufsize, opts.blocksize, source)
 	
 	# Set trigger-threshold
-	dr.setThreshold(opts.thresh)
+	dr.setThreshold(opts.thresh, opts.off)
+
+	# Enable coincidence-triggering
+	if opts.coinc:
+		chans = None
+		if opts.coinc_chans:
+			chans = [int(c) for c in opts.coinc_chans.split(',')]
+		dr.setCoincidence(opts.coinc, chans, opts.window)
+	
+	# Enable adaptive thresholds
+	if opts.adaptive:
+		dr.setAdaptive(opts.adaptive, filename=opts.noise_file)
+	
+	# Filter the samples
+	dr.setFilter(opts.highpass, opts.lowpass, opts.notch)
+	
+	# Calculate spectral features
+	dr.setSpectral(opts.spectral)
+	
+	# Capture the samples around triggers
+	dr.setCapture(opts.capture, opts.pre, opts.post)
 	
 	# Create an/or open logfile
 	if opts.logfile == '-':
@@ -123,19 +181,23 @@ if __name__ == '__main__':
 	signal.signal(signal.SIGQUIT, stophandler)
 	
 	# Function to write triggered events to the logfile
-	def printEvent(ch, mag, duration):
+	def printEvent(ch, mag, duration, chans, features=None):
 		out = ("%s: Triggered " % progname)
 		if opts.utctime:
 			out += "at %s" % time.strftime("%b %d %Y - %H:%M:%S UTC", time.gmtime())
 		else:
 			out += "at %s" % time.strftime("%b %d %Y - %H:%M:%S %Z", time.localtime())
 		out += (" -> Channel %d, M%4.1f, D%7.1f s" % (ch, mag, duration))
+		if len(chans) > 1:
+			out += (" (coincidence of channels %s)" % ",".join([str(c) for c in chans]))
+		if features:
+			out += (", F%5.1f Hz" % features['freq'][list(chans).index(ch)])
 		logfd.write(out + '\n')
 		
 	# Define a trigger-handler function.
 	# writes events to logfile and to the FIFO/outfile
-	def trig_func(ch, mag, duration):
-		printEvent(ch, mag, duration)
+	def trig_func(ch, mag, duration, info):
+		printEvent(ch, mag, duration, info['chans'], info.get('features'))
 		try:
 			outfd.write("C%1dM%03dD%08d\n" % (ch, mag * 10, duration * 1000))
 		except IOError, e:
@@ -14,7 +14,7 @@
 #
 #	Stock, V2_Lab Rotterdam, June 2008
 ###
-import qdmparser, stprunner, dasreader
+import qdmparser, stprunner, dasreader, dassource
 
 import sys, os, signal, threading
 
@@ -51,6 +51,40 @@ if __name__ == '__main__':
 					help="set size of sample block [default = 10]")
 	op.add_option("-t", "--threshold", action='store', type='float', dest='thresh', metavar='MAG',
 					help="set trigger threshold magnitude [default = 0.1]")
+	op.add_option("-T", "--off-threshold", action='store', type='float', dest='off', metavar='MAG',
+					help="set the threshold magnitude below which a triggered channel is re-armed [default = 0.8 x threshold]")
+	op.add_option("-p", "--process", action='store', type='int', dest='cpu', metavar='CPU',
+					help="run the DASReader in a separate process, pinned to CPU (-1 = not pinned)")
+	op.add_option("-R", "--replay", action='store', type='string', dest='replay', metavar='FILE',
+					help="read samples from sample-file FILE instead of the DAS08-inputs")
+	op.add_option("-Y", "--synth", action='store_true', dest='synth',
+					help="read synthetic samples (noise and quake-like bursts) instead of the DAS08-inputs")
+	op.add_option("-S", "--speed", action='store', type='float', dest='speed', metavar='X',
+					help="replay or synthesize samples at X times real-time (0 = as fast as possible) [default = 1]")
+	op.add_option("-K", "--coincidence", action='store', type='int', dest='coinc', metavar='K',
+					help="only trigger when at least K inputs cross the threshold within the coincidence-window")
+	op.add_option("-w", "--window", action='store', type='float', dest='window', metavar='SEC',
+					help="set the coincidence-window [default = %default s]")
+	op.add_option("--coinc-channels", action='store', type='string', dest='coinc_chans', metavar='LIST',
+					help="comma-separated list of the inputs taking part in the coincidence [default = all]")
+	op.add_option("-a", "--adaptive", action='store', type='float', dest='adaptive', metavar='K',
+					help="adapt each input's threshold to K times its background-noise level (never below 0.01)")
+	op.add_option("--noise-file", action='store', type='string', dest='noise_file', metavar='FILE',
+					help="load and save the background-noise estimate from/to FILE [default = %default]")
+	op.add_option("--highpass", action='store', type='float', dest='highpass', metavar='HZ',
+					help="high-pass filter the samples at HZ before calculating the magnitudes")
+	op.add_option("--lowpass", action='store', type='float', dest='lowpass', metavar='HZ',
+					help="low-pass filter the samples at HZ before calculating the magnitudes")
+	op.add_option("--notch", action='store', type='float', dest='notch', metavar='HZ',
+					help="notch-filter the samples at HZ (e.g. mains-hum) before calculating the magnitudes")
+	op.add_option("--spectral", action='store', type='int', dest='spectral', metavar='N',
+					help="calculate spectral features every N read-cycles, and log the dominant frequency of triggers")
+	op.add_option("--capture", action='store', type='string', dest='capture', metavar='DIR',
+					help="write the samples around each trigger to a capture-file in DIR")
+	op.add_option("--pre", action='store', type='float', dest='pre', metavar='SEC',
+					help="capture SEC seconds before each trigger [default = %default]")
+	op.add_option("--post", action='store', type='float', dest='post', metavar='SEC',
+					help="capture SEC seconds after each trigger [default = %default]")
 	
 	# Set default values	
 	op.set_defaults(num_sta=3)
@@ -64,6 +98,12 @@ if __name__ == '__main__':
 	op.set_defaults(bufsize=15)
 	op.set_defaults(blocksize=10)
 	op.set_defaults(thresh=0.1)
+	op.set_defaults(synth=False)
+	op.set_defaults(speed=1.)
+	op.set_defaults(window=1.)
+	op.set_defaults(pre=5.)
+	op.set_defaults(post=10.)
+	op.set_defaults(noise_file='/var/lib/pieqf.noise')
 	
 	# Parse command-line options
 	(opts, args) = op.parse_args()
@@ -79,7 +119,15 @@ if __name__ == '__main__':
 	else:
 		sr = stprunner.StpRunner(qdmparser=qp, outputdir=opts.outputdir, logfile=opts.logfile, errfile=opts.logfile)
 	
-	dr = dasreader.DASReader(opts.num_ch, opts.bufsize, opts.blocksize)
+	source = dassource.openSource(opts.num_ch, opts.replay, opts.synth, opts.speed)
+	
+	if opts.cpu == None:
+		dr = dasreader.DASReader(opts.num_ch, opts.bufsize, opts.blocksize, source)
+	elif opts.cpu < 0:
+		# run the DASReader in its own process, so it doesn't share the GIL with the other threads
+		dr = dasreader.DASProcess(opts.num_ch, opts.bufsize, opts.blocksize, source)
+	else:
+		dr = dasreader.DASProcess(opts.num_ch, opts.bufsize, opts.blocksize, source, opts.cpu)
 	
 	# share the log-file-object and err-file-object that the StpRunner created and opened with the DASReader
 	dr.logfd = sr.logfd
@@ -118,7 +166,27 @@ if __name__ == '__main__':
 	sr.setRetainPeriod(opts.keepper)
 	
 	# set trigger-threshold
-	dr.setThreshold(opts.thresh)
+	dr.setThreshold(opts.thresh, opts.off)
+
+	# enable coincidence-triggering
+	if opts.coinc:
+		chans = None
+		if opts.coinc_chans:
+			chans = [int(c) for c in opts.coinc_chans.split(',')]
+		dr.setCoincidence(opts.coinc, chans, opts.window)
+	
+	# enable adaptive thresholds
+	if opts.adaptive:
+		dr.setAdaptive(opts.adaptive, filename=opts.noise_file)
+	
+	# filter the samples
+	dr.setFilter(opts.highpass, opts.lowpass, opts.notch)
+	
+	# calculate spectral features
+	dr.setSpectral(opts.spectral)
+	
+	# capture the samples around triggers
+	dr.setCapture(opts.capture, opts.pre, opts.post)
 		
 	###
 	# Signal-Handler functions
@@ -142,10 +210,16 @@ if __name__ == '__main__':
 	# Trigger-Handler function
 	###
 	
-	def trig_func(ch, mag, dur):
+	def trig_func(ch, mag, dur, info):
 		event = qp.getEvent(mag)
 		ev_str = sr._eventStr(event)
-		dr.logMessage("! Triggered: Channel %d, Event %s, dur %.3f s" % (ch, ev_str, dur))
+		if len(info['chans']) > 1:
+			msg = "! Triggered: Channels %s, Event %s, dur %.3f s" % (",".join([str(c) for c in info['chans']]), ev_str, dur)
+		else:
+			msg = "! Triggered: Channel %d, Event %s, dur %.3f s" % (ch, ev_str, dur)
+		if 'features' in info:
+			msg += ", dominant freq. %.1f Hz" % info['features']['freq'][info['chans'].index(ch)]
+		dr.logMessage(msg)
 		
 	# Register handler for trigger
 	dr.setTrigFunc(trig_func)
@@ -163,7 +237,7 @@ if __name__ == '__main__':
 	sr.start()
 	
 	###
-	# start DASReader in its own thread
+	# start DASReader in its own thread (or process)
 	###
 	
 	dr.start()
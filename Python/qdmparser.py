@@ -5,6 +5,7 @@
 # 
 # Defines classes for parsing a QDM 'merged XML catalog' of earthquakes,
 # and for 'triggering' a callback function for each new event appearing in this catalog.
+# Subscribers (see QDMParser.subscribe()) are told about the events added to, and removed from, the DB after each parse.
 # The 'backlisting' of events to be ignored in future is also supported, 
 # and the 'blacklist' is saved to disk (as XML)
 #
@@ -12,7 +13,7 @@
 ###
 from __future__ import with_statement
 
-import os, errno, types, time, stat
+import os, sys, errno, types, time, stat
 import threading, signal
 
 import xml.parsers.expat
@@ -63,6 +64,9 @@ class QDMParser(object):
 		self.parsed = threading.Event()
 		self.run = False
 		
+		# the functions to call with the changes of the DB after each parse
+		self.subscribers = []
+		
 		self._loadBlackList()
 
 		
@@ -130,6 +134,7 @@ class QDMParser(object):
 	def parse(self):
 		"""Parse the XML catalog-file
 		updates the databse (a dict of recent events, indexed by (magnitude * 10))
+		Then calls the subscribers with the events that were added (or changed) and removed, if there were any
 		"""
 		self.xp = xml.parsers.expat.ParserCreate()
 		
@@ -141,10 +146,24 @@ class QDMParser(object):
 			f = open(self.inputfile)
 			
 			with self.parser_lock:
+				old = {}
+				for ev in self.db.values():
+					old[ev['id']] = ev
+				
 				self.db = {}
 				self.xp.ParseFile(f)
+				events = self.db.values()
 			
 			self.parsed.set()
+			
+			added = []
+			for ev in events:
+				if old.pop(ev['id'], None) != ev:
+					added.append(ev)
+			
+			removed = old.values()
+			if len(added) or len(removed):
+				self._publish(added, removed)
 		
 		except xml.parsers.expat.ExpatError:
 			eno = self.xp.ErrorCode
@@ -227,6 +246,29 @@ class QDMParser(object):
 			
 			self.event = None
 		
+	def subscribe(self, func):
+		"""Have the function 'func' called after each parse that changes the DB, with two lists of events (dicts);
+		the events that were added to the DB (or that have changed), and the events that were removed from it.
+		The function is called in the thread that runs parse()
+		"""
+		if func not in self.subscribers:
+			self.subscribers.append(func)
+	
+	def unsubscribe(self, func):
+		"""Stop calling the function 'func' after each parse
+		"""
+		if func in self.subscribers:
+			self.subscribers.remove(func)
+	
+	def _publish(self, added, removed):
+		"""Call the subscribers with the changes of the DB
+		"""
+		for func in self.subscribers[:]:
+			try:
+				func(added, removed)
+			except Exception, e:
+				sys.stderr.write("Error in QDMParser subscriber %s: %s\n" % (str(func), str(e)))
+	
 	def wait(self, timeout=None):
 		"""Waits for the end of the next parser-run
 		If 'timeout' == None, it waits indefinately.
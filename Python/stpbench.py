@@ -0,0 +1,542 @@
+#!/usr/bin/python
+### _*_ coding: utf-8 _*_
+#
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# A throughput-benchmark for the StpRunner. It runs a complete StpRunner (with its QDMParser, GarbageCollector and
+# StpWrappers) against stand-in datacenters; either the stand-in 'stp' program (see stpmock.py) or, with the
+# '--native' option, stand-in STP servers (see stpclient.py), which a NativeRunner's StpWrappers connect to directly
+# with an StpClient. The StpClient does not speak the datacenters' STP protocol; it is not for production use. Synthetic events are added to a QDM catalog-file
+# at a given rate, and the time from each event's appearance in the catalog to the "Downloaded ..." message of
+# its StpWrapper is measured.
+# Reports the number of events downloaded per hour, the event-to-download times (median, 99th percentile & max)
+# and the CPU-time used by the StpRunner (and by its 'stp' processes), and the disk-space taken by the seismograms.
+# With more events than the QDMParser keeps, older events are superseded by newer ones; their cancellations are reported.
+# With the '--closest' option, it benchmarks the selection of the stations closest to an event instead; the grid-indexed
+# great-circle search of the StationCatalog against the former planar distance over all available stations.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+from __future__ import with_statement
+
+import qdmparser, stprunner, stpclient, stpmock
+
+import os, sys, time, re, shutil, tempfile, threading, random, socket
+import numpy
+
+
+class BenchLog(object):
+	"""A log-file-object for the StpRunner, which notes the time of each "Downloaded ..." message
+	"""
+	pattern = re.compile(r"^(STP\[\d+\]): Downloaded \d+ seismograms for event (\w+):(\S+) ")
+	
+	def __init__(self, logfd=None):
+		"""'logfd' is an (optional) file-object to pass the messages on to
+		"""
+		self.logfd = logfd
+		self.name = "<benchmark>"
+		self.lock = threading.Lock()
+		self.downloaded = {}
+	
+	def write(self, msg):
+		m = self.pattern.match(msg)
+		if m != None:
+			with self.lock:
+				if m.group(3) not in self.downloaded:
+					self.downloaded[m.group(3)] = time.time()
+		
+		if self.logfd != None:
+			self.logfd.write(msg)
+	
+	def flush(self):
+		if self.logfd != None:
+			self.logfd.flush()
+
+
+class NativeWrapper(stprunner.StpWrapper):
+	"""An StpWrapper that connects to stand-in STP servers directly, with an StpClient, rather than through
+	the 'stp' program. For testing only; see stpclient.py
+	"""
+	def __init__(self, name, qdm_parser=None, stations=None, defaults=None, outputdir=None, pool=None, driver=None, avails=None, planner=None, retries=None, servers=None):
+		"""Instantiate a NativeWrapper (see StpWrapper.__init__())
+		'servers' is a dict of stand-in STP server addresses ((host, port) tuples) per STP server group (see stprunner.netgroup).
+			The server groups that are not in it are accessed through the 'stp' program, as usual.
+		"""
+		if servers == None:
+			servers = {}
+		self.servers = servers
+		stprunner.StpWrapper.__init__(self, name, qdm_parser, stations, defaults, outputdir, pool, driver, avails, planner, retries)
+	
+	def _checkExec(self):
+		"""The 'stp' program is only needed for the server groups that are not accessed natively
+		"""
+		native = [group for group in stprunner.netgroup.values() if group in self.servers]
+		if len(native) < len(stprunner.netgroup):
+			stprunner.StpWrapper._checkExec(self)
+	
+	def _openSession(self, net):
+		"""Returns an StpRequest that completes with a new StpClient connected to the stand-in STP server of the given
+		network's server group. If this NativeWrapper has an StpDriver, the (blocking) connect is done in a new thread,
+		so it does not hold up the driver's other sessions
+		"""
+		group = stprunner.netgroup[net]
+		if group not in self.servers:
+			return stprunner.StpWrapper._openSession(self, net)
+		
+		(host, port) = self.servers[group]
+		req = stprunner.StpRequest()
+		
+		def connect():
+			try:
+				client = stpclient.StpClient(host, port, self.outputdir)
+			except socket.error, e:
+				req.finish(error=stprunner.StpError(12, "Failed to connect to STP server %s:%d: %s" % (host, port, str(e))))
+			else:
+				req.finish(client)
+		
+		if self.driver == None:
+			connect()
+			return req
+		
+		thread = threading.Thread(None, connect, "%sconnect" % self.name)
+		thread.setDaemon(True)
+		thread.start()
+		return req
+	
+	def _helper(self, n, outputdir=None):
+		"""Returns a new NativeWrapper, sharing this NativeWrapper's settings and servers (see StpWrapper._helper())
+		"""
+		if outputdir == None:
+			helper = NativeWrapper("%s/%d" % (self.name, n), self.qp, self.stations, None, self.outputdir, self.pool, self.driver,
+					self.avails, self.planner, servers=self.servers)
+		else:
+			helper = NativeWrapper("%s/%d" % (self.name, n), self.qp, self.stations, None, outputdir, None, self.driver,
+					self.avails, self.planner, servers=self.servers)
+		helper.verbose = self.verbose
+		helper.logfd = self.logfd
+		helper.errfd = self.errfd
+		helper.run = self.run
+		helper.processing = self.processing
+		
+		return helper
+
+
+class NativeRunner(stprunner.StpRunner):
+	"""An StpRunner whose StpWrappers are NativeWrappers (see setServer())
+	"""
+	def __init__(self, *args, **kwargs):
+		# the addresses of the stand-in STP servers to connect to natively
+		self.servers = {}
+		stprunner.StpRunner.__init__(self, *args, **kwargs)
+	
+	def setServer(self, group, host=None, port=9999):
+		"""Have future StpWrappers connect to the STP server group 'group' (one of the names in stprunner.netgroup)
+		directly at 'host':'port', with a native StpClient, rather than through the 'stp' program.
+		If 'host' is 'None', the 'stp' program is used for this server group again
+		"""
+		if group not in stprunner.netgroup.values():
+			raise ValueError("Unrecognized STP server group: '%s'" % str(group))
+		
+		if host != None:
+			self.servers[group] = (host, int(port))
+		elif group in self.servers:
+			del self.servers[group]
+	
+	def _newWrapper(self, name):
+		return NativeWrapper(name, self.qp, self.stations, self.defaults, pool=self.pool, driver=self.driver,
+				avails=self.avails, planner=self.planner, retries=self.retries, servers=self.servers)
+
+
+class StpBench(object):
+	"""Runs an StpRunner against stand-in datacenters, feeding it synthetic events
+	"""
+	# the number of distinct magnitudes the QDMParser keeps an event of (it keeps one event per 0.1 magnitude)
+	magnitudes = 90
+	
+	def __init__(self, workdir, native=False, multiplex=False, verbose=False, parallel=None, trim=False, **kwargs):
+		"""Instantiate an StpBench working in 'workdir' (which is emptied first).
+		If 'native' == True, the StpRunner connects to stand-in STP servers. Otherwise it runs the stand-in 'stp' program.
+		If 'multiplex' == True, the StpRunner runs all StpWrappers from one thread (see StpDriver).
+		If 'verbose' == True, the StpRunner's messages are printed.
+		'parallel' is the max number of sessions per datacenter each event's seismograms are downloaded over (see StpRunner.setParallel())
+		If 'trim' == True, only the part of each seismogram that is played back is downloaded (see StpRunner.setTrim())
+		The other keyword-arguments are passed to the stand-in datacenters (see stpclient.StpCatalog)
+		"""
+		self.workdir = workdir
+		self.native = native
+		self.multiplex = multiplex
+		self.parallel = parallel
+		self.trim = trim
+		self.catalog = kwargs
+		
+		if os.path.isdir(workdir):
+			shutil.rmtree(workdir)
+		
+		self.outputdir = os.path.join(workdir, 'STP')
+		os.makedirs(self.outputdir)
+		self.inputfile = os.path.join(workdir, 'merge.xml')
+		self.blacklistfile = os.path.join(workdir, 'blacklist.xml')
+		
+		# the events added to the catalog, and the time each was added at
+		self.events = []
+		self.added = {}
+		self._writeCatalog()
+		
+		if verbose:
+			self.log = BenchLog(sys.stdout)
+		else:
+			self.log = BenchLog()
+		
+		self.servers = []
+	
+	def _writeCatalog(self):
+		"""(Re-)Write the QDM catalog-file with the events added so far
+		"""
+		tmpfile = "%s.tmp" % self.inputfile
+		f = open(tmpfile, 'w')
+		try:
+			f.write('<?xml version="1.0"?>\n<merge>\n')
+			for ev in self.events:
+				tt = time.localtime(ev['time'])
+				f.write('<event id="%s" network-code="%s">\n' % (ev['id'], ev['net']))
+				for (name, val) in (('year', tt[0]), ('month', tt[1]), ('day', tt[2]), ('hour', tt[3]), ('minute', tt[4]),
+						('second', tt[5]), ('magnitude', ev['mag']), ('latitude', ev['loc'][0]), ('longitude', ev['loc'][1])):
+					f.write('  <param name="%s" value="%s"/>\n' % (name, str(val)))
+				f.write('</event>\n')
+			f.write('</merge>\n')
+		finally:
+			f.close()
+		
+		os.rename(tmpfile, self.inputfile)
+	
+	def addEvents(self, num):
+		"""Add 'num' new events to the catalog, alternating between the networks
+		"""
+		now = time.time()
+		for n in range(num):
+			k = len(self.events)
+			net = ('CI', 'NC')[k % 2]
+			ev = {'id':"%s%06d" % (net.lower(), k), 'net':net, 'time':now - 60, 'loc':(35.9, -120.43),
+					'mag':1. + (k % self.magnitudes) / 10.}
+			self.events.append(ev)
+		
+		self._writeCatalog()
+		for ev in self.events[-num:]:
+			self.added[ev['id']] = time.time()
+	
+	def _startDatacenters(self, runner):
+		"""Start stand-in STP servers, or set up the stand-in 'stp' program
+		"""
+		if self.native:
+			for (net, group) in (('CI', 'scedc'), ('NC', 'ncedc')):
+				srv = stpclient.StpServer(('localhost', 0), net, group, **self.catalog)
+				(host, port) = srv.start()
+				runner.setServer(group, host, port)
+				self.servers.append(srv)
+			return
+		
+		names = {'num_sta':'STATIONS', 'wavesize':'SIZE', 'delay':'DELAY', 'jitter':'JITTER', 'latency':'LATENCY',
+				'rate':'RATE', 'failrate':'FAILRATE', 'nodata':'NODATA'}
+		for (key, val) in self.catalog.items():
+			os.environ["STPMOCK_%s" % names[key]] = str(val)
+		
+		# a wrapper, so stpmock.py runs with this Python interpreter
+		stpexec = os.path.join(self.workdir, 'stp')
+		f = open(stpexec, 'w')
+		try:
+			f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.abspath(stpmock.__file__).replace('.pyc', '.py')))
+		finally:
+			f.close()
+		os.chmod(stpexec, 0755)
+		stprunner.StpWrapper.stpexec = stpexec
+	
+	def _stopDatacenters(self):
+		for srv in self.servers:
+			srv.stop()
+	
+	def run(self, num_events, rate, timeout, num_sta=3, channels='H%'):
+		"""Add 'num_events' events to the catalog, at 'rate' events / min, while the StpRunner downloads their seismograms
+		from 'num_sta' stations, on 'channels'. Waits until all events are downloaded, or for 'timeout' seconds at most.
+		Returns a dict with the results
+		"""
+		qp = qdmparser.QDMParser(self.inputfile, self.blacklistfile)
+		if self.native:
+			runner = NativeRunner(qp, outputdir=self.outputdir, cachedir=os.path.join(self.workdir, 'cache'))
+		else:
+			runner = stprunner.StpRunner(qp, outputdir=self.outputdir, cachedir=os.path.join(self.workdir, 'cache'))
+		runner.logfd = self.log
+		if self.multiplex:
+			runner.setMultiplex(True)
+		if self.parallel != None:
+			runner.setParallel(self.parallel)
+		runner.setTrim(self.trim)
+		
+		self._startDatacenters(runner)
+		
+		totals0 = stprunner.StpWrapper.totals.copy()
+		t0 = time.time()
+		times0 = os.times()
+		runner.start(True, num_sta, channels)
+		
+		# add the events once per second at most; the QDMParser notices changes of the file's mtime (in seconds)
+		interval = max(1., 60. / rate)
+		while (len(self.events) < num_events) or self._waiting():
+			now = time.time()
+			if now - t0 > timeout:
+				break
+			
+			due = min(num_events, int((now - t0) * rate / 60.) + 1)
+			if due > len(self.events):
+				self.addEvents(due - len(self.events))
+				time.sleep(interval)
+			else:
+				time.sleep(0.1)
+		
+		t1 = time.time()
+		runner.stop()
+		times1 = os.times()
+		self._stopDatacenters()
+		
+		res = self._results(t0, t1, times0, times1)
+		for (key, val) in stprunner.StpWrapper.totals.items():
+			res[key] = val - totals0[key]
+		res['cancels'] = runner.cancels.copy()
+		
+		return res
+	
+	def _waiting(self):
+		"""Returns the number of events in the catalog that were not downloaded yet.
+		Events that were superseded by a newer event of the same magnitude are no longer in the catalog
+		"""
+		return len([ev for ev in self.events[-self.magnitudes:] if ev['id'] not in self.log.downloaded])
+	
+	def _results(self, t0, t1, times0, times1):
+		lat = []
+		last = t0
+		for (ev_id, t) in self.log.downloaded.items():
+			if ev_id in self.added:
+				lat.append(t - self.added[ev_id])
+				last = max(last, t)
+		lat.sort()
+		
+		res = {'added':len(self.events), 'downloaded':len(lat), 'elapsed':t1 - t0,
+				'superseded':max(0, len(self.events) - self.magnitudes)}
+		if len(lat):
+			res['events/hour'] = len(lat) * 3600. / max(last - t0, 1e-6)
+			res['p50'] = lat[len(lat) // 2]
+			res['p99'] = lat[min(len(lat) - 1, int(len(lat) * .99))]
+			res['max'] = lat[-1]
+		
+		res['cpu'] = (times1[0] - times0[0]) + (times1[1] - times0[1])
+		res['cpu_children'] = (times1[2] - times0[2]) + (times1[3] - times0[3])
+		if self.native:
+			res['sessions'] = sum([srv.stats()['connections'] for srv in self.servers])
+			res['failures'] = sum([srv.stats()['failures'] for srv in self.servers])
+			res['bytes'] = stpclient.StpClient.totals['data_bytes']
+		
+		res['disk'] = 0
+		for (path, dirs, files) in os.walk(self.outputdir):
+			for name in files:
+				res['disk'] += os.path.getsize(os.path.join(path, name))
+		
+		return res
+
+
+def closestPlanar(stations, avail, loc, num):
+	"""The former StpWrapper._closest(); the planar distance (in degrees) from 'loc' to all 'avail'able stations, sorted.
+	'stations' is a dict of (latitude, longitude) pairs, indexed by station-code
+	"""
+	locs = {}
+	for sta in avail:
+		locs[sta] = stations[sta]
+	
+	positions = numpy.array(locs.values())
+	codes = numpy.array(locs.keys())
+	distances = stprunner.veclen(positions - numpy.array(loc), axis=1)
+	idxes = distances.argsort()
+	return codes.take(idxes)[:num].tolist()
+
+def benchClosest(num_sta, num_events, num=3, num_locs=None, seed=0):
+	"""Select the 'num' stations closest to each of 'num_events' events, out of 'num_sta' stations spread over California,
+	of which a random half has data for each event. With the former planar selection, with the StationCatalog's
+	grid-index, and with the StationCatalog's memoised results (the events then occur at 'num_locs' distinct locations)
+	Returns a dict with the results
+	"""
+	rnd = random.Random(seed)
+	stations = {}
+	for n in range(num_sta):
+		stations["CI.S%05d" % n] = (rnd.uniform(32.5, 42.), rnd.uniform(-124.3, -114.2))
+	
+	if num_locs == None:
+		num_locs = max(1, num_events // 10)
+	
+	# a few sets of available stations, as for a few different channel-filters
+	codes = sorted(stations.keys())
+	avails = [set(rnd.sample(codes, num_sta // 2)) for n in range(4)]
+	locs = [(rnd.uniform(34., 38.), rnd.uniform(-122., -117.)) for n in range(num_locs)]
+	events = []
+	for n in range(num_events):
+		f = rnd.randrange(len(avails))
+		events.append((locs[rnd.randrange(num_locs)], avails[f], f))
+	
+	catalog = stprunner.StationCatalog()
+	catalog.update('CI', stations, True)
+	
+	res = {'stations':num_sta, 'events':num_events, 'locations':num_locs}
+	
+	t = time.time()
+	planar = [closestPlanar(stations, avail, loc, num) for (loc, avail, f) in events]
+	res['planar'] = time.time() - t
+	
+	t = time.time()
+	indexed = []
+	for (loc, avail, f) in events:
+		catalog.memo = {}
+		indexed.append(catalog.nearest('CI', loc, num, avail, f)[0])
+	res['indexed'] = time.time() - t
+	
+	t = time.time()
+	memoised = [catalog.nearest('CI', loc, num, avail, f)[0] for (loc, avail, f) in events]
+	res['memoised'] = time.time() - t
+	
+	# check the indexed search against the great-circle distances to all available stations
+	errors = 0
+	differ = 0
+	for (n, (loc, avail, f)) in enumerate(events):
+		avail = list(avail)
+		d = stprunner.gcdist(loc, [stations[sta] for sta in avail])
+		exact = [avail[i] for i in d.argsort()[:num]]
+		if (indexed[n] != exact) or (memoised[n] != exact):
+			errors += 1
+		if planar[n] != exact:
+			differ += 1
+	
+	res['errors'] = errors
+	res['differ'] = differ
+	return res
+
+def reportClosest(res):
+	"""Returns the closest-station benchmark-results as a multi-line string
+	"""
+	out = "Closest stations for %d events (at %d locations), out of %d stations\n" % (res['events'], res['locations'], res['stations'])
+	for name in ('planar', 'indexed', 'memoised'):
+		out += "%-9s %8.2f ms total, %7.1f us/event\n" % (name, res[name] * 1000., res[name] * 1e6 / res['events'])
+	out += "Indexed results differing from exhaustive great-circle search: %d\n" % res['errors']
+	out += "Planar results differing from great-circle results: %d\n" % res['differ']
+	
+	return out
+
+def report(res):
+	"""Returns the benchmark-results as a multi-line string
+	"""
+	out = "Events downloaded: %d of %d, in %.1f sec\n" % (res['downloaded'], res['added'], res['elapsed'])
+	if 'events/hour' in res:
+		out += "Throughput: %.0f events/hour\n" % res['events/hour']
+		out += "Event-to-download time: median %.2f sec, p99 %.2f sec, max %.2f sec\n" % (res['p50'], res['p99'], res['max'])
+	out += "CPU-time: %.2f sec (%.1f%%), 'stp' processes: %.2f sec\n" % (res['cpu'], res['cpu'] * 100. / res['elapsed'], res['cpu_children'])
+	if res['downloaded']:
+		out += "Round-trips per event: %.1f, commands per event: %.1f\n" % (res['roundtrips'] / float(res['downloaded']), res['commands'] / float(res['downloaded']))
+	if 'sessions' in res:
+		out += "STP sessions: %d, injected failures: %d, seismogram-data: %.1f MB\n" % (res['sessions'], res['failures'], res['bytes'] / 1048576.)
+	if res['downloaded']:
+		out += "Disk usage: %.1f MB, %.0f kB per event\n" % (res['disk'] / 1048576., res['disk'] / 1024. / res['downloaded'])
+	if res['superseded']:
+		c = res['cancels']
+		out += "Superseded events: %d; cancelled %d queued, %d retrying, %d in process" % (res['superseded'], c['queued'], c['retry'], c['inflight'])
+		if c['inflight']:
+			out += " (mean latency %.2f sec)" % (c['latency'] / c['inflight'])
+		out += ", %.1f MB saved (est.)\n" % (c['est_saved'] / 1048576.)
+	
+	return out
+
+
+if __name__ == '__main__':
+	from optparse import OptionParser
+	
+	op = OptionParser()
+	# Define command-line options
+	op.add_option("-n", "--events", action='store', type='int', dest='events', metavar='N',
+					help="add N events to the catalog [default = 60]")
+	op.add_option("-r", "--rate", action='store', type='float', dest='rate', metavar='R',
+					help="add R events per minute [default = 60]")
+	op.add_option("-t", "--timeout", action='store', type='float', dest='timeout', metavar='T',
+					help="stop after T seconds at most [default = 600]")
+	op.add_option("-k", "--num-sta", action='store', type='int', dest='num_sta', metavar='K',
+					help="download seismograms from the K closest stations [default = 3]")
+	op.add_option("-c", "--channels", action='store', type='string', dest='channels', metavar='CHAN',
+					help="download seismograms on channel(s) CHAN [default = 'H%']")
+	op.add_option("-N", "--native", action='store_true', dest='native',
+					help="connect to stand-in STP servers, rather than running the stand-in 'stp' program")
+	op.add_option("-x", "--multiplex", action='store_true', dest='multiplex',
+					help="run all StpWrappers from one thread")
+	op.add_option("-p", "--parallel", action='store', type='int', dest='parallel', metavar='N',
+					help="download each event's seismograms over at most N sessions per datacenter [default = 3]")
+	op.add_option("-T", "--trim", action='store_true', dest='trim',
+					help="download only the part of each seismogram that is played back")
+	op.add_option("-w", "--workdir", action='store', type='string', dest='workdir', metavar='DIR',
+					help="work in DIR (which is emptied first) [default = a temporary dir]")
+	op.add_option("-v", "--verbose", action='store_true', dest='verbose',
+					help="print the StpRunner's messages")
+	op.add_option("-G", "--closest", action='store', type='int', dest='closest', metavar='N',
+					help="benchmark the selection of the closest stations, out of N stations, for the number of events given by '-n'")
+	# the stand-in datacenters' parameters
+	op.add_option("-s", "--stations", action='store', type='int', dest='num_sta_dc', metavar='N',
+					help="the datacenters have N stations [default = 20]")
+	op.add_option("-z", "--size", action='store', type='int', dest='wavesize', metavar='N',
+					help="the seismograms are N bytes [default = 65536]")
+	op.add_option("-d", "--delay", action='store', type='float', dest='delay', metavar='T',
+					help="wait T seconds before answering each command [default = 0]")
+	op.add_option("-j", "--jitter", action='store', type='float', dest='jitter', metavar='T',
+					help="wait up to T seconds extra (at random) before answering each command [default = 0]")
+	op.add_option("-l", "--latency", action='store', type='float', dest='latency', metavar='T',
+					help="wait T seconds before starting each session [default = 0]")
+	op.add_option("-b", "--bandwidth", action='store', type='int', dest='bandwidth', metavar='N',
+					help="send seismogram-data at N bytes/sec at most [default = unlimited]")
+	op.add_option("-f", "--failrate", action='store', type='float', dest='failrate', metavar='P',
+					help="break off a session with probability P for each command [default = 0]")
+	op.add_option("-e", "--nodata", action='store', type='float', dest='nodata', metavar='P',
+					help="have no data for an event with probability P [default = 0]")
+	
+	# Set default values
+	op.set_defaults(events=60)
+	op.set_defaults(rate=60.)
+	op.set_defaults(timeout=600.)
+	op.set_defaults(num_sta=3)
+	op.set_defaults(channels='H%')
+	op.set_defaults(native=False)
+	op.set_defaults(multiplex=False)
+	op.set_defaults(trim=False)
+	op.set_defaults(verbose=False)
+	op.set_defaults(num_sta_dc=20)
+	op.set_defaults(wavesize=65536)
+	op.set_defaults(delay=0.)
+	op.set_defaults(jitter=0.)
+	op.set_defaults(latency=0.)
+	op.set_defaults(bandwidth=0)
+	op.set_defaults(failrate=0.)
+	op.set_defaults(nodata=0.)
+	
+	# Parse command-line options
+	(opts, args) = op.parse_args()
+	
+	if opts.closest:
+		print reportClosest(benchClosest(opts.closest, opts.events, opts.num_sta))
+		sys.exit(0)
+	
+	if opts.workdir:
+		workdir = opts.workdir
+		cleanup = False
+	else:
+		workdir = tempfile.mkdtemp(prefix='stpbench')
+		cleanup = True
+	
+	bench = StpBench(workdir, opts.native, opts.multiplex, opts.verbose, opts.parallel, opts.trim, num_sta=opts.num_sta_dc, wavesize=opts.wavesize,
+			delay=opts.delay, jitter=opts.jitter, latency=opts.latency, rate=opts.bandwidth, failrate=opts.failrate, nodata=opts.nodata)
+	
+	try:
+		res = bench.run(opts.events, opts.rate, opts.timeout, opts.num_sta, opts.channels.split(','))
+	finally:
+		if cleanup:
+			shutil.rmtree(workdir, True)
+	
+	print report(res)
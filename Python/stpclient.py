@@ -0,0 +1,682 @@
+#!/usr/bin/python
+### _*_ coding: utf-8 _*_
+#
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# A local stand-in STP server, for running and testing the StpRunner without network-access, and an in-process client
+# for it, used by stpbench.py's NativeWrapper (an StpWrapper, see stprunner.py) instead of the 'stp' executable.
+#
+# NOTE: this is a test-only transport. It does NOT speak the STP wire protocol of the SCEDC / NCEDC datacenters, and it
+# cannot connect to them; the 'stp' program is the only way to reach a real datacenter. Only the StpServer below (and
+# stpmock.py) understand the StpClient's framing.
+#
+# The StpClient talks to the StpServer over a TCP socket, in the same line-based dialogue the 'stp' program has with
+# its user: a command per line, answered by lines of text in the format the 'stp' program prints, ending with a
+# 'Done' line. Seismogram-files are sent by the server as 'DATA <event-ID> <filename> <size>' lines (a framing of our
+# own), each followed by <size> bytes of file-data, which the client streams straight into the seismograms dir-structure.
+# The StpClient mimics the parts of a subprocess.Popen object that the StpWrapper uses ('stdin', 'stdout', 'poll()',
+# 'wait()', etc.) so an StpWrapper (or StpDriver) handles it like any 'stp' process, without an extra process,
+# and without the 'STP>' prompts. It also counts the bytes sent and received.
+#
+# The StpServer serves a synthetic catalog (an StpCatalog); events are made up from their IDs, the stations are spread
+# around Parkfield, and the seismograms are blocks of bytes of a given size. The catalog simulates the latencies of a
+# real datacenter (per session, per command and per byte) and injects failures: sessions that break off, and events
+# that have no data (yet). The same catalog & dialogue (StpDialog) back the stand-in 'stp' program (see stpmock.py).
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+from __future__ import with_statement
+
+import os, time, socket, threading, SocketServer, fnmatch, random
+
+# the file-name extensions of the seismogram formats
+extensions = {'SAC':'sac', 'SEED':'seed', 'MSEED':'mseed', 'FLT32':'flt', 'INT32':'int', 'ASCII':'asc',
+				'V0':'v0', 'COSMOS-V0':'v0c', 'V1':'v1', 'COSMOS-V1':'v1c'}
+
+
+class _SocketWriter(object):
+	"""The 'stdin' of an StpClient
+	"""
+	def __init__(self, client):
+		self.client = client
+		self.closed = False
+	
+	def write(self, data):
+		self.client.sock.sendall(data)
+		self.client.sent(len(data))
+	
+	def flush(self):
+		pass
+	
+	def fileno(self):
+		return self.client.sock.fileno()
+	
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			try:
+				self.client.sock.shutdown(socket.SHUT_WR)
+			except socket.error:
+				pass
+
+
+class _SocketReader(object):
+	"""The 'stdout' of an StpClient
+	"""
+	def __init__(self, client):
+		self.client = client
+		self.closed = False
+		self.lines = []
+	
+	def readline(self):
+		"""Returns the next line of text received (including the newline), or an empty string at the end of the connection
+		"""
+		while not len(self.lines):
+			data = self.client._recv()
+			if not len(data):
+				return ""
+			self.lines.extend(self.client.feed(data))
+		
+		return "%s\n" % self.lines.pop(0)
+	
+	def read(self):
+		"""Read until the end of the connection. Returns all lines of text received
+		"""
+		out = ""
+		line = self.readline()
+		while len(line):
+			out += line
+			line = self.readline()
+		
+		return out
+	
+	def fileno(self):
+		return self.client.sock.fileno()
+	
+	def close(self):
+		self.closed = True
+
+
+class StpClient(object):
+	"""A connection to a stand-in StpServer (test-only; see the note at the top of this file)
+	"""
+	# the size of the blocks in which data is received
+	bufsize = 65536
+	
+	# the total number of bytes sent & received, and of seismogram-files & -bytes received, by all StpClients
+	totals = {'bytes_out':0, 'bytes_in':0, 'files':0, 'data_bytes':0}
+	totals_lock = threading.Lock()
+	
+	def __init__(self, host, port, outputdir, timeout=60.):
+		"""Connect to the stand-in STP server at 'host':'port'.
+		Seismogram-files are saved in a subfolder, named after the Event-ID, in 'outputdir'
+		'timeout' is the time (in seconds) to wait for the connection to be established
+		(May raise socket.error)
+		"""
+		self.host = host
+		self.port = port
+		self.outputdir = outputdir
+		
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.settimeout(timeout)
+		self.sock.connect((host, port))
+		self.sock.settimeout(None)
+		
+		# the subprocess.Popen look-alike attributes
+		self.pid = None
+		self.returncode = None
+		self.stdin = _SocketWriter(self)
+		self.stdout = _SocketReader(self)
+		
+		# the last incomplete line received, and the seismogram-file being received with the number of bytes still to come
+		self.buf = ""
+		self.file = None
+		self.remaining = 0
+		
+		# transfer-statistics
+		self.bytes_out = 0
+		self.bytes_in = 0
+		self.files = 0
+		self.data_bytes = 0
+	
+	def __str__(self):
+		return "%s:%d" % (self.host, self.port)
+	
+	def _recv(self):
+		"""Receive a block of data (blocking). Returns an empty string (and closes the connection) at the end of the connection
+		"""
+		if self.returncode != None:
+			return ""
+		
+		try:
+			data = self.sock.recv(self.bufsize)
+		except socket.error:
+			data = ""
+		
+		if not len(data):
+			self.wait()
+		
+		return data
+	
+	def _startFile(self, line):
+		"""Open the seismogram-file announced by a 'DATA' line
+		"""
+		(tag, ev_id, filename, size) = line.split()
+		ev_dir = os.path.join(self.outputdir, os.path.basename(ev_id))
+		if not os.path.isdir(ev_dir):
+			os.makedirs(ev_dir)
+		
+		self.file = open(os.path.join(ev_dir, os.path.basename(filename)), 'wb')
+		self.remaining = int(size)
+		if self.remaining == 0:
+			self._endFile()
+	
+	def _endFile(self):
+		self.file.close()
+		self.file = None
+		self.files += 1
+		with self.totals_lock:
+			self.totals['files'] += 1
+	
+	def feed(self, data):
+		"""Handle a block of received data. Seismogram-data is written to its file.
+		Returns a list of the complete lines of text received (without the newlines)
+		"""
+		self.bytes_in += len(data)
+		with self.totals_lock:
+			self.totals['bytes_in'] += len(data)
+		
+		lines = []
+		while len(data):
+			if self.remaining > 0:
+				chunk = data[:self.remaining]
+				data = data[len(chunk):]
+				self.file.write(chunk)
+				self.remaining -= len(chunk)
+				self.data_bytes += len(chunk)
+				with self.totals_lock:
+					self.totals['data_bytes'] += len(chunk)
+				
+				if self.remaining == 0:
+					self._endFile()
+				continue
+			
+			i = data.find('\n')
+			if i < 0:
+				self.buf += data
+				break
+			
+			line = (self.buf + data[:i]).rstrip('\r')
+			self.buf = ""
+			data = data[i + 1:]
+			
+			if line.startswith('DATA '):
+				self._startFile(line)
+			else:
+				lines.append(line)
+		
+		return lines
+	
+	def sent(self, n):
+		"""Count 'n' bytes sent to the server by other means than 'stdin' (i.e. by an StpDriver)
+		"""
+		self.bytes_out += n
+		with self.totals_lock:
+			self.totals['bytes_out'] += n
+	
+	def poll(self):
+		"""Returns 'None' while connected, or the returncode (0) once the connection has ended
+		"""
+		return self.returncode
+	
+	def wait(self):
+		"""Close the connection, and any seismogram-file being received. Returns the returncode (0)
+		"""
+		if self.returncode == None:
+			self.returncode = 0
+			try:
+				self.sock.close()
+			except socket.error:
+				pass
+			
+			if self.file != None:
+				self.file.close()
+				self.file = None
+			
+			self.stdout.close()
+			self.stdin.closed = True
+		
+		return self.returncode
+	
+	def terminate(self):
+		"""Break the connection. A blocked readline() returns right away
+		"""
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+	
+	def stats(self):
+		"""Returns a dict with the transfer-statistics of this connection
+		"""
+		return {'bytes_out':self.bytes_out, 'bytes_in':self.bytes_in, 'files':self.files, 'data_bytes':self.data_bytes}
+
+
+###
+# Stand-in STP server
+###
+
+class StpCatalog(object):
+	"""The synthetic catalog of one network, served by the StpServer and the 'stpmock.py' stand-in 'stp' program.
+	Also holds the simulated latencies and the failure-injection rates
+	"""
+	# the channels each station has
+	chans = ('HHE', 'HHN', 'HHZ')
+	
+	def __init__(self, net='CI', group='scedc', num_sta=20, wavesize=65536, delay=0., jitter=0., latency=0., rate=0., failrate=0., nodata=0.):
+		"""Instantiate an StpCatalog for the network 'net', in STP server group 'group', with 'num_sta' stations, 3 channels each.
+		'wavesize' is the size (in bytes) of each seismogram.
+		'delay' is the time (in seconds) to wait before answering each command, plus a random extra of up to 'jitter' seconds.
+		'latency' is the time (in seconds) to wait before sending the banner of a new session.
+		'rate' limits the seismogram-data transfer-rate (in bytes / sec). 0 means unlimited.
+		'failrate' is the probability (0 - 1) that a session breaks off while handling a command,
+		and 'nodata' the probability that an 'EVENT' or 'EAVAIL' command returns no data (yet)
+		"""
+		self.net = net
+		self.group = group
+		self.wavesize = wavesize
+		self.delay = delay
+		self.jitter = jitter
+		self.latency = latency
+		self.rate = rate
+		self.failrate = failrate
+		self.nodata = nodata
+		# the length (in seconds) of each station's triggered window; the seismograms sent by 'TRIG'
+		self.duration = 300.
+		self.block = ''.join([chr(i % 256) for i in range(65536)])
+		
+		# the stations, spread around Parkfield
+		rnd = random.Random(net)
+		self.stations = {}
+		for n in range(num_sta):
+			self.stations["%s.S%03d" % (net, n)] = (35.9 + rnd.uniform(-2, 2), -120.43 + rnd.uniform(-2, 2))
+		
+		self.lock = threading.Lock()
+		self.connections = 0
+		self.commands = 0
+		self.failures = 0
+		
+		self.rnd = random.Random()
+	
+	def event(self, ev_id):
+		"""Returns a (made-up) event for the given Event-ID
+		"""
+		rnd = random.Random(ev_id)
+		return {'id':ev_id, 'type':'le', 'time':time.time() - 600, 'loc':(35.9 + rnd.uniform(-1, 1), -120.43 + rnd.uniform(-1, 1)),
+				'depth':rnd.uniform(1, 15), 'mag':rnd.uniform(1, 5), 'magtype':'l', 'qual':1.}
+	
+	def eventLine(self, ev_id):
+		"""Returns the line describing the given event in the output of the 'EVENT' command
+		"""
+		ev = self.event(ev_id)
+		timestring = time.strftime("%Y/%m/%d,%H:%M:%S.000", time.localtime(ev['time']))
+		return "%s %s %s %.4f %.4f %.1f %.1f %s %.1f" % (ev['id'], ev['type'], timestring, ev['loc'][0], ev['loc'][1],
+				ev['depth'], ev['mag'], ev['magtype'], ev['qual'])
+	
+	def channels(self, pattern):
+		"""Returns the channels matching the given channel-code (with the '%' or '_' wildcards)
+		"""
+		pattern = pattern.replace('%', '*').replace('_', '?')
+		return [chan for chan in self.chans if fnmatch.fnmatchcase(chan, pattern)]
+	
+	def chance(self, p):
+		"""Returns 'True' with probability 'p'
+		"""
+		with self.lock:
+			return (p > 0) and (self.rnd.random() < p)
+	
+	def wait(self):
+		"""Wait before answering a command (see 'delay' and 'jitter')
+		"""
+		t = self.delay
+		if self.jitter > 0:
+			with self.lock:
+				t += self.rnd.uniform(0, self.jitter)
+		
+		if t > 0:
+			time.sleep(t)
+	
+	def stats(self):
+		"""Returns a dict with the number of sessions, commands and injected failures so far
+		"""
+		with self.lock:
+			return {'connections':self.connections, 'commands':self.commands, 'failures':self.failures}
+
+
+class StpDialog(object):
+	"""The command-dialogue of one session with an StpCatalog, in the 'stp' program's output format.
+	Subclasses define how lines of text and seismogram-files are sent (see _send() and _sendFile())
+	"""
+	def __init__(self, catalog):
+		self.catalog = catalog
+		self.format = 'SAC'
+		self.gain = False
+		self.verbose = False
+	
+	def _send(self, *lines):
+		"""Send the given lines of text
+		"""
+		raise NotImplementedError
+	
+	def _sendFile(self, ev_id, filename, size, blocks):
+		"""Send a file of 'size' bytes for the event with the given ID. 'blocks' is an iterable of blocks of file-data
+		"""
+		raise NotImplementedError
+	
+	def _blocks(self, size):
+		"""Yields 'size' bytes of synthetic seismogram-data in blocks, at the catalog's transfer-rate (if any)
+		"""
+		cat = self.catalog
+		left = size
+		while left > 0:
+			block = cat.block[:left]
+			left -= len(block)
+			yield block
+			
+			if cat.rate > 0:
+				time.sleep(len(block) / float(cat.rate))
+	
+	def banner(self):
+		"""Send the banner, which starts the session
+		"""
+		cat = self.catalog
+		with cat.lock:
+			cat.connections += 1
+		
+		if cat.latency > 0:
+			time.sleep(cat.latency)
+		
+		self._send("Connected to %s (stand-in STP server)" % cat.group, "Done")
+	
+	def command(self, line):
+		"""Handle one line of input.
+		Returns 'False' when the session ends; after the 'EXIT' command, or when a failure is injected
+		"""
+		cat = self.catalog
+		tokens = line.split()
+		if not len(tokens):
+			return True
+		
+		with cat.lock:
+			cat.commands += 1
+		
+		cat.wait()
+		
+		cmd = tokens[0].upper()
+		if cmd == 'EXIT':
+			return False
+		
+		if cat.chance(cat.failrate):
+			with cat.lock:
+				cat.failures += 1
+			return False
+		
+		if cmd == 'STATUS':
+			self._send("Format = %s" % self.format, "Gain = %s" % ('OFF', 'ON')[self.gain], "Done")
+		elif cmd == 'VERBOSE':
+			self.verbose = not self.verbose
+			self._send("verbose mode %s" % ('off', 'on')[self.verbose], "Done")
+		elif cmd == 'GAIN':
+			self.gain = (tokens[-1].upper() == 'ON')
+			if self.gain:
+				self._send("Correcting for gain", "Done")
+			else:
+				self._send("No gain correction", "Done")
+		elif cmd in extensions:
+			self.format = cmd
+			self._send("Done")
+		elif cmd == 'EVENT':
+			self._eventCmd(tokens[1:])
+		elif cmd == 'STA':
+			self._staCmd(tokens[1:])
+		elif cmd == 'EAVAIL':
+			self._eavailCmd(tokens[1:])
+		elif cmd == 'TRIG':
+			self._trigCmd(tokens[1:])
+		elif cmd == 'WIN':
+			self._winCmd(tokens[1:])
+		else:
+			self._send("Unknown command '%s'" % tokens[0], "Done")
+		
+		return True
+	
+	def _args(self, tokens):
+		"""Split a command's arguments into a dict of '-option value' pairs, and a list of the remaining arguments
+		"""
+		opts = {}
+		args = []
+		while len(tokens):
+			tok = tokens.pop(0)
+			if tok.startswith('-') and (tok not in ('-e', '-l')) and len(tokens):
+				opts[tok] = tokens.pop(0)
+			elif not tok.startswith('-'):
+				args.append(tok)
+		
+		return (opts, args)
+	
+	def _eventCmd(self, tokens):
+		cat = self.catalog
+		(opts, ids) = self._args(tokens)
+		lines = ["# Number of events: %d" % len(ids)]
+		for ev_id in ids:
+			if cat.chance(cat.nodata):
+				lines.append("%s No data" % ev_id)
+			else:
+				lines.append(cat.eventLine(ev_id))
+		lines.append("Done")
+		self._send(*lines)
+	
+	def _staCmd(self, tokens):
+		cat = self.catalog
+		(opts, args) = self._args(tokens)
+		codes = sorted(cat.stations.keys())
+		if '-sta' in opts:
+			codes = [code for code in codes if code == "%s.%s" % (opts.get('-net', cat.net), opts['-sta'])]
+		
+		lines = ["# Number of stations: %d" % len(codes)]
+		for code in codes:
+			lines.append("%s %.4f %.4f" % (code, cat.stations[code][0], cat.stations[code][1]))
+		lines.append("Done")
+		self._send(*lines)
+	
+	def _eavailCmd(self, tokens):
+		cat = self.catalog
+		(opts, ids) = self._args(tokens)
+		if cat.chance(cat.nodata):
+			self._send("# of seismograms: 0", "Done")
+			return
+		
+		chans = cat.channels(opts.get('-chan', '%'))
+		ev = cat.event(ids[0])
+		timestring = time.strftime("%Y/%m/%d,%H:%M:%S.000", time.localtime(ev['time']))
+		
+		lines = ["# of seismograms: %d" % (len(cat.stations) * len(chans))]
+		for code in sorted(cat.stations.keys()):
+			(net, sta) = code.split('.')
+			for chan in chans:
+				lines.append("%s %s %s T %s %.1fs" % (net, sta, chan, timestring, cat.duration))
+		lines.append("Done")
+		self._send(*lines)
+	
+	def _trigCmd(self, tokens):
+		cat = self.catalog
+		(opts, ids) = self._args(tokens)
+		code = "%s.%s" % (opts.get('-net', cat.net), opts.get('-sta', ''))
+		chans = cat.channels(opts.get('-chan', '%'))
+		
+		for ev_id in ids:
+			evnt = "%s\n" % cat.eventLine(ev_id)
+			self._sendFile(ev_id, "%s.evnt" % ev_id, len(evnt), [evnt])
+			
+			if code not in cat.stations:
+				continue
+			
+			for chan in chans:
+				self._sendFile(ev_id, "%s.%s.%s" % (code, chan, extensions[self.format]), cat.wavesize, self._blocks(cat.wavesize))
+		
+		self._send("Done")
+	
+	def _parseTime(self, timestring):
+		"""Returns the time (in seconds since the epoch) of a 'YYYY/MM/DD,hh:mm:ss.sss' time-string
+		"""
+		(secs, dot, frac) = timestring.partition('.')
+		return time.mktime(time.strptime(secs, "%Y/%m/%d,%H:%M:%S")) + float("0.%s" % (frac or "0"))
+	
+	def _winCmd(self, tokens):
+		# 'WIN -net <net> -sta <sta> -chan <chan> <start-time> <end-time>'; seismograms that span the window (up to the
+		# length of a triggered seismogram), saved in the root of the outputdir, not in an event's dir
+		cat = self.catalog
+		(opts, args) = self._args(tokens)
+		code = "%s.%s" % (opts.get('-net', cat.net), opts.get('-sta', ''))
+		chans = cat.channels(opts.get('-chan', '%'))
+		try:
+			(start, end) = [self._parseTime(arg) for arg in args[:2]]
+		except ValueError:
+			self._send("Invalid time window '%s'" % " ".join(args), "Done")
+			return
+		
+		dur = min(max(0., end - start), cat.duration)
+		size = max(1, int(cat.wavesize * dur / cat.duration))
+		stamp = time.strftime("%Y%m%d%H%M%S", time.localtime(start))
+		
+		if code in cat.stations:
+			for chan in chans:
+				self._sendFile(".", "%s.%s.%s.%s" % (stamp, code, chan, extensions[self.format]), size, self._blocks(size))
+		
+		self._send("Done")
+
+
+class StpHandler(SocketServer.StreamRequestHandler, StpDialog):
+	"""Handles one connection to the StpServer
+	"""
+	def setup(self):
+		SocketServer.StreamRequestHandler.setup(self)
+		StpDialog.__init__(self, self.server)
+	
+	def _send(self, *lines):
+		out = ""
+		for line in lines:
+			out += "%s\n" % line
+		self.wfile.write(out)
+	
+	def _sendFile(self, ev_id, filename, size, blocks):
+		"""Send the file as a 'DATA <event-ID> <filename> <size>' line, followed by the file-data
+		"""
+		self._send("DATA %s %s %d" % (ev_id, filename, size))
+		for block in blocks:
+			self.wfile.write(block)
+	
+	def handle(self):
+		self.banner()
+		
+		while True:
+			line = self.rfile.readline()
+			if not len(line):
+				break
+			
+			if not self.command(line):
+				break
+
+
+class StpServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer, StpCatalog):
+	"""A local stand-in for an STP server, serving a synthetic catalog for one network (see StpCatalog)
+	"""
+	allow_reuse_address = True
+	daemon_threads = True
+	
+	def __init__(self, address=('localhost', 0), net='CI', group='scedc', num_sta=20, wavesize=65536, delay=0., **kwargs):
+		"""Instantiate an StpServer listening at 'address' (a (host, port) tuple; port 0 picks a free port)
+		for the network 'net', in STP server group 'group'. The server has 'num_sta' stations, 3 channels each.
+		'wavesize' is the size (in bytes) of each seismogram, and 'delay' the time (in seconds) the server waits
+		before answering each command. The other keyword-arguments set the other simulated latencies and the
+		failure-injection rates (see StpCatalog)
+		"""
+		SocketServer.TCPServer.__init__(self, address, StpHandler)
+		StpCatalog.__init__(self, net, group, num_sta, wavesize, delay, **kwargs)
+		
+		self.thread = None
+	
+	def start(self):
+		"""Starts serving in a new thread. Returns the (host, port) tuple the server listens at
+		"""
+		self.thread = threading.Thread(None, self.serve_forever, "StpServer-%s" % self.net)
+		self.thread.start()
+		return self.server_address
+	
+	def stop(self):
+		"""Stops serving, and waits for the thread to finish
+		"""
+		self.shutdown()
+		if self.thread and self.thread.isAlive():
+			self.thread.join()
+		self.server_close()
+
+
+if __name__ == '__main__':
+	import signal
+	
+	from optparse import OptionParser
+	
+	op = OptionParser()
+	# Define command-line options
+	op.add_option("-p", "--port", action='store', type='int', dest='port', metavar='PORT',
+					help="listen at PORT [default = 9999]")
+	op.add_option("-n", "--net", action='store', type='string', dest='net', metavar='NET',
+					help="serve network NET (CI or NC) [default = CI]")
+	op.add_option("-s", "--size", action='store', type='int', dest='size', metavar='N',
+					help="serve seismograms of N bytes [default = 65536]")
+	op.add_option("-d", "--delay", action='store', type='float', dest='delay', metavar='T',
+					help="wait T seconds before answering each command [default = 0]")
+	op.add_option("-j", "--jitter", action='store', type='float', dest='jitter', metavar='T',
+					help="wait up to T seconds extra (at random) before answering each command [default = 0]")
+	op.add_option("-l", "--latency", action='store', type='float', dest='latency', metavar='T',
+					help="wait T seconds before starting each session [default = 0]")
+	op.add_option("-r", "--rate", action='store', type='int', dest='rate', metavar='N',
+					help="send seismogram-data at N bytes/sec at most [default = unlimited]")
+	op.add_option("-f", "--failrate", action='store', type='float', dest='failrate', metavar='P',
+					help="break off a session with probability P for each command [default = 0]")
+	op.add_option("-e", "--nodata", action='store', type='float', dest='nodata', metavar='P',
+					help="have no data for an event with probability P [default = 0]")
+	
+	# Set default values
+	op.set_defaults(port=9999)
+	op.set_defaults(net='CI')
+	op.set_defaults(size=65536)
+	op.set_defaults(delay=0.)
+	op.set_defaults(jitter=0.)
+	op.set_defaults(latency=0.)
+	op.set_defaults(rate=0)
+	op.set_defaults(failrate=0.)
+	op.set_defaults(nodata=0.)
+	
+	# Parse command-line options
+	(opts, args) = op.parse_args()
+	
+	groups = {'CI':'scedc', 'NC':'ncedc'}
+	srv = StpServer(('', opts.port), opts.net, groups.get(opts.net, opts.net.lower()), wavesize=opts.size, delay=opts.delay,
+			jitter=opts.jitter, latency=opts.latency, rate=opts.rate, failrate=opts.failrate, nodata=opts.nodata)
+	
+	# Define a signal-handler to stop the server
+	def stophandler(sig, frame):
+		print "\nGot signal %d" % sig
+		srv.stop()
+	
+	signal.signal(signal.SIGINT, stophandler)
+	signal.signal(signal.SIGQUIT, stophandler)
+	
+	print "Serving '%s' at %s:%d" % (srv.group, srv.server_address[0], srv.server_address[1])
+	srv.start()
+	while srv.thread.isAlive():
+		time.sleep(1)
+	
+	print "Quitting"
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+### _*_ coding: utf-8 _*_
+#
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# A stand-in for the 'stp' program, for running the StpWrapper (see stprunner.py) without the real 'stp' executable
+# and without network-access. It takes the same arguments as 'stp' ('-d <outputdir> <server-group>'), reads commands
+# from stdin, prints its output (with 'STP>' prompts) to stdout, and saves the seismogram-files in <outputdir>/<event-ID>/
+# The synthetic catalog and the command-dialogue are those of the stand-in STP server (see stpclient.py).
+#
+# The StpWrapper starts 'stp' with fixed arguments, so the catalog's latencies and failure-injection rates are set
+# through environment-variables (see stpclient.StpCatalog):
+#	STPMOCK_STATIONS	the number of stations [default = 20]
+#	STPMOCK_SIZE		the size of each seismogram (bytes) [default = 65536]
+#	STPMOCK_DELAY		the time to wait before answering each command (sec) [default = 0]
+#	STPMOCK_JITTER		the max extra (random) time to wait before answering each command (sec) [default = 0]
+#	STPMOCK_LATENCY		the time to wait before printing the banner (sec) [default = 0]
+#	STPMOCK_RATE		the max seismogram-data rate (bytes/sec) [default = 0 = unlimited]
+#	STPMOCK_FAILRATE	the probability of exiting (with returncode 1) on any command [default = 0]
+#	STPMOCK_NODATA		the probability of having no data for an event [default = 0]
+# Set StpWrapper.stpexec to (an executable wrapper around) this script to use it.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+import stpclient
+
+import os, sys
+
+# the network served by each STP server group
+groupnet = {'scedc':'CI', 'ncedc':'NC'}
+
+
+class StpConsole(stpclient.StpDialog):
+	"""An StpDialog on stdin / stdout, saving the seismogram-files to disk
+	"""
+	def __init__(self, catalog, outputdir, infd=sys.stdin, outfd=sys.stdout):
+		stpclient.StpDialog.__init__(self, catalog)
+		self.outputdir = outputdir
+		self.infd = infd
+		self.outfd = outfd
+	
+	def _send(self, *lines):
+		for line in lines:
+			self.outfd.write("%s\n" % line)
+		self.outfd.flush()
+	
+	def _sendFile(self, ev_id, filename, size, blocks):
+		"""Save the file in the event's subfolder of the outputdir
+		"""
+		ev_dir = os.path.join(self.outputdir, os.path.basename(ev_id))
+		if not os.path.isdir(ev_dir):
+			os.makedirs(ev_dir)
+		
+		f = open(os.path.join(ev_dir, os.path.basename(filename)), 'wb')
+		try:
+			for block in blocks:
+				f.write(block)
+		finally:
+			f.close()
+	
+	def run(self):
+		"""Run the session until 'EXIT' or the end of the input.
+		Returns the returncode; 0, or 1 if a failure was injected
+		"""
+		self.banner()
+		
+		while True:
+			self.outfd.write("STP>\n")
+			self.outfd.flush()
+			
+			line = self.infd.readline()
+			if not len(line):
+				return 0
+			
+			if not self.command(line):
+				if line.split()[0].upper() == 'EXIT':
+					return 0
+				return 1
+
+
+def _env(name, default):
+	"""Returns the value of the environment-variable 'name', converted to the type of 'default', or 'default' if it is not set
+	"""
+	val = os.environ.get(name)
+	if not val:
+		return default
+	
+	try:
+		return type(default)(val)
+	except ValueError:
+		sys.stderr.write("Invalid value for %s: '%s'\n" % (name, val))
+		return default
+
+
+if __name__ == '__main__':
+	from optparse import OptionParser
+	
+	op = OptionParser(usage="%prog [-d OUTPUTDIR] GROUP")
+	# Define command-line options
+	op.add_option("-d", "--outputdir", action='store', type='string', dest='outputdir', metavar='DIR',
+					help="save seismograms in DIR [default = .]")
+	
+	# Set default values
+	op.set_defaults(outputdir='.')
+	
+	# Parse command-line options
+	(opts, args) = op.parse_args()
+	
+	if len(args):
+		group = args[0]
+	else:
+		group = 'scedc'
+	
+	cat = stpclient.StpCatalog(groupnet.get(group, group[:2].upper()), group,
+			num_sta=_env('STPMOCK_STATIONS', 20),
+			wavesize=_env('STPMOCK_SIZE', 65536),
+			delay=_env('STPMOCK_DELAY', 0.),
+			jitter=_env('STPMOCK_JITTER', 0.),
+			latency=_env('STPMOCK_LATENCY', 0.),
+			rate=_env('STPMOCK_RATE', 0),
+			failrate=_env('STPMOCK_FAILRATE', 0.),
+			nodata=_env('STPMOCK_NODATA', 0.))
+	
+	try:
+		ret = StpConsole(cat, opts.outputdir).run()
+	except (IOError, KeyboardInterrupt):	# 'Broken pipe' or interrupted
+		ret = 1
+	
+	sys.exit(ret)
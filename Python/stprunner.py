@@ -16,16 +16,41 @@
 # it starts an StpWrapper in its own thread, which in turn uses the 'stp' executable to query 
 # the relevant seismic datacenter and to download seismograms for this event from the nearest few 
 # seismographic stations, if such data exists.
-# If no data exists (yet), the StpWrapper keeps retrying the events it is working on.
+# If no data exists (yet), the StpWrapper hands the event to a RetryScheduler, to be retried later.
 # In the meantime, the StpRunner might start other StpWrappers if more new events appear in the DB.
+# The connected 'stp' processes are kept in an StpPool when an StpWrapper is done with them, so that
+# other StpWrappers (and later retry-cycles) can re-use them without waiting for a new connection.
+# Optionally, an StpDriver runs all StpWrappers from one thread, multiplexing the 'stp' processes' in- and output
+# with poll(); the StpWrappers' retrieval-cycles then run as generator-based coroutines (StpTasks).
+# The StpWrapper only talks to the datacenters through 'stp'. Tests and benchmarks can subclass it to use a different
+# session (see StpWrapper._openSession(), and the stand-in transport in stpbench.py).
+# The stations' locations are kept in a StationCatalog, which saves each network's station-list to disk, so it is
+# known right after a restart. Full station-lists are only fetched again when they are older than a set TTL.
+# The seismograms available per event are asked for in batches (pipelined 'EAVAIL' commands) and kept in an AvailCache,
+# so retries only ask for what is still missing.
+# A FetchPlanner spreads each event's seismogram-downloads over several concurrent sessions, up to a cap per datacenter.
+# Optionally (and experimentally), only the part of each seismogram that is played back is downloaded (with 'WIN' rather
+# than 'TRIG'); from just before the P-wave arrives at the station until the quake's duration after the S-wave arrives.
+# Events that have to be retried are handed to the StpRunner's RetryScheduler, which has them processed again (by a new
+# StpWrapper) when they are due, with a delay that grows with each attempt, so no StpWrapper sits waiting for them.
+# The StpRunner queues the events to process in an EventQueue, ranked by magnitude, age and distance to Parkfield,
+# from which a fixed pool of StpWrappers (workers) take their work.
+# In 'auto' mode, the StpRunner subscribes to the QDMParser's changes, and only queues the events that were added to
+# (or replaced in) the DB. Which events are done, in process or waiting to be retried is kept in memory, so the
+# outputdir is only listed once, at start-up.
+# Events that leave the DB (e.g. replaced by a newer event of the same magnitude) are cancelled right away; taken out of
+# the EventQueue or the RetryScheduler, or, if a worker is processing them, stopped between two commands, after which
+# their partial downloads are removed.
 #
 #	Stock, V2_Lab Rotterdam, June 2008
 ###
 from __future__ import with_statement
 
-import qdmparser
+import qdmparser, dastrigger
 
 import datetime, time, types, os, stat, sys, subprocess, thread, threading
+import select, fcntl, errno, heapq, math, random
+import _strptime		# time.strptime() imports this on first use, which is not thread-safe
 import numpy
 
 ###
@@ -40,42 +65,1627 @@ out_fmts = ('SAC', 'SEED', 'MSEED', 'FLT32', 'INT32', 'ASCII', 'V0', 'COSMOS-V0'
 global netgroup
 netgroup = {'CI':'scedc', 'NC':'ncedc'}
 
+# the mean radius of the Earth, in km
+global earth_radius
+earth_radius = 6371.0
+
+# the (mean crustal) velocities of P- and S-waves, in km/s
+global p_velocity, s_velocity
+p_velocity = 6.0
+s_velocity = 3.5
+
+# the location (latitude, longitude) of Parkfield, to which events' distances are measured
+global parkfield
+parkfield = (35.9, -120.43)
+
+###
+# Global functions
+###
+
+def arstr(a, p=3) :
+	"""Returns a string-representation of a numpy-array.
+	
+	This is simply a wrapper around numpy.array2string()
+	"""
+	return numpy.array2string(a, precision=p, suppress_small=True)
+
+def veclen(a, axis=0) :
+	"""Returns the length of a vector, or array of vectors
+	
+	This is simply a wrapper around numpy.ma.hypot.reduce()
+	"""
+	return numpy.ma.hypot.reduce(a, axis)
+
+def gcdist(loc, locs) :
+	"""Returns the great-circle distance(s) (in km) from the location 'loc' to the location(s) 'locs'.
+	Locations are (latitude, longitude) pairs in degrees; 'locs' can be an (N x 2) array of locations.
+	
+	Uses the haversine-formula
+	"""
+	lat0 = math.radians(loc[0])
+	lon0 = math.radians(loc[1])
+	rad = numpy.radians(numpy.asarray(locs, dtype=numpy.float64))
+	lat = rad[..., 0]
+	lon = rad[..., 1]
+	h = numpy.sin((lat - lat0) / 2.) ** 2 + math.cos(lat0) * numpy.cos(lat) * numpy.sin((lon - lon0) / 2.) ** 2
+	return 2. * earth_radius * numpy.arcsin(numpy.sqrt(numpy.minimum(h, 1.)))
+
+def exitError(returncode) :
+	"""Returns an StpError describing the exit of an 'stp' process with the given returncode
+	"""
+	if returncode in (-1, -2, -3, -4, -5, -6, -9, -14, -15):	# got signal
+		return StpError(returncode, "Interrupted")
+	elif returncode == -11:	# SEGV
+		return StpError(-11, "Segfault in %s" % os.path.basename(StpWrapper.stpexec))
+	elif returncode == -8:	# No configfile found
+		return StpError(-8, "Config-file '~/.stp' or '%s/.stp' not found" % os.path.dirname(StpWrapper.stpexec))
+	else:
+		return StpError(returncode, "Disconnected")
+
+###
+# Error class
+###
+
+class StpError(BaseException):
+	def __init__(self, code, msg):
+		self.code = code
+		self.message = msg
+		
+	def __str__(self):
+		out = ""
+		if self.code != 0:
+			out += "STP Error: "
+		out += self.message
+		if self.code != 0:
+			out += " [exit-code %d]" % self.code
+		
+		return out
+
+###
+# STP session pool
+###
+
+class StpPool(object):
+	"""A pool of idle, connected 'stp' subprocesses, shared by the StpWrappers of an StpRunner.
+	An StpWrapper leases a session from the pool when it connects to a network, and releases it
+	back into the pool when it disconnects, so the 'stp' process stays connected and configured
+	for the next StpWrapper (or the next retry-cycle) that needs the same network.
+	Sessions are kept per 'key'; a tuple of the network-code, the output-dir and the STP settings
+	applied to the session (see StpWrapper._sessionKey()), so a leased session never needs re-configuring.
+	"""
+	# max number of idle sessions to keep per key
+	maxidle = 2
+	# idle sessions are closed after this period of time
+	maxage = datetime.timedelta(0, 600)
+	
+	def __init__(self, maxidle=None, maxage=None):
+		"""Instantiate an StpPool.
+		'maxidle' is the max number of idle sessions to keep per key,
+		'maxage' (a 'timedelta' object) the period of time after which idle sessions are closed
+		"""
+		if maxidle != None:
+			self.maxidle = maxidle
+		if maxage != None:
+			self.maxage = maxage
+		
+		# a dict of lists of (stp-process, release-time) tuples, per key
+		self.idle = {}
+		self.lock = threading.Lock()
+		
+	def lease(self, key):
+		"""Take the most recently released idle session for the given key out of the pool.
+		Returns the 'stp' process (a subprocess.Popen object), or 'None' if there is no idle session for this key
+		"""
+		with self.lock:
+			sessions = self.idle.get(key, [])
+			while len(sessions):
+				(stp, released) = sessions.pop()
+				if stp.poll() == None:
+					return stp
+		
+		return None
+		
+	def release(self, key, stp):
+		"""Put a session for the given key back into the pool.
+		The session is closed if it has exited, or if the pool already holds 'maxidle' sessions for this key
+		"""
+		with self.lock:
+			sessions = self.idle.setdefault(key, [])
+			if (stp.poll() == None) and (len(sessions) < self.maxidle):
+				sessions.append((stp, datetime.datetime.utcnow()))
+				return
+		
+		self.close(stp)
+		
+	def expire(self):
+		"""Close all idle sessions that have exited, or that have been idle for longer than StpPool.maxage
+		"""
+		old = datetime.datetime.utcnow() - self.maxage
+		expired = []
+		with self.lock:
+			for (key, sessions) in self.idle.items():
+				for (stp, released) in sessions[:]:
+					if (released < old) or (stp.poll() != None):
+						sessions.remove((stp, released))
+						expired.append(stp)
+		
+		for stp in expired:
+			self.close(stp)
+	
+	def count(self):
+		"""Returns the total number of idle sessions in the pool
+		"""
+		with self.lock:
+			return sum([len(sessions) for sessions in self.idle.values()])
+	
+	def close(self, stp):
+		"""Exit an 'stp' process that is not (or no longer) in the pool
+		"""
+		if stp.poll() != None:
+			return
+		
+		try:
+			stp.stdin.write("EXIT\n")
+			stp.stdin.close()
+			stp.stdout.read()	# read until EOF
+		except IOError:		# 'Broken pipe' i.e. stp-subprocess was already killed
+			pass
+		
+		stp.wait()
+	
+	def closeAll(self):
+		"""Close all idle sessions
+		"""
+		with self.lock:
+			sessions = []
+			for key in self.idle.keys():
+				sessions.extend(self.idle.pop(key))
+		
+		for (stp, released) in sessions:
+			self.close(stp)
+
+###
+# STP requests, tasks & event-loop driver
+###
+
+class StpRequest(object):
+	"""A command (or a sequence of commands) for an 'stp' process, and its (parsed) result.
+	StpRequests are executed right away by the StpWrapper that creates them, or in the background by an StpDriver.
+	"""
+	def __init__(self, cmds=None, parse=None, end='Done', owner=None, pipeline=False, split=False):
+		"""Instantiate an StpRequest.
+		'cmds' is a list of command-strings, sent to the 'stp' process one after the other. The output of each command
+		ends with the line 'end', or with the exit of the 'stp' process if 'end' is 'None'.
+		A command of 'None' sends nothing, but does wait for the 'end' line (e.g. the banner of a new 'stp' process)
+		If 'pipeline' == True, all commands are sent at once, rather than each after the output of the previous one,
+		so the whole sequence takes a single round-trip to the datacenter.
+		'parse' is a function that is called with the list of all output-lines (excluding the 'end' lines),
+		or with a list of each command's list of output-lines if 'split' == True, and returns the request's result.
+		'owner' is the StpWrapper that created the request. Its 'verbose' setting and logMessage() method are used
+		for logging the 'stp' output.
+		"""
+		if cmds == None:
+			cmds = []
+		
+		self.cmds = cmds
+		self.parse = parse
+		self.end = end
+		self.owner = owner
+		self.pipeline = pipeline
+		self.split = split
+		
+		# the output-lines, the index of the command being executed, and the number of commands sent
+		self.lines = []
+		self.idx = 0
+		self.sent = 0
+		# the number of output-lines at the end of each command's output
+		self.ends = []
+		# set by cancel()
+		self.cancelled = False
+		
+		self.value = None
+		self.error = None
+		self.callbacks = []
+		self.done = threading.Event()
+	
+	def finish(self, value=None, error=None):
+		"""Complete the request with the given error or, if there is no error, with its parsed output (or the given value).
+		Then call the callbacks
+		"""
+		if (error == None) and (self.parse != None):
+			try:
+				if self.split:
+					value = self.parse(self.outputs())
+				else:
+					value = self.parse(self.lines)
+			except StpError, e:
+				error = e
+			except (ValueError, IndexError, KeyError), e:
+				error = StpError(8, "Unexpected STP output: %s" % str(e))
+		
+		self.value = value
+		self.error = error
+		self.done.set()
+		
+		for func in self.callbacks:
+			func(self)
+	
+	def outputs(self):
+		"""Returns a list of each (completed) command's list of output-lines
+		"""
+		out = []
+		start = 0
+		for end in self.ends:
+			out.append(self.lines[start:end])
+			start = end
+		
+		return out
+	
+	def cancel(self):
+		"""Have the request stop after the command being executed; the remaining commands are not sent, and the request
+		fails with a 'Cancelled' StpError. Pipelined requests (of which all commands are sent at once) run to completion.
+		"""
+		self.cancelled = True
+	
+	def isCancelled(self):
+		"""Returns 'True' if the request has been cancelled, and its next command is not to be sent
+		"""
+		return self.cancelled and (not self.pipeline) and (self.idx < len(self.cmds)) and (self.cmds[self.idx] != None)
+	
+	def addCallback(self, func):
+		"""Add a function to be called (with the request as argument) when the request completes.
+		If the request has already completed, the function is called right away
+		"""
+		if self.done.isSet():
+			func(self)
+		else:
+			self.callbacks.append(func)
+	
+	def isDone(self):
+		"""Returns 'True' if the request has completed
+		"""
+		return self.done.isSet()
+	
+	def wait(self, timeout=None):
+		"""Wait for the request to complete. Returns 'True' if the request has completed
+		"""
+		self.done.wait(timeout)
+		return self.done.isSet()
+	
+	def result(self, timeout=None):
+		"""Wait for the request to complete, and return its result
+		(May raise StpError)
+		"""
+		if not self.wait(timeout):
+			raise StpError(11, "Timed out")
+		
+		if self.error != None:
+			raise self.error
+		
+		return self.value
+
+
+class StpTask(object):
+	"""A generator-based coroutine, driven by the StpRequests it yields.
+	The generator yields an StpRequest whenever it has to wait for one. When the request completes,
+	the generator is resumed with the request's result (or the request's error is raised inside the generator).
+	A generator may also yield another generator, which then runs as a sub-routine; the first value yielded
+	by the sub-routine that is neither an StpRequest nor a generator is its return-value.
+	"""
+	def __init__(self, gen, name=None):
+		"""Instantiate an StpTask for the generator 'gen'
+		"""
+		self.name = name
+		self.stack = [gen]
+		
+		self.value = None
+		self.error = None
+		self.done = threading.Event()
+		# a request that completes with the task's result, for other tasks to wait for
+		self.finished = StpRequest()
+	
+	def step(self, value=None, error=None):
+		"""Resume the task with the given value, or raise the given error inside it,
+		and run it until it yields an StpRequest that has not completed yet.
+		Returns that request, or 'None' if the task is done
+		"""
+		while len(self.stack):
+			gen = self.stack[-1]
+			try:
+				if error != None:
+					item = gen.throw(error)
+				else:
+					item = gen.send(value)
+			
+			except StopIteration:
+				self.stack.pop()
+				(value, error) = (None, None)
+				continue
+			
+			except BaseException, e:
+				self.stack.pop()
+				(value, error) = (None, e)
+				continue
+			
+			(value, error) = (None, None)
+			if type(item) == types.GeneratorType:
+				self.stack.append(item)
+			
+			elif isinstance(item, StpRequest):
+				if not item.isDone():
+					return item
+				
+				(value, error) = (item.value, item.error)
+			
+			else:	# any other value is the return-value of the current generator
+				gen.close()
+				self.stack.pop()
+				value = item
+		
+		self.value = value
+		self.error = error
+		self.done.set()
+		self.finished.finish(value, error)
+		return None
+
+
+class StpDriver(object):
+	"""Executes the StpRequests of any number of 'stp' processes, and runs the StpTasks waiting for them, in one thread.
+	The processes' output-pipes are multiplexed with poll(), and read without blocking. The output is split into lines,
+	and fed to the request being executed on each process. Each request steps through its commands; when the output of
+	a command is complete, the next command (of the request, or of the next request queued for the process) is sent.
+	A session that is not an 'stp' process, but has the same 'stdin', 'stdout', poll() and wait() members, is handled
+	the same way. If it has a feed() method, it splits its own output into lines (see _read()), and if it has a sent()
+	method, it is told the number of bytes written to it.
+	"""
+	# file-objects for writing informational messages, warnings & errors
+	logfd = sys.stdout
+	errfd = sys.stderr
+	
+	def __init__(self):
+		"""Instantiate an StpDriver
+		"""
+		self.thread = None
+		self.run = False
+		
+		# the state of each 'stp' process, indexed by the file-descriptors of both its stdout and its stdin
+		self.fds = {}
+		self.poller = None
+		
+		# a list of (function, args) tuples to be called in the driver-thread, a lock to guard it,
+		# and a pipe for waking up the driver-thread
+		self.calls = []
+		self.lock = threading.Lock()
+		self.wakeup = None
+		
+		# a heap of (time, sequence-number, StpRequest) tuples for sleeping tasks
+		self.timers = []
+		self.timerseq = 0
+	
+	def logMessage(self, msg):
+		"""Write a message, prefixed by 'StpDriver: " to the log-file-object
+		"""
+		try:
+			self.logfd.write("StpDriver: %s\n" % msg)
+		except Exception, e:
+			self.errMessage("Error writing to file '%s': %s" % (self.logfd.name, str(e)))
+	
+	def errMessage(self, msg):
+		"""Write a message, prefixed by 'StpDriver: " to the err-file-object
+		"""
+		try:
+			self.errfd.write("StpDriver: %s\n" % msg)
+		except Exception, e:
+			sys.stderr.write("Error writing to file '%s': %s\n" % (self.errfd.name, str(e)))
+	
+	
+	def _call(self, func, *args):
+		"""Have the driver-thread call 'func' with the given arguments
+		If the driver is not running, the function is called right away
+		"""
+		with self.lock:
+			if self.run:
+				self.calls.append((func, args))
+				os.write(self.wakeup[1], 'x')
+				return
+		
+		func(*args)
+	
+	def submit(self, stp, req):
+		"""Queue the StpRequest 'req' for execution on the 'stp' process (a subprocess.Popen object)
+		Returns the request
+		"""
+		self._call(self._submit, stp, req)
+		return req
+	
+	def detach(self, stp):
+		"""Stop handling the 'stp' process, so it can be used without the driver again.
+		Returns an StpRequest that completes when the process has been detached
+		"""
+		req = StpRequest()
+		self._call(self._detach, stp, req)
+		return req
+	
+	def sleep(self, seconds):
+		"""Returns an StpRequest that completes after the given number of seconds
+		"""
+		req = StpRequest()
+		self._call(self._addTimer, time.time() + seconds, req)
+		return req
+	
+	def spawn(self, task):
+		"""Run the StpTask 'task'
+		"""
+		self._call(self._resume, task)
+	
+	
+	def _resume(self, task, value=None, error=None):
+		"""Resume a task, and have it resumed again when the request it yields completes
+		"""
+		req = task.step(value, error)
+		if req != None:
+			req.addCallback(lambda r: self._wake(task, r))
+		elif task.error != None:
+			self.errMessage("Error in %s: %s" % (task.name, str(task.error)))
+	
+	def _wake(self, task, req):
+		"""Resume a task with the result of the completed request 'req', in the driver-thread.
+		(Requests that do not belong to an 'stp' process, e.g. those of an EventQueue, may complete in other threads)
+		"""
+		if threading.currentThread() is self.thread:
+			self._resume(task, req.value, req.error)
+		else:
+			self._call(self._resume, task, req.value, req.error)
+	
+	def _addTimer(self, t, req):
+		if not self.run:
+			req.finish()
+			return
+		
+		self.timerseq += 1
+		heapq.heappush(self.timers, (t, self.timerseq, req))
+	
+	def _setBlocking(self, fd, blocking):
+		flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+		if blocking:
+			fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+		else:
+			fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+	
+	def _submit(self, stp, req):
+		if not self.run:
+			req.finish(error=StpError(10, "Interrupted"))
+			return
+		
+		fd = stp.stdout.fileno()
+		if fd not in self.fds:
+			if stp.poll() != None:
+				req.finish(error=StpError(1, "Not connected"))
+				return
+			
+			s = {'stp':stp, 'fd':fd, 'infd':stp.stdin.fileno(), 'buf':"", 'out':"", 'writing':False, 'queue':[]}
+			self._setBlocking(s['fd'], False)
+			self._setBlocking(s['infd'], False)
+			self.fds[s['fd']] = s
+			self.fds[s['infd']] = s
+			self._register(s)
+		
+		s = self.fds[fd]
+		s['queue'].append(req)
+		if len(s['queue']) == 1:
+			self._next(s)
+	
+	def _register(self, s):
+		"""(Re-)register an 'stp' process' file-descriptors with the poller; its stdout for reading,
+		and its stdin for writing while there is pending output. (A session may have one file-descriptor for both)
+		"""
+		s['writing'] = (len(s['out']) > 0)
+		mask = select.POLLIN | select.POLLPRI
+		if s['fd'] == s['infd']:
+			if s['writing']:
+				mask |= select.POLLOUT
+			self.poller.register(s['fd'], mask)
+			return
+		
+		self.poller.register(s['fd'], mask)
+		if s['writing']:
+			self.poller.register(s['infd'], select.POLLOUT)
+		else:
+			try:
+				self.poller.unregister(s['infd'])
+			except KeyError:
+				pass
+	
+	def _remove(self, s):
+		"""Stop handling an 'stp' process. Restores its pipes (or other file-descriptors) to blocking mode
+		"""
+		self.poller.unregister(s['fd'])
+		if s['writing'] and (s['infd'] != s['fd']):
+			self.poller.unregister(s['infd'])
+		self.fds.pop(s['fd'], None)
+		self.fds.pop(s['infd'], None)
+		
+		for fd in (s['fd'], s['infd']):
+			try:
+				self._setBlocking(fd, True)
+			except IOError:
+				pass
+	
+	def _detach(self, stp, req):
+		s = None
+		if stp.stdout and not stp.stdout.closed:
+			s = self.fds.get(stp.stdout.fileno())
+		
+		if s != None:
+			self._remove(s)
+			for r in s['queue']:
+				r.finish(error=StpError(10, "Interrupted"))
+		
+		req.finish()
+	
+	def _next(self, s):
+		"""Send the next command of the current request of an 'stp' process.
+		Completes the requests that have no (more) commands
+		"""
+		while len(s['queue']):
+			req = s['queue'][0]
+			if req.idx >= len(req.cmds):
+				s['queue'].pop(0)
+				req.finish()
+				continue
+			
+			if (req.sent <= req.idx) and req.isCancelled():
+				s['queue'].pop(0)
+				req.finish(error=StpError(13, "Cancelled"))
+				continue
+			
+			if req.pipeline:
+				cmds = req.cmds[req.sent:]
+			elif req.sent <= req.idx:
+				cmds = [req.cmds[req.idx]]
+			else:
+				cmds = []
+			
+			req.sent += len(cmds)
+			for cmd in cmds:
+				if cmd != None:
+					s['out'] += "%s\n" % cmd
+			
+			if len(s['out']):
+				self._write(s)
+			
+			return
+	
+	def _write(self, s):
+		"""Write (as much as possible of) the pending output to an 'stp' process' stdin
+		"""
+		try:
+			n = os.write(s['infd'], s['out'])
+			s['out'] = s['out'][n:]
+			if hasattr(s['stp'], 'sent'):
+				s['stp'].sent(n)
+		except OSError, e:
+			if e.errno != errno.EAGAIN:		# 'Broken pipe' i.e. stp-subprocess has exited. We'll get an EOF on stdout
+				s['out'] = ""
+		
+		# poll stdin for writability only while there is pending output
+		if s['writing'] != (len(s['out']) > 0):
+			self._register(s)
+	
+	def _read(self, s):
+		"""Read the available output of an 'stp' process, and feed the complete lines to its current request
+		"""
+		try:
+			data = os.read(s['fd'], 65536)
+		except OSError, e:
+			if e.errno == errno.EAGAIN:
+				return
+			data = ""
+		
+		if not len(data):
+			self._eof(s)
+			return
+		
+		if hasattr(s['stp'], 'feed'):
+			lines = s['stp'].feed(data)
+		else:
+			lines = (s['buf'] + data).split('\n')
+			s['buf'] = lines.pop()
+		
+		for line in lines:
+			line = line.rstrip('\r')
+			if (not len(line)) or (not len(s['queue'])):
+				continue
+			
+			req = s['queue'][0]
+			if (req.owner != None) and ((req.owner.verbose & 1) != 0):
+				req.owner.logMessage("STP: %s" % line)
+			
+			if line.startswith('STP>'):
+				continue
+			
+			if line == req.end:
+				req.idx += 1
+				req.ends.append(len(req.lines))
+				if req.idx >= len(req.cmds):
+					s['queue'].pop(0)
+					req.finish()
+				
+				self._next(s)
+			
+			else:
+				req.lines.append(line)
+	
+	def _eof(self, s):
+		"""Handle the exit of an 'stp' process. Completes its pending requests
+		"""
+		self._remove(s)
+		code = s['stp'].wait()
+		
+		for req in s['queue']:
+			if req.end == None:
+				req.finish()
+			else:
+				req.finish(error=exitError(code))
+	
+	def _loop(self):
+		"""MainLoop of the driver-thread
+		"""
+		while self.run:
+			timeout = 1000
+			if len(self.timers):
+				timeout = max(0, min(timeout, int((self.timers[0][0] - time.time()) * 1000)))
+			
+			try:
+				events = self.poller.poll(timeout)
+			except select.error, e:
+				if e[0] == errno.EINTR:
+					continue
+				raise
+			
+			for (fd, event) in events:
+				if fd == self.wakeup[0]:
+					os.read(fd, 4096)
+					continue
+				
+				s = self.fds.get(fd)
+				if s == None:
+					continue
+				
+				if event & select.POLLOUT:
+					self._write(s)
+				if (event & ~select.POLLOUT) and (s['fd'] in self.fds):
+					self._read(s)
+			
+			with self.lock:
+				calls = self.calls
+				self.calls = []
+			
+			for (func, args) in calls:
+				func(*args)
+			
+			now = time.time()
+			while len(self.timers) and (self.timers[0][0] <= now):
+				(t, seq, req) = heapq.heappop(self.timers)
+				req.finish()
+		
+		# complete all outstanding requests
+		with self.lock:
+			calls = self.calls
+			self.calls = []
+		
+		for (func, args) in calls:
+			func(*args)
+		
+		for s in self.fds.values():
+			if s['fd'] in self.fds:
+				self._remove(s)
+				for req in s['queue']:
+					req.finish(error=StpError(10, "Interrupted"))
+		
+		while len(self.timers):
+			(t, seq, req) = heapq.heappop(self.timers)
+			req.finish()
+	
+	def start(self):
+		"""Starts the driver-thread (if it is not running already)
+		"""
+		with self.lock:
+			if self.run:
+				return
+			
+			self.poller = select.poll()
+			self.wakeup = os.pipe()
+			self.poller.register(self.wakeup[0], select.POLLIN)
+			self.run = True
+		
+		self.thread = threading.Thread(None, self._loop, "StpDriver")
+		self.thread.start()
+	
+	def stop(self):
+		"""Stops the driver-thread, and waits for it to finish.
+		Outstanding requests fail with an 'Interrupted' StpError.
+		"""
+		with self.lock:
+			if not self.run:
+				return
+			
+			self.run = False
+			os.write(self.wakeup[1], 'x')
+		
+		if self.thread and self.thread.isAlive():
+			self.thread.join()
+		
+		for fd in self.wakeup:
+			os.close(fd)
+		self.wakeup = None
+
+
+###
+# Station catalog
+###
+
+class StationCatalog(object):
+	"""A thread-safe catalog of the seismic networks' stations' locations, shared by the StpWrappers of an StpRunner.
+	Per network, the station-codes are kept in a list, with a dict of each code's index in that list,
+	and the locations in a contiguous (N x 2) array of (latitude, longitude) pairs in the same order.
+	Updates replace these as a whole (copy-on-write), so a snapshot (see get()) stays consistent without locking.
+	If a 'cachedir' is given, each network's station-list is saved in (and loaded from) a file in that dir,
+	so the stations are known right after a restart. A station-list is 'stale' if it was last fetched in full
+	longer than StationCatalog.ttl ago.
+	The stations are also indexed on a grid of 'cell' x 'cell' degree cells, for finding the stations nearest
+	to a location (see nearest()) without computing the distances to all stations.
+	"""
+	# station-lists are fetched in full again after this period of time
+	ttl = datetime.timedelta(7)
+	
+	# the size (in degrees) of the cells of the grid-index
+	cell = 0.5
+	# with at most this many stations to consider, the distances to all of them are computed, rather than searching the grid
+	exhaustive = 256
+	
+	# nearest() results are memoised per location, rounded to this many degrees, and at most this many are kept
+	quantum = 0.01
+	maxmemo = 1000
+	
+	def __init__(self, cachedir=None, ttl=None, stations=None):
+		"""Instantiate a StationCatalog.
+		'cachedir' is the dir to save the station-lists in. If not given, the station-lists are not saved.
+			This should not be the seismograms-dir (all subdirs and files in there are taken for events)
+		'ttl' (a 'timedelta' object) the period of time after which a station-list is stale
+		'stations' is an (optional) hierarchy of dicts containing the seismic networks' stations' locations
+		"""
+		self.cachedir = cachedir
+		if ttl != None:
+			self.ttl = ttl
+		
+		self.lock = threading.Lock()
+		
+		# a dict of per-network dicts with the 'codes', 'index', 'locs', 'grid' and 'fetched' time
+		self.nets = {}
+		for net in netgroup.keys():
+			self.nets[net] = self._stationList([], {}, numpy.zeros((0, 2)), None)
+		
+		# the memoised results of nearest()
+		self.memo = {}
+		
+		if type(stations) == types.DictType:
+			for (net, stns) in stations.items():
+				if type(stns) == types.DictType:
+					self.update(net, stns)
+	
+	def _cachefile(self, net):
+		return os.path.join(self.cachedir, "stations-%s.txt" % net)
+	
+	def _stationList(self, codes, index, locs, fetched):
+		"""Returns a station-list dict, with the grid-index of the given locations;
+		a dict of arrays of row-numbers (in 'locs') indexed by (lat-cell, lon-cell) tuples, and the 'extent' of the grid
+		"""
+		grid = {}
+		extent = None
+		if len(codes):
+			cells = numpy.floor(locs / self.cell).astype(int)
+			order = numpy.lexsort((cells[:, 1], cells[:, 0]))
+			keys = cells[order]
+			bounds = numpy.flatnonzero(numpy.any(keys[1:] != keys[:-1], axis=1)) + 1
+			for rows in numpy.split(order, bounds):
+				grid[tuple(cells[rows[0]])] = rows
+			
+			extent = (cells[:, 0].min(), cells[:, 0].max(), cells[:, 1].min(), cells[:, 1].max())
+		
+		return {'codes':codes, 'index':index, 'locs':locs, 'grid':grid, 'extent':extent, 'fetched':fetched}
+	
+	def _ring(self, ci, cj, r, extent):
+		"""Yields the grid-cells (within the grid's extent) at 'r' cells from cell (ci, cj)
+		"""
+		(imin, imax, jmin, jmax) = extent
+		if r == 0:
+			yield (ci, cj)
+			return
+		
+		for i in (ci - r, ci + r):
+			if imin <= i <= imax:
+				for j in range(max(cj - r, jmin), min(cj + r, jmax) + 1):
+					yield (i, j)
+		
+		for j in (cj - r, cj + r):
+			if jmin <= j <= jmax:
+				for i in range(max(ci - r + 1, imin), min(ci + r - 1, imax) + 1):
+					yield (i, j)
+	
+	def _bound(self, loc, ci, cj, r):
+		"""Returns the minimum distance (in km) from 'loc' to any location outside the cells within 'r' cells from cell (ci, cj)
+		"""
+		dlat = min(loc[0] - ((ci - r) * self.cell), ((ci + r + 1) * self.cell) - loc[0])
+		dlon = min(loc[1] - ((cj - r) * self.cell), ((cj + r + 1) * self.cell) - loc[1])
+		
+		# the distance to a meridian 'dlon' degrees away is smallest along the great circle perpendicular to it
+		across = math.asin(min(1., math.cos(math.radians(loc[0])) * math.sin(math.radians(min(dlon, 90.)))))
+		return earth_radius * min(math.radians(dlat), across)
+	
+	def nearest(self, net, loc, num, codes=None, filter=None):
+		"""Find the 'num' stations on the given network nearest to the location 'loc' (a (latitude, longitude) pair),
+		by great-circle distance. If 'codes' (a dict or set) is given, only the stations with these codes are considered.
+		The grid-cells are searched in rings around the location's cell, until no station outside the searched cells
+		can be nearer than the 'num'-th nearest station found. (The grid does not wrap around at the date-line)
+		Results are memoised per location (rounded to StationCatalog.quantum degrees), 'num', 'filter' (e.g. the
+		channel-filter the 'codes' were selected with) and set of 'codes'.
+		Returns a tuple of a list of station-codes, nearest first, and an array of their distances (in km)
+		(May raise KeyError, if 'codes' contains unknown stations)
+		"""
+		s = self.get(net)
+		if (codes != None) and (type(codes) not in (types.DictType, set, frozenset)):
+			codes = set(codes)
+		
+		if codes != None:
+			key = (net, int(round(loc[0] / self.quantum)), int(round(loc[1] / self.quantum)), num, filter, frozenset(codes))
+		else:
+			key = (net, int(round(loc[0] / self.quantum)), int(round(loc[1] / self.quantum)), num, filter, None)
+		
+		with self.lock:
+			memo = self.memo.get(key)
+		
+		if memo != None:
+			(closest, distances) = memo
+			return (closest[:], distances)
+		
+		if num < 1 or not len(s['codes']):
+			return ([], numpy.zeros(0))
+		
+		if codes != None:
+			rows = numpy.fromiter(map(s['index'].__getitem__, codes), int, len(codes))
+		else:
+			rows = numpy.arange(len(s['codes']))
+		
+		(imin, imax, jmin, jmax) = s['extent']
+		ci = int(math.floor(loc[0] / self.cell))
+		cj = int(math.floor(loc[1] / self.cell))
+		
+		if len(rows) <= self.exhaustive:
+			rows = [rows]
+			dists = [gcdist(loc, s['locs'][rows[0]])]
+			found = len(rows[0])
+			r = None
+		else:
+			mask = None
+			if codes != None:
+				mask = numpy.zeros(len(s['codes']), dtype=bool)
+				mask[rows] = True
+			
+			rows = []
+			dists = []
+			found = 0
+			# start at the first ring that reaches the grid
+			r = max(0, imin - ci, ci - imax, jmin - cj, cj - jmax)
+		
+		while r != None:
+			for cell in self._ring(ci, cj, r, s['extent']):
+				cellrows = s['grid'].get(cell)
+				if cellrows is None:
+					continue
+				if mask is not None:
+					cellrows = cellrows[mask[cellrows]]
+				if len(cellrows):
+					rows.append(cellrows)
+					dists.append(gcdist(loc, s['locs'][cellrows]))
+					found += len(cellrows)
+			
+			covered = (ci - r <= imin) and (ci + r >= imax) and (cj - r <= jmin) and (cj + r >= jmax)
+			if found >= num:
+				d = numpy.concatenate(dists)
+				kth = numpy.partition(d, num - 1)[num - 1]
+				if kth <= self._bound(loc, ci, cj, r):
+					break
+			
+			if covered:
+				break
+			
+			r += 1
+		
+		if not found:
+			result = ([], numpy.zeros(0))
+		else:
+			rows = numpy.concatenate(rows)
+			d = numpy.concatenate(dists)
+			if len(d) > num:
+				idxes = numpy.argpartition(d, num - 1)[:num]
+			else:
+				idxes = numpy.arange(len(d))
+			idxes = idxes[d[idxes].argsort()]
+			result = ([s['codes'][i] for i in rows[idxes]], d[idxes])
+		
+		with self.lock:
+			if len(self.memo) >= self.maxmemo:
+				self.memo = {}
+			if self.nets.get(net) is s:
+				self.memo[key] = result
+		
+		return (result[0][:], result[1])
+	
+	def get(self, net):
+		"""Returns a snapshot of the given network's station-list; a dict with the station-'codes' (a list),
+		the 'index' of each code in that list (a dict), their 'locs' (an array of (latitude, longitude) pairs)
+		and the time (seconds since the Epoch) the list was 'fetched' in full (or 'None')
+		"""
+		with self.lock:
+			if net not in self.nets:
+				self.nets[net] = self._stationList([], {}, numpy.zeros((0, 2)), None)
+			return self.nets[net]
+	
+	def count(self, net):
+		"""Returns the number of known stations on the given network
+		"""
+		return len(self.get(net)['codes'])
+	
+	def unknown(self, net, codes):
+		"""Returns a list of the given station-codes that are not (yet) known on the given network
+		"""
+		index = self.get(net)['index']
+		return [code for code in codes if code not in index]
+	
+	def isStale(self, net):
+		"""Returns 'True' if the given network's station-list has not been fetched in full within the last StationCatalog.ttl
+		"""
+		fetched = self.get(net)['fetched']
+		if fetched == None:
+			return True
+		
+		ttl = (self.ttl.days * 86400.) + self.ttl.seconds
+		return (time.time() - fetched) > ttl
+	
+	def locations(self, net, codes):
+		"""Returns an (N x 2) array of the locations of the given (known) stations
+		(May raise KeyError)
+		"""
+		s = self.get(net)
+		return s['locs'].take([s['index'][code] for code in codes], axis=0)
+	
+	def update(self, net, stations, complete=False, fetched=None):
+		"""Add the given stations (a dict of (latitude, longitude) pairs, indexed by station-code) to the given network's
+		station-list, or update their locations.
+		If 'complete' == True, the given stations are the network's full station-list; any other stations are removed,
+		and the list's 'fetched' time is set to 'fetched' (or to now)
+		Returns the number of stations added
+		"""
+		with self.lock:
+			old = self.nets.get(net)
+			if old == None:
+				old = self._stationList([], {}, numpy.zeros((0, 2)), None)
+			
+			if complete:
+				codes = sorted(stations.keys())
+				index = dict([(code, i) for (i, code) in enumerate(codes)])
+				locs = numpy.array([stations[code][:2] for code in codes], dtype=numpy.float64).reshape((len(codes), 2))
+				if fetched == None:
+					fetched = time.time()
+				added = len([code for code in codes if code not in old['index']])
+			
+			else:
+				codes = old['codes'][:]
+				index = old['index'].copy()
+				new = [code for code in sorted(stations.keys()) if code not in index]
+				for code in new:
+					index[code] = len(codes)
+					codes.append(code)
+				
+				locs = numpy.empty((len(codes), 2), dtype=numpy.float64)
+				locs[:len(old['codes'])] = old['locs']
+				for (code, loc) in stations.items():
+					locs[index[code]] = loc[:2]
+				
+				fetched = old['fetched']
+				added = len(new)
+			
+			self.nets[net] = self._stationList(codes, index, locs, fetched)
+			self.memo = {}
+		
+		return added
+	
+	def load(self):
+		"""Load the saved station-lists from the cachedir (if any)
+		Returns a dict with the number of stations loaded per network
+		(May raise IOError or ValueError)
+		"""
+		loaded = {}
+		if self.cachedir == None:
+			return loaded
+		
+		for net in netgroup.keys():
+			cachefile = self._cachefile(net)
+			if not os.path.isfile(cachefile):
+				continue
+			
+			stations = {}
+			fetched = None
+			f = open(cachefile)
+			try:
+				for line in f:
+					tokens = line.split()
+					if not len(tokens):
+						continue
+					
+					if tokens[0] == '#':
+						if tokens[1] == 'fetched':
+							fetched = float(tokens[2])
+						continue
+					
+					stations[tokens[0]] = (float(tokens[1]), float(tokens[2]))
+			finally:
+				f.close()
+			
+			if fetched != None:
+				self.update(net, stations, True, fetched)
+			else:
+				self.update(net, stations)
+			
+			loaded[net] = len(stations)
+		
+		return loaded
+	
+	def save(self, net):
+		"""Save the given network's station-list in the cachedir (if any)
+		(May raise IOError or OSError)
+		"""
+		if self.cachedir == None:
+			return
+		
+		if not os.path.isdir(self.cachedir):
+			os.makedirs(self.cachedir)
+		
+		s = self.get(net)
+		cachefile = self._cachefile(net)
+		tmpfile = "%s.tmp" % cachefile
+		f = open(tmpfile, 'w')
+		try:
+			f.write("# %s stations: %d\n" % (net, len(s['codes'])))
+			if s['fetched'] != None:
+				f.write("# fetched %.0f\n" % s['fetched'])
+			for (code, loc) in zip(s['codes'], s['locs']):
+				f.write("%s %.4f %.4f\n" % (code, loc[0], loc[1]))
+		finally:
+			f.close()
+		
+		os.rename(tmpfile, cachefile)
+
+
 ###
-# Global functions
+# Availability cache
 ###
 
-def arstr(a, p=3) :
-	"""Returns a string-representation of a numpy-array.
-	
-	This is simply a wrapper around numpy.array2string()
+class AvailCache(object):
+	"""A cache of the seismograms available for each event, per channel(s), shared by the StpWrappers of an StpRunner.
+	Only non-empty results are cached, so a retry of an event only asks the datacenter for the channel(s) that had
+	no seismograms available yet. The entries for an event expire AvailCache.maxage after they were fetched
+	(when more stations may have reported data), or when the event is dropped.
 	"""
-	return numpy.array2string(a, precision=p, suppress_small=True)
-
-def veclen(a, axis=0) :
-	"""Returns the length of a vector, or array of vectors
+	# cached availability expires after this period of time
+	maxage = datetime.timedelta(0, 600)
 	
-	This is simply a wrapper around numpy.ma.hypot.reduce()
+	def __init__(self, maxage=None):
+		"""Instantiate an AvailCache.
+		'maxage' (a 'timedelta' object) the period of time after which cached availability expires
+		"""
+		if maxage != None:
+			self.maxage = maxage
+		
+		# a dict of per-event dicts of (available seismograms, fetch-time) tuples per channel(s), indexed by (net, Event-ID)
+		self.events = {}
+		self.lock = threading.Lock()
+		
+		self.hits = 0
+		self.misses = 0
+	
+	def put(self, net, ev_id, chan, avail):
+		"""Store the seismograms available for the given event on the given channel(s);
+		a dict of lists of dicts with the 'chan', 'time' and 'dur' (and 'loc') of each seismogram, indexed by station
+		"""
+		if not len(avail):
+			return
+		
+		with self.lock:
+			self.events.setdefault((net, ev_id), {})[chan] = (avail, datetime.datetime.utcnow())
+	
+	def missing(self, net, ev_id, channels):
+		"""Returns a list of the given channel(s) for which there is no (unexpired) cached availability for the given event
+		"""
+		old = datetime.datetime.utcnow() - self.maxage
+		missing = []
+		with self.lock:
+			cached = self.events.get((net, ev_id), {})
+			for chan in channels:
+				if (chan in cached) and (cached[chan][1] >= old):
+					self.hits += 1
+				else:
+					self.misses += 1
+					missing.append(chan)
+		
+		return missing
+	
+	def get(self, net, ev_id, channels):
+		"""Returns the cached seismograms available for the given event on the given channel(s), merged into one dict
+		indexed by station
+		"""
+		avail = {}
+		with self.lock:
+			cached = self.events.get((net, ev_id), {})
+			for chan in channels:
+				if chan not in cached:
+					continue
+				
+				for (station, waves) in cached[chan][0].items():
+					avail.setdefault(station, []).extend(waves)
+		
+		return avail
+	
+	def drop(self, net, ev_id):
+		"""Remove the cached availability for the given event
+		"""
+		with self.lock:
+			self.events.pop((net, ev_id), None)
+	
+	def expire(self):
+		"""Remove all expired entries
+		"""
+		old = datetime.datetime.utcnow() - self.maxage
+		with self.lock:
+			for (key, cached) in self.events.items():
+				for (chan, (avail, fetched)) in cached.items():
+					if fetched < old:
+						del cached[chan]
+				
+				if not len(cached):
+					del self.events[key]
+	
+	def count(self):
+		"""Returns the number of events with cached availability
+		"""
+		with self.lock:
+			return len(self.events)
+
+
+###
+# Parallel seismogram-fetching
+###
+
+class FetchPlanner(object):
+	"""Spreads the 'TRIG' commands for an event's seismograms over several STP sessions, which download them concurrently.
+	The number of sessions fetching seismograms at the same time from each STP server group (i.e. datacenter) is capped,
+	across all StpWrappers sharing the FetchPlanner. The StpWrapper's own session counts against the cap too; a fetch
+	waits (without blocking its thread) until a session is released when the cap is exhausted.
 	"""
-	return numpy.ma.hypot.reduce(a, axis)
+	# default max number of concurrent fetching sessions per STP server group
+	maxfetch = 3
+	
+	def __init__(self, maxfetch=None, caps=None):
+		"""Instantiate a FetchPlanner.
+		'maxfetch' is the max number of concurrent fetching sessions per STP server group,
+		'caps' a dict of the max number of concurrent fetching sessions for specific STP server groups
+		"""
+		if maxfetch != None:
+			self.maxfetch = maxfetch
+		
+		self.caps = {}
+		if type(caps) == types.DictType:
+			self.caps.update(caps)
+		
+		# the number of sessions currently fetching, per STP server group
+		self.busy = {}
+		# a list of (StpRequest, number of sessions) tuples of the fetches waiting for sessions, per STP server group
+		self.waiters = {}
+		self.lock = threading.Lock()
+	
+	def cap(self, group):
+		"""Returns the max number of concurrent fetching sessions for the given STP server group
+		"""
+		return max(1, self.caps.get(group, self.maxfetch))
+	
+	def _claim(self, group, num):
+		"""Claim up to 'num' fetching sessions for the given STP server group, as far as its cap allows (while holding
+		the lock). Returns the number of sessions claimed
+		"""
+		busy = self.busy.get(group, 0)
+		num = max(0, min(num, self.cap(group) - busy))
+		self.busy[group] = busy + num
+		return num
+	
+	def acquire(self, group, num):
+		"""Claim up to 'num' fetching sessions (at least 1) for the given STP server group, as far as its cap allows.
+		Returns an StpRequest that completes with the number of sessions claimed; right away if any are free,
+		or else when another fetch releases some (see release())
+		"""
+		req = StpRequest()
+		with self.lock:
+			got = self._claim(group, max(1, num))
+			if got == 0:
+				self.waiters.setdefault(group, []).append((req, max(1, num)))
+				return req
+		
+		req.finish(got)
+		return req
+	
+	def release(self, group, num):
+		"""Give back 'num' fetching sessions for the given STP server group, and hand them to the fetches waiting for them
+		"""
+		ready = []
+		with self.lock:
+			self.busy[group] = max(0, self.busy.get(group, 0) - num)
+			waiters = self.waiters.get(group, [])
+			while len(waiters):
+				got = self._claim(group, waiters[0][1])
+				if got == 0:
+					break
+				
+				ready.append((waiters.pop(0)[0], got))
+		
+		for (req, got) in ready:
+			req.finish(got)
+	
+	def plan(self, cmds, num):
+		"""Split a list of commands into (at most) 'num' lists of (nearly) equal length.
+		Returns a list of lists of commands
+		"""
+		num = max(1, min(num, len(cmds)))
+		return [cmds[i::num] for i in range(num)]
+
 
 ###
-# Error class
+# Retry scheduling
 ###
 
-class StpError(BaseException):
-	def __init__(self, code, msg):
-		self.code = code
-		self.message = msg
+class RetryScheduler(object):
+	"""Keeps the events that have to be retried, in a heap ordered by the time their next attempt is due.
+	The delay before the next attempt depends on the reason of the failure, and grows exponentially with the number
+	of attempts, with some random jitter (so events that failed together are not all retried at once).
+	An event is given up on when its retry-period (counted from its first failure) has expired.
+	"""
+	# the delay (in seconds) after the first failure, the factor by which it grows with each next failure,
+	# and the max delay (in seconds), per reason of failure
+	policies = {'connect':(30., 2., 900.),		# failed to connect to the datacenter
+				'error':(30., 2., 900.),		# failed to process the event
+				'noevent':(300., 1.5, 3600.),	# the datacenter has no data for the event (yet)
+				'nostations':(300., 1.5, 3600.),	# no stations have data for the event (yet)
+				'noseismograms':(300., 1.5, 3600.)}	# no seismograms were downloaded (yet)
+	# the max random deviation from the delay, as a fraction of the delay
+	jitter = 0.1
+	# the period of time after the first failure after which an event is given up on
+	period = datetime.timedelta(1)
+	
+	def __init__(self, period=None):
+		"""Instantiate a RetryScheduler.
+		'period' (a 'timedelta' object) is the period of time after which events are given up on
+		"""
+		if period != None:
+			self.period = period
 		
-	def __str__(self):
-		out = ""
-		if self.code != 0:
-			out += "STP Error: "
-		out += self.message
-		if self.code != 0:
-			out += " [exit-code %d]" % self.code
+		# a heap of (due-time, sequence-nr, event-ID) tuples
+		self.heap = []
+		self.seq = 0
+		# the scheduled events; (due-time, event, arguments) tuples, per event-ID
+		self.pending = {}
+		# the time of the first failure, and the number of failures, per event-ID
+		self.failures = {}
+		self.rnd = random.Random()
+		self.lock = threading.Lock()
+		self.closed = False
+	
+	def __contains__(self, ev_id):
+		with self.lock:
+			return ev_id in self.pending
+	
+	def __len__(self):
+		with self.lock:
+			return len(self.pending)
+	
+	def _push(self, due, ev, args):
+		self.seq += 1
+		heapq.heappush(self.heap, (due, self.seq, ev['id']))
+		self.pending[ev['id']] = (due, ev, args)
+	
+	def schedule(self, ev, reason, args=()):
+		"""Schedule the next attempt for an event that failed for the given reason (one of the keys of 'policies').
+		'args' is a (hashable) tuple of the arguments to process the event with (see StpRunner.runStp()).
+		Returns the delay (in seconds) until the next attempt, or 'None' if the event's retry-period has expired,
+		or the scheduler is closed (see close())
+		"""
+		(first, factor, maxdelay) = self.policies.get(reason, self.policies['error'])
+		now = time.time()
+		with self.lock:
+			if self.closed:
+				return None
+			
+			(since, attempts) = self.failures.get(ev['id'], (now, 0))
+			end = since + self.period.days * 86400. + self.period.seconds
+			if now >= end:
+				self.failures.pop(ev['id'], None)
+				return None
+			
+			delay = min(maxdelay, first * factor**attempts)
+			delay *= 1. + self.rnd.uniform(-self.jitter, self.jitter)
+			delay = min(delay, end - now)
+			
+			self.failures[ev['id']] = (since, attempts + 1)
+			self._push(now + delay, ev, args)
+		
+		return delay
+	
+	def forget(self, ev_id):
+		"""Remove an event (that was downloaded, or is no longer of interest) from the scheduler
+		Returns 'True' if the event was waiting to be retried
+		"""
+		with self.lock:
+			self.failures.pop(ev_id, None)
+			return self.pending.pop(ev_id, None) != None
+	
+	def due(self):
+		"""Take the events whose next attempt is due out of the scheduler.
+		Returns a list of (event, arguments) tuples
+		"""
+		now = time.time()
+		out = []
+		with self.lock:
+			while len(self.heap) and (self.heap[0][0] <= now) and not self.closed:
+				(due, seq, ev_id) = heapq.heappop(self.heap)
+				if (ev_id in self.pending) and (self.pending[ev_id][0] == due):	# skip entries that were re-scheduled or forgotten
+					(due, ev, args) = self.pending.pop(ev_id)
+					out.append((ev, args))
 		
 		return out
+	
+	def close(self):
+		"""Drop all events, and stop handing out due events
+		"""
+		with self.lock:
+			self.closed = True
+			self.heap = []
+			self.pending = {}
+			self.failures = {}
+
+
+###
+# Event work-queue
+###
+
+class EventQueue(object):
+	"""A priority-queue of the events waiting to be processed, from which a fixed pool of StpWrappers (workers) take their
+	work. An event is queued only once; events that are waiting, or being processed by a worker, are not queued again.
+	Events are ranked by their magnitude, their age and their distance to Parkfield (see priority()). A worker takes the
+	highest-ranked event, plus up to 'batch' - 1 more of the highest-ranked events on the same network, so it can ask
+	for their available seismograms at once (see StpWrapper._processAsync())
+	"""
+	# the priority gained per unit of magnitude, and lost per hour of age and per 100 km of distance to Parkfield
+	magweight = 1.
+	ageweight = 0.5
+	distweight = 0.5
+	# the max number of events a worker takes at once
+	batch = 4
+	
+	def __init__(self):
+		"""Instantiate an (empty) EventQueue
+		"""
+		# a heap of (-priority, sequence-nr, event, arguments) tuples per network
+		self.heaps = {}
+		self.seq = 0
+		# the network of each waiting event, and the name of the worker processing each event in process, per event-ID
+		self.queued = {}
+		self.inflight = {}
+		# a list of (worker-name, StpRequest) tuples of the workers waiting for work
+		self.waiters = []
+		# the IDs of the events that have been downloaded
+		self.completed = set()
+		# the (-priority, event, arguments) tuples of the events that were queued again while in process, per event-ID.
+		# They are queued when their worker is done with them (see done())
+		self.again = {}
+		self.lock = threading.Lock()
+		self.closed = False
+	
+	def __contains__(self, ev_id):
+		with self.lock:
+			return (ev_id in self.queued) or (ev_id in self.inflight)
+	
+	def state(self, ev_id):
+		"""Returns the state of the event with the given ID; 'queued', 'inflight', 'done' (downloaded) or 'None'
+		"""
+		with self.lock:
+			if ev_id in self.queued:
+				return 'queued'
+			if ev_id in self.inflight:
+				return 'inflight'
+			if ev_id in self.completed:
+				return 'done'
+		
+		return None
+	
+	def __len__(self):
+		with self.lock:
+			return len(self.queued)
+	
+	def busy(self):
+		"""Returns 'True' if any events are waiting or in process
+		"""
+		with self.lock:
+			return (len(self.queued) + len(self.inflight)) > 0
+	
+	def priority(self, ev):
+		"""Returns the priority of an event; bigger, more recent events, closer to Parkfield, go first.
+		The age-term is counted from the event's (absolute) time, so events queued at different times rank consistently
+		"""
+		prio = self.magweight * ev.get('mag', 0.)
+		if 'time' in ev:
+			prio += self.ageweight * ev['time'] / 3600.
+		if 'loc' in ev:
+			prio -= self.distweight * float(gcdist(parkfield, ev['loc'])) / 100.
+		
+		return prio
+	
+	def put(self, events, args=()):
+		"""Queue the given events, unless they are queued already. Events that are in process are queued again
+		when their worker is done with them, unless they were downloaded.
+		'args' is a (hashable) tuple of the arguments to process the events with (see StpRunner.runStp())
+		Returns the number of events queued
+		"""
+		entries = [(-self.priority(ev), ev, args) for ev in events]
+		num = 0
+		with self.lock:
+			if self.closed:
+				return 0
+			
+			for (prio, ev, args) in entries:
+				if ev['id'] in self.queued:
+					continue
+				
+				if ev['id'] in self.inflight:
+					self.again[ev['id']] = (prio, ev, args)
+					continue
+				
+				self._push(prio, ev, args)
+				num += 1
+			
+			ready = self._dispatch()
+		
+		for (req, work) in ready:
+			req.finish(work)
+		
+		return num
+	
+	def _push(self, prio, ev, args):
+		"""Queue an event (while holding the lock)
+		"""
+		self.seq += 1
+		heapq.heappush(self.heaps.setdefault(ev['net'], []), (prio, self.seq, ev, args))
+		self.queued[ev['id']] = ev['net']
+	
+	def _next(self, name):
+		"""Take the next batch of work out of the queue, for the given worker.
+		Returns an (events, arguments) tuple, or 'None' if the queue is empty
+		"""
+		best = None
+		for heap in self.heaps.values():
+			if len(heap) and ((best == None) or (heap[0] < best[0])):
+				best = heap
+		
+		if best == None:
+			return None
+		
+		(prio, seq, ev, args) = heapq.heappop(best)
+		events = [ev]
+		while len(best) and (len(events) < self.batch) and (best[0][3] == args):
+			events.append(heapq.heappop(best)[2])
+		
+		for ev in events:
+			del self.queued[ev['id']]
+			self.inflight[ev['id']] = name
+		
+		return (events, args)
+	
+	def _dispatch(self):
+		"""Hand out work to the waiting workers (while holding the lock).
+		Returns a list of (StpRequest, work) tuples, for the requests to be completed (outside the lock)
+		"""
+		ready = []
+		while len(self.waiters) and len(self.queued):
+			(name, req) = self.waiters.pop(0)
+			ready.append((req, self._next(name)))
+		
+		return ready
+	
+	def take(self, name):
+		"""Returns an StpRequest that completes with the next batch of work for the worker with the given name;
+		an (events, arguments) tuple. The request fails with an 'Interrupted' StpError when the queue is closed
+		"""
+		req = StpRequest()
+		work = None
+		with self.lock:
+			if not self.closed:
+				work = self._next(name)
+				if work == None:
+					self.waiters.append((name, req))
+					return req
+		
+		if work == None:
+			req.finish(error=StpError(10, "Interrupted"))
+		else:
+			req.finish(work)
+		
+		return req
+	
+	def done(self, ev_ids, downloaded=()):
+		"""Mark the events with the given IDs as no longer in process,
+		and those that are also in 'downloaded' as done. Events that were queued again while in process are queued now
+		"""
+		with self.lock:
+			for ev_id in ev_ids:
+				self.inflight.pop(ev_id, None)
+				if ev_id in downloaded:
+					self.completed.add(ev_id)
+				
+				entry = self.again.pop(ev_id, None)
+				if (entry != None) and (ev_id not in self.completed) and not self.closed:
+					self._push(*entry)
+			
+			ready = self._dispatch()
+		
+		for (req, work) in ready:
+			req.finish(work)
+	
+	def cancel(self, ev_id):
+		"""Take the event with the given ID out of the queue, if it is waiting.
+		Returns a tuple of the event's state before; 'queued', 'inflight' or 'None', and the name of the worker processing it
+		"""
+		with self.lock:
+			if ev_id in self.inflight:
+				self.again.pop(ev_id, None)
+				return ('inflight', self.inflight[ev_id])
+			
+			net = self.queued.pop(ev_id, None)
+			if net == None:
+				return (None, None)
+			
+			heap = [entry for entry in self.heaps[net] if entry[2]['id'] != ev_id]
+			heapq.heapify(heap)
+			self.heaps[net] = heap
+		
+		return ('queued', None)
+	
+	def forget(self, ev_ids):
+		"""Forget that the events with the given IDs were done (e.g. because their seismograms-dirs were removed)
+		"""
+		with self.lock:
+			self.completed.difference_update(ev_ids)
+	
+	def close(self):
+		"""Drop all waiting events, and stop all waiting workers (their requests fail with an 'Interrupted' StpError)
+		"""
+		with self.lock:
+			self.closed = True
+			self.heaps = {}
+			self.queued = {}
+			self.again = {}
+			waiters = self.waiters
+			self.waiters = []
+		
+		for (name, req) in waiters:
+			req.finish(error=StpError(10, "Interrupted"))
+
 
 ###
 # STP wrapper class
@@ -96,28 +1706,56 @@ class StpWrapper(object):
 	logfd = sys.stdout
 	errfd = sys.stderr
 	
-	# a hierarchy of dicts for storing seismic networks' stations' locations
-	stations = {'CI':{}, 'NC':{}}
+	# the catalog of the seismic networks' stations' locations, shared by all StpWrappers (unless given one)
+	stations = StationCatalog()
+	# the cache of the seismograms available per event, shared by all StpWrappers (unless given one)
+	avails = AvailCache()
 	verbose = 0
 	
 	# Default values
 	defaults = {'retryperiod':datetime.timedelta(1)}
 	
-	def __init__(self, name, qdm_parser=None, stations=None, defaults=None, outputdir=None):
+	# the max number of unknown stations to look up one by one, rather than fetching the full station-list
+	maxlookup = 10
+	
+	# the FetchPlanner that spreads each event's seismogram-downloads over several sessions (or 'None' to use one session)
+	planner = None
+	
+	# the time (in seconds) to download before the P-wave arrival, and after the end of the quake, in trimmed downloads
+	margin = 5.
+	
+	# the RetryScheduler that has failed events retried later
+	retries = None
+	
+	# the total number of requests, commands and round-trips (commands that were waited for) sent by all StpWrappers,
+	# and the number of events downloaded, with the seismogram-bytes they take on disk
+	totals = {'requests':0, 'commands':0, 'roundtrips':0, 'downloads':0, 'download_bytes':0}
+	totals_lock = threading.Lock()
+	
+	def __init__(self, name, qdm_parser=None, stations=None, defaults=None, outputdir=None, pool=None, driver=None, avails=None, planner=None, retries=None):
 		"""Instantiate an StpWrapper. The 'name' argument must be supplied, and should be unique.
 		It is used as a prefix for reported/logged messages
 		The other arguments are 'inherited' from the StpRunner that instantiates the StpWrapper(s)
 		'qdmparser' should be the 'main' QDMParser instance. if not supplied, an(other) QDMParser is instantiated.
-		'stations' should be a hierarchy of dicts containing the seismic networks' stations' locations.
+		'stations' should be the StpRunner's StationCatalog, or a hierarchy of dicts containing the seismic networks' stations' locations.
 			This information is initially retrieved from the networks' datacenters.
 		'defaults' is a dict of 'parameter':<value> pairs. Relevant parameters are:
 			'retryperiod' (a 'timedelta' object) the period of time to keep retring to get data for an Event.
+			'trim' (True / False) download only the part of each seismogram that is played back (see fetchSeismograms()).
 		'outputdir' is the root-dir of the seismograms dir-structure.
+		'pool' is an StpPool from which to lease (and to which to release) connected 'stp' processes.
+			If not supplied, each connect() starts a new 'stp' process, and each disconnect() exits it.
+		'driver' is an StpDriver that executes the 'stp' commands, and runs runStp() (see start()), in its own thread.
+			If not supplied, the commands are executed by the calling thread, and start() runs runStp() in a new thread.
+		'avails' is the AvailCache in which the available seismograms per event are kept.
+		'planner' is the FetchPlanner that spreads each event's seismogram-downloads over several concurrent sessions.
+			If not supplied, all seismograms are downloaded over the StpWrapper's own session, one after the other.
+		'retries' is the RetryScheduler to which events that have to be retried are handed.
+			If not supplied, the StpWrapper has a RetryScheduler of its own, from which the caller takes the events that are
+			due (see RetryScheduler.due())
 		"""
 		self.name = name
-		
-		if not (os.path.exists(self.stpexec) and os.access(self.stpexec, os.X_OK)):
-			raise ValueError("STP Executable '%s' was not found or not executable" % self.stpexec)
+		self._checkExec()
 		
 		if isinstance(qdm_parser, qdmparser.QDMParser):
 			self.qp = qdm_parser
@@ -127,23 +1765,55 @@ class StpWrapper(object):
 		self.stp = None
 		self.net = None
 		self.connected = None
+		self.pool = pool
+		self.driver = driver
+		if isinstance(avails, AvailCache):
+			self.avails = avails
+		if isinstance(planner, FetchPlanner):
+			self.planner = planner
+		if isinstance(retries, RetryScheduler):
+			self.retries = retries
+		
+		# the StpWrappers fetching seismograms alongside this one (see fetchSeismogramsAsync()),
+		# and the number of seismogram-bytes they received during the last fetch
+		self.helpers = []
+		self.helped = 0
+		
+		# the IDs of the events that were dealt with by the last runStp() cycle (see _processAsync()),
+		# and the number of seismograms downloaded for each event in it
+		self.handled = set()
+		self.downloaded = {}
+		
+		# the total length (in seconds) of the windows requested in the last trimmed fetch, and of the available windows
+		self.trimmed = None
+		
+		# the ID of the event being processed, the last StpRequest submitted, and the (cancel()-time, StpRequest) tuples
+		# of the events whose processing is to be cancelled, per event-ID
+		self.processing = None
+		self.active = None
+		self.cancelling = {}
+		self.cancel_lock = threading.Lock()
 		
 		self.thread = None
+		self.task = None
 		self.done = threading.Event()
 		self.run = True
 		
 		# a list for storing rejected events
 		self.rejects = []
 		
-		# copy provided stations-info
-		if type(stations) == types.DictType:
-			for net in netgroup.keys():
-				if (net in stations) and (type(stations[net]) == types.DictType):
-					self.stations[net] = stations[net]
+		# use the provided station-catalog, or a catalog of the provided stations-info
+		if isinstance(stations, StationCatalog):
+			self.stations = stations
+		elif type(stations) == types.DictType:
+			self.stations = StationCatalog(stations=stations)
 				
 		# copy provided defaults
 		if type(defaults) == types.DictType:
 			self.defaults.update(defaults)
+		
+		if self.retries == None:
+			self.retries = RetryScheduler(self.defaults['retryperiod'])
 			
 		# check if provided outputdir exists
 		if outputdir:
@@ -176,7 +1846,7 @@ class StpWrapper(object):
 		"""
 		while self.stp.poll() == None:
 			line = self.stp.stdout.readline()
-				
+			
 			line = line.strip('\n')
 			
 			if not len(line):
@@ -184,10 +1854,10 @@ class StpWrapper(object):
 			
 			if (self.verbose & 1) != 0:
 				self.logMessage("STP: %s" % line)
-				
+			
 			if line.startswith('STP>'):
 				continue
-				
+			
 			break
 		
 		else:
@@ -196,24 +1866,144 @@ class StpWrapper(object):
 			if self.stp.returncode in (-1, -2, -3, -4, -5, -6, -9, -14, -15):	# got signal
 				self.logMessage("STP: Interrupted (%d)" % self.stp.returncode)
 				return None
-			elif self.stp.returncode == -11:	# SEGV
-				raise StpError(-11, "Segfault in %s" % os.path.basename(self.stpexec))
 			elif self.stp.returncode == -8:	# No configfile found
 				thread.interrupt_main()
-				raise StpError(-8, "Config-file '~/.stp' or '%s/.stp' not found" % os.path.dirname(self.stpexec))
-			else:
-				raise StpError(self.stp.returncode, "Disconnected")
 			
+			raise exitError(self.stp.returncode)
+		
 		return line
 	
+	def _command(self, req):
+		"""Send the command(s) of the StpRequest 'req' to the 'stp' process, one after the other (or all at once, if the request
+		is pipelined), and read each command's output up to the request's 'end' line (or up to the exit of the 'stp' process,
+		if 'end' is 'None') into the request's list of output-lines, excluding the 'end' lines.
+		(May raise StpError)
+		"""
+		end = req.end
+		if req.pipeline:
+			out = ""
+			for cmd in req.cmds:
+				if cmd != None:
+					out += "%s\n" % cmd
+			if len(out):
+				self.stp.stdin.write(out)
+			req.sent = len(req.cmds)
+		
+		for cmd in req.cmds:
+			if req.isCancelled():
+				raise StpError(13, "Cancelled")
+			
+			if (cmd != None) and not req.pipeline:
+				self.stp.stdin.write("%s\n" % cmd)
+				req.sent += 1
+			
+			while self.run or (end == None):
+				line = self._readstp()
+				
+				if line == None:
+					if end == None:
+						return
+					raise StpError(10, "Interrupted")
+				
+				if line == end:
+					break
+				
+				req.lines.append(line)
+			
+			else:
+				raise StpError(10, "Interrupted")
+			
+			req.idx += 1
+			req.ends.append(len(req.lines))
+	
+	def _request(self, cmds, parse=None, end='Done', pipeline=False, split=False):
+		"""Returns an StpRequest for the given command(s) (see StpRequest).
+		If this StpWrapper has an StpDriver, the request is submitted to it, and the returned request completes in the background.
+		Otherwise, the request is executed right away.
+		(May raise StpError)
+		"""
+		if (self.stp == None) or (self.stp.returncode != None):
+			raise StpError(1, "Not connected")
+		
+		req = StpRequest(cmds, parse, end, self, pipeline, split)
+		with self.cancel_lock:
+			self.active = req
+			if (self.processing != None) and (self.processing in self.cancelling):
+				req.cancel()
+		
+		sent = [cmd for cmd in cmds if cmd != None]
+		with self.totals_lock:
+			self.totals['requests'] += 1
+			self.totals['commands'] += len(sent)
+			if pipeline:
+				self.totals['roundtrips'] += min(1, len(sent))
+			else:
+				self.totals['roundtrips'] += len(sent)
+		
+		if self.driver != None:
+			return self.driver.submit(self.stp, req)
+		
+		try:
+			self._command(req)
+		except (StpError, IOError), e:
+			req.finish(error=e)
+		else:
+			req.finish()
+		
+		return req
+	
+	def _runSync(self, gen):
+		"""Run a generator that yields StpRequests (see StpTask) in the current thread, until it is done.
+		Returns its result
+		(May raise StpError)
+		"""
+		task = StpTask(gen, self.name)
+		self._runTask(task)
+		
+		if task.error != None:
+			raise task.error
+		
+		return task.value
+	
+	def _runTask(self, task):
+		"""Run the StpTask 'task' in the current thread, until it is done
+		"""
+		req = task.step()
+		while req != None:
+			req.wait()
+			req = task.step(req.value, req.error)
+		
+	def _spawn(self, task):
+		"""Run the StpTask 'task' in the background; by the StpDriver, if this StpWrapper has one, or in a new thread.
+		The task's 'finished' request completes when the task is done
+		"""
+		if self.driver != None:
+			self.driver.spawn(task)
+			return
+		
+		thread = threading.Thread(None, self._runTask, "%sthread" % task.name, [task])
+		thread.setDaemon(True)
+		thread.start()
 	
-	def connect(self, net):
-		"""Start an 'stp' subprocess, connecting to the provided network's STP server group.
-		When connected, may set various STP parameters according to parameters found in StpWrapper.defaults:
-		'verbose' (any value) set verbose mode in the 'stp' program
-		'format' (one of the strings in out_fmts) set downloaded seismograms' file-format
-		'gaincorr' (True / False) set seismogram gain-correction on / off
-		(May raise StpError)
+	
+	def _checkExec(self):
+		"""Check that the 'stp' program can be run
+		(May raise ValueError)
+		"""
+		if not (os.path.exists(self.stpexec) and os.access(self.stpexec, os.X_OK)):
+			raise ValueError("STP Executable '%s' was not found or not executable" % self.stpexec)
+	
+	def _openSession(self, net):
+		"""Start a new session with the given network's STP server group; an 'stp' process.
+		Returns an StpRequest that completes with the session
+		"""
+		args = [self.stpexec, "-d", self.outputdir, netgroup[net]]
+		req = StpRequest()
+		req.finish(subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True))
+		return req
+	
+	def connectAsync(self, net):
+		"""Generator version of connect() (see StpTask)
 		"""
 		if not net in netgroup:
 			raise StpError(4, "Unrecognized netcode: '%s'" % str(net))
@@ -221,82 +2011,143 @@ class StpWrapper(object):
 		if (self.stp != None) and (self.stp.returncode == None):
 			raise StpError(2, "Already connected")
 		
-		args = [self.stpexec, "-d", self.outputdir, netgroup[net]]
-		self.stp = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-	
-		line = ""
-		while self.run and (line != None):
-			line = self._readstp()
-			
-			if line == 'Done':
-				break
+		if self.pool != None:
+			# lease a session from the pool. Each leased session is health-checked with a STATUS command
+			key = self._sessionKey(net)
+			stp = self.pool.lease(key)
+			while stp != None:
+				self.stp = stp
+				try:
+					status = yield self.getStatusAsync()
+					healthy = 'Format' in status
+				except (StpError, IOError):
+					healthy = False
+				
+				if healthy:
+					self.net = net
+					self.connected = datetime.datetime.utcnow()
+					self.avail = {}
+					return
+				
+				self.logMessage("Discarding stale STP session (%s)" % self._sessionStr(stp))
+				if self.driver != None:
+					yield self.driver.detach(stp)
+				self.pool.close(stp)
+				self.stp = None
+				stp = self.pool.lease(key)
 		
-		else:
-			return
+		self.stp = yield self._openSession(net)
+		
+		# wait for the banner
+		try:
+			yield self._request([None])
+		except (StpError, IOError):
+			if self.stp.poll() == None:
+				self.stp.terminate()
+			self._forgetSession()
+			raise
 		
 		self.net = net
 		self.connected = datetime.datetime.utcnow()
 		self.avail = {}
 		
 		if 'verbose' in self.defaults:
-			self.toggleVerbose()
-	
+			yield self.toggleVerboseAsync()
+		
 		if 'format' in self.defaults:
-			self.setFormat(self.defaults['format'])
-	
+			yield self.setFormatAsync(self.defaults['format'])
+		
 		if 'gaincorr' in self.defaults:
-			self.setGainCorr(self.defaults['gaincorr'])
+			yield self.setGainCorrAsync(self.defaults['gaincorr'])
+	
+	def connect(self, net):
+		"""Start an 'stp' subprocess, connecting to the provided network's STP server group.
+		If this StpWrapper has an StpPool, a connected 'stp' process is leased from the pool instead, if the pool has one.
+		When connected, may set various STP parameters according to parameters found in StpWrapper.defaults:
+		'verbose' (any value) set verbose mode in the 'stp' program
+		'format' (one of the strings in out_fmts) set downloaded seismograms' file-format
+		'gaincorr' (True / False) set seismogram gain-correction on / off
+		(May raise StpError)
+		"""
+		self._runSync(self.connectAsync(net))
 	
 	
-	def disconnect(self):
-		"""Disconnect (ie. exit) the 'stp' subprocess
+	def _sessionStr(self, stp):
+		"""Returns a description of an 'stp' process (its PID), or of another session
 		"""
-		if (self.stp == None) or (self.stp.returncode != None):
-			return
-			
-		cmd = 'EXIT'
-		try:
-			self.stp.stdin.write("%s\n" % cmd)
-		except IOError:		# 'Broken pipe' i.e. stp-subprocess was already killed
+		if getattr(stp, 'pid', None) == None:
+			return "session %s" % str(stp)
+		return "PID %d" % stp.pid
+	
+	def _received(self):
+		"""Returns the number of seismogram-bytes received over the current session, if it counts them ('data_bytes'),
+		or 'None' (e.g. for an 'stp' process)
+		"""
+		return getattr(self.stp, 'data_bytes', None)
+	
+	def _sessionKey(self, net):
+		"""Returns the key under which sessions connected to the given network, with the current defaults,
+		are kept in the StpPool
+		"""
+		return (net, self.outputdir, 'verbose' in self.defaults, self.defaults.get('format'), self.defaults.get('gaincorr'))
+	
+	def disconnectAsync(self):
+		"""Generator version of disconnect() (see StpTask)
+		"""
+		if self.stp == None:
 			return
-
-		line = ""
-		while line != None:
-			try:
-				line = self._readstp()
-			except IOError:
-				break
-			except StpError, e:
-				self.logMessage(str(e))
-				break
 		
-		self.connected = None
+		if self.stp.poll() != None:
+			self._forgetSession()
+			return
 		
+		if (self.pool != None) and self.run and (self.net != None):
+			# hand the (idle) session back to the pool, rather than exiting it
+			if self.driver != None:
+				yield self.driver.detach(self.stp)
+			self.connected = None
+			self.pool.release(self._sessionKey(self.net), self.stp)
+			self.stp = None
+			self.net = None
+			return
 		
+		try:
+			yield self._request(['EXIT'], end=None)
+		except IOError:		# 'Broken pipe' i.e. stp-subprocess was already killed
+			pass
+		except StpError, e:
+			self.logMessage(str(e))
 		
-	def getStations(self):
-		"""Request (and parse) a list of stations for the network we're connected to
-		(May raise StpError)
+		self._forgetSession()
+	
+	def _forgetSession(self):
+		"""Forget the 'stp' process this StpWrapper was connected with, once it has exited
 		"""
-		if (self.stp == None) or (self.stp.returncode != None):
-			raise StpError(1, "Not connected")
-			
-		cmd = 'STA -l'
-		self.stp.stdin.write("%s\n" % cmd)
+		self.stp = None
+		self.net = None
+		self.connected = None
+	
+	def disconnect(self):
+		"""Disconnect (ie. exit) the 'stp' subprocess
+		If this StpWrapper has an StpPool, the 'stp' process is released into the pool instead
+		"""
+		self._runSync(self.disconnectAsync())
 	
-		stations = {}
 	
+	def _parseStations(self, lines, complete=False):
+		"""Parse the output of the 'STA' command(s), and add the stations to the StationCatalog for the network we're connected to
+		If 'complete' == True, the output is the network's full station-list, which replaces the one in the catalog.
+		Returns the number of stations
+		(May raise StpError)
+		"""
+		stations = {}
+		
 		count = 0
-		while self.run:
-			line = self._readstp()
-			
-			if (line == 'Done') or (line == None):
-				break
-			
+		for line in lines:
 			tokens = line.split()
 			if tokens[0] == '#':
 				try:
-					count = int(tokens[-1])
+					count += int(tokens[-1])
 				except ValueError, e:
 					raise StpError(8, "Non-int value in '# Number of stations' message: %s" % tokens[-1])
 			
@@ -308,15 +2159,43 @@ class StpWrapper(object):
 						data.append(float(val))
 					except ValueError, e:
 						raise StpError(8, "Non-float value in station '%s' data: %s" % (station, val))
-					
+				
 				stations[station] = data
-	
-		self.stations[self.net].update(stations)
+		
 		if count != len(stations):
 			self.errMessage("Warning: Number of available stations (%d) does not match station-count (%d)" % (count, len(stations)))
 		
+		self.stations.update(self.net, stations, complete)
+		try:
+			self.stations.save(self.net)
+		except (IOError, OSError), e:
+			self.errMessage("Unable to save station-list: %s" % str(e))
+		
 		return len(stations)
 	
+	def getStationsAsync(self, codes=None):
+		"""Asynchronous version of getStations(). Returns an StpRequest
+		(May raise StpError)
+		"""
+		if codes == None:
+			return self._request(['STA -l'], lambda lines: self._parseStations(lines, True))
+		
+		cmds = []
+		for code in codes:
+			if (type(code) not in types.StringTypes) or ('.' not in code):
+				raise StpError(5, "Invalid station '%s'" % str(code))
+			
+			cmds.append('STA -l -net %s -sta %s' % tuple(code.split('.', 1)))
+		
+		return self._request(cmds, self._parseStations)
+	
+	def getStations(self, codes=None):
+		"""Request (and parse) the list of stations for the network we're connected to,
+		or only the stations with the given station-identifiers (strings), if 'codes' is given
+		(May raise StpError)
+		"""
+		return self.getStationsAsync(codes).result()
+
 	def _parseTime(self, time_string):
 		"""Parse a time & date string as present in the 'stp' output
 		returns the time in Python format (floating-point seconds-since-the-epoch)
@@ -343,28 +2222,44 @@ class StpWrapper(object):
 		return d
 		
 	
-	def getEvent(self, event_in):
-		"""Request (and parse) data on one event (dict)
-		returns a dict containing the event metadata as provided by the datacenter
+	def _parseEvent(self, tokens):
+		"""Parse one line (split into tokens) of the output of the 'EVENT' command
+		returns a dict containing the event metadata
 		(May raise StpError)
 		"""
-		if (self.stp == None) or (self.stp.returncode != None):
-			raise StpError(1, "Not connected")
-			
-		if (type(event_in) != types.DictType) or ('id' not in event_in):
-			raise StpError(7, "Invalid event '%s'" % str(event_in))
+		event = {'net':self.net, 'id': tokens[0]}
+		event['type'] = tokens[1]
+		event['time'] = self._parseTime(tokens[2])
+		event['loc'] = []
+		for val in tokens[3:5]:
+			try:
+				event['loc'].append(float(val))
+			except ValueError, e:
+				raise StpError(8, "Non-float value in event '%s' location: %s" % (tokens[0], val))
+		try:
+			event['depth'] = float(tokens[5])
+		except ValueError, e:
+			raise StpError(8, "Non-float value in event '%s' depth: %s" % (tokens[0], tokens[6]))
+		try:
+			event['mag'] = float(tokens[6])
+		except ValueError, e:
+			raise StpError(8, "Non-float value in event '%s' magnitude: %s" % (tokens[0], tokens[6]))
+		event['magtype'] = tokens[7]
+		try:
+			event['qual'] = float(tokens[8])
+		except ValueError, e:
+			raise StpError(8, "Non-float value in event '%s' quality: %s" % (tokens[0], tokens[8]))
 		
-		cmd = 'EVENT -e %s' % str(event_in['id'])
-		self.stp.stdin.write("%s\n" % cmd)
+		return event
 	
-		event_out = {}
+	def _parseEvents(self, lines):
+		"""Parse the output of the 'EVENT' command
+		returns a tuple of the '# Number of events' count, and a dict of dicts containing the events' metadata, indexed by Event-ID
+		(May raise StpError)
+		"""
+		events_out = {}
 		count = 0
-		while self.run:
-			line = self._readstp()
-			
-			if (line == 'Done') or (line == None):
-				break
-			
+		for line in lines:
 			tokens = line.split()
 			if tokens[0] == '#':
 				try:
@@ -376,34 +2271,40 @@ class StpWrapper(object):
 				continue
 			
 			else:
-				event_out['net'] = self.net
-				event_out['id'] = tokens[0]
-				event_out['type'] = tokens[1]
-				event_out['time'] = self._parseTime(tokens[2])
-				event_out['loc'] = []
-				for val in tokens[3:5]:
-					try:
-						event_out['loc'].append(float(val))
-					except ValueError, e:
-						raise StpError(8, "Non-float value in event '%s' location: %s" % (tokens[0], val))
-				try:	
-					event_out['depth'] = float(tokens[5])
-				except ValueError, e:
-					raise StpError(8, "Non-float value in event '%s' depth: %s" % (tokens[0], tokens[6]))
-				try:	
-					event_out['mag'] = float(tokens[6])
-				except ValueError, e:
-					raise StpError(8, "Non-float value in event '%s' magnitude: %s" % (tokens[0], tokens[6]))
-				event_out['magtype'] = tokens[7]
-				try:	
-					event_out['qual'] = float(tokens[8])
-				except ValueError, e:
-					raise StpError(8, "Non-float value in event '%s' quality: %s" % (tokens[0], tokens[8]))
-				
-		if len(event_out) and (count != 1):
+				event = self._parseEvent(tokens)
+				events_out[event['id']] = event
+		
+		return (count, events_out)
+	
+	def _parseOneEvent(self, lines):
+		"""Parse the output of the 'EVENT' command for one event
+		returns a dict containing the event metadata, or an empty dict if the datacenter has no data for the event
+		(May raise StpError)
+		"""
+		(count, events_out) = self._parseEvents(lines)
+		if not len(events_out):
+			return {}
+		
+		if count != 1:
 			self.errMessage("Warning: Number of available events (%d) does not match count (1)" % count)
 		
-		return event_out
+		return events_out.values()[-1]
+	
+	def getEventAsync(self, event_in):
+		"""Asynchronous version of getEvent(). Returns an StpRequest
+		(May raise StpError)
+		"""
+		if (type(event_in) != types.DictType) or ('id' not in event_in):
+			raise StpError(7, "Invalid event '%s'" % str(event_in))
+		
+		return self._request(['EVENT -e %s' % str(event_in['id'])], self._parseOneEvent)
+	
+	def getEvent(self, event_in):
+		"""Request (and parse) data on one event (dict)
+		returns a dict containing the event metadata as provided by the datacenter
+		(May raise StpError)
+		"""
+		return self.getEventAsync(event_in).result()
 	
 	
 	def getEvents(self, events_in):
@@ -411,9 +2312,6 @@ class StpWrapper(object):
 		returns a list of dicts containing the events' metadata as provided by the datacenter
 		(May raise StpError)
 		"""
-		if (self.stp == None) or (self.stp.returncode != None):
-			raise StpError(1, "Not connected")
-			
 		if type(events_in) != types.ListType:
 			events_in = [events_in]
 		
@@ -423,178 +2321,232 @@ class StpWrapper(object):
 				raise StpError(7, "Invalid event '%s'" % str(ev))
 			
 			cmd += ' %s' % str(ev['id'])
-			
-		self.stp.stdin.write("%s\n" % cmd)
+		
+		(count, events_out) = self._request([cmd], self._parseEvents).result()
+		
+		if len(events_out) and (count != len(events_out)):
+			self.errMessage("Warning: Number of available events (%d) does not match count (%d)" % (count, len(events_out)))
+		
+		return events_out.values()
 	
-		events_out = {}
+	
+	def _checkChannel(self, chan):
+		"""Check a channel-code
+		(May raise StpError)
+		"""
+		if (type(chan) not in types.StringTypes) or (len(chan) > 3)  or ((len(chan) < 3) and '%' not in chan):
+			raise StpError(6, "Invalid channel '%s'" % str(chan))
+		if (len(chan) == 3) and ((chan[1] not in ('H', 'L', '_', '%')) or (chan[2] not in ('E', 'N', 'Z', '2', '3', '_', '%'))):
+			raise StpError(6, "Invalid channel '%s'" % str(chan))
+	
+	def _parseAvail(self, lines):
+		"""Parse the output of an 'EAVAIL' command
+		Returns a dict of lists of the available seismograms (dicts with the 'chan', 'time' and 'dur' (and 'loc') of each),
+		indexed by station
+		(May raise StpError)
+		"""
+		avail = {}
 		count = 0
-		while self.run:
-			line = self._readstp()
-			
-			if (line == 'Done') or (line == None):
-				break
-			
+		for line in lines:
 			tokens = line.split()
 			if tokens[0] == '#':
 				try:
-					count = int(tokens[-1])
+					count += int(tokens[-1])
 				except ValueError, e:
-					raise StpError(8, "Non-int value in '# Number of events' message: %s" % tokens[-1])
-			
-			elif tokens[1] == 'No':
-				continue
+					raise StpError(8, "Non-int value in '# of seismograms' message: %s" % tokens[-1])
 			
 			else:
-				event = {'net':self.net, 'id': tokens[0]}
-				event['type'] = tokens[1]
-				event['time'] = self._parseTime(tokens[2])
-				event['loc'] = []
-				for val in tokens[3:5]:
-					try:
-						event['loc'].append(float(val))
-					except ValueError, e:
-						raise StpError(8, "Non-float value in event '%s' location: %s" % (tokens[0], val))
-				try:	
-					event['depth'] = float(tokens[5])
-				except ValueError, e:
-					raise StpError(8, "Non-float value in event '%s' depth: %s" % (tokens[0], tokens[6]))
-				try:	
-					event['mag'] = float(tokens[6])
-				except ValueError, e:
-					raise StpError(8, "Non-float value in event '%s' magnitude: %s" % (tokens[0], tokens[6]))
-				event['magtype'] = tokens[7]
-				try:	
-					event['qual'] = float(tokens[8])
-				except ValueError, e:
-					raise StpError(8, "Non-float value in event '%s' quality: %s" % (tokens[0], tokens[8]))
+				station = "%s.%s" % (tokens[0], tokens[1])
+				wave = {'chan':tokens[2]}
+				if tokens[3] not in ('T', 'C'):
+					wave['loc'] = tokens.pop(3)	# location-code
 				
-				events_out[event['id']] = event
+				wave['time'] = self._parseTime(tokens[-2])
+				wave['dur'] = self._parseDuration(tokens[-1])
+				if station in avail:
+					avail[station].append(wave)
+				else:
+					avail[station] = [wave]
 		
-		if len(events_out) and (count != len(events_out)):
-			self.errMessage("Warning: Number of available events (%d) does not match count (%d)" % (count, len(self.events)))
+		cnt = self._countAvail(avail)
+		if count != cnt:
+			self.errMessage("Warning: Number of available seismograms (%d) does not match count (%d)" % (count, cnt))
 		
-		return events_out.values()
+		return avail
 	
+	def _countAvail(self, avail):
+		cnt = 0
+		for l in avail.values():
+			cnt += len(l)
+		
+		return cnt
 	
-	def getAvail(self, event, channels='H%'):
-		"""Request a list of available seismograms for the given event, on the provided channels
-		'event' is a dict with Event metadata
-		'channels' can be a string or a list of strings containg (a) three-letter channel-code(s),
-		or (a) channel-code(s) containing the '%' or '_' wildcards (see the STP manual)
+	def _availRequest(self, events, channels, result):
+		"""Returns an StpRequest for the seismograms available for the given events on the given channels, that are not
+		in the AvailCache yet. All 'EAVAIL' commands are pipelined, so they take a single round-trip.
+		The results are stored in the AvailCache. The request's result is the return-value of the function 'result',
+		which is called once the AvailCache is up-to-date
 		(May raise StpError)
 		"""
-		if (self.stp == None) or (self.stp.returncode != None):
-			raise StpError(1, "Not connected")
-			
-		if (type(event) != types.DictType) or ('id' not in event):
-			raise StpError(7, "Invalid event '%s'" % str(event))
-		
 		if type(channels) != types.ListType:
 			channels = [channels]
 		
-		count = 0
 		for chan in channels:
-			if (type(chan) not in types.StringTypes) or (len(chan) > 3)  or ((len(chan) < 3) and '%' not in chan):
-				raise StpError(6, "Invalid channel '%s'" % str(chan))
-			if (len(chan) == 3) and ((chan[1] not in ('H', 'L', '_', '%')) or (chan[2] not in ('E', 'N', 'Z', '2', '3', '_', '%'))):
-				raise StpError(6, "Invalid channel '%s'" % str(chan))
+			self._checkChannel(chan)
 		
-			cmd = 'EAVAIL -l -chan %s %s' % (chan, event['id'])
-			self.stp.stdin.write("%s\n" % cmd)
-		
-			while self.run:
-				line = self._readstp()
-				
-				if (line == 'Done') or (line == None):
-					break
-				
-				tokens = line.split()
-				if tokens[0] == '#':
-					try:
-						count += int(tokens[-1])
-					except ValueError, e:
-						raise StpError(8, "Non-int value in '# of seismograms' message: %s" % tokens[-1])
-				
-				else:
-					station = "%s.%s" % (tokens[0], tokens[1])
-					wave = {'chan':tokens[2]}
-					if tokens[3] not in ('T', 'C'):
-						wave['loc'] = tokens.pop(3)	# location-code
-						
-					wave['time'] = self._parseTime(tokens[-2])
-					wave['dur'] = self._parseDuration(tokens[-1])
-					if station in self.avail:
-						self.avail[station].append(wave)
-					else:
-						self.avail[station] = [wave]
+		net = self.net
+		keys = []
+		cmds = []
+		for ev in events:
+			if (type(ev) != types.DictType) or ('id' not in ev):
+				raise StpError(7, "Invalid event '%s'" % str(ev))
+			
+			for chan in self.avails.missing(net, ev['id'], channels):
+				keys.append((ev['id'], chan))
+				cmds.append('EAVAIL -l -chan %s %s' % (chan, ev['id']))
 		
-		cnt = 0
-		for l in self.avail.values():
-			cnt += len(l)
+		if not len(cmds):
+			req = StpRequest()
+			req.finish(result())
+			return req
 		
-		if count != cnt:
-			self.errMessage("Warning: Number of available seismograms (%d) does not match count (%d)" % (count, cnt))
+		def parse(outputs):
+			for ((ev_id, chan), lines) in zip(keys, outputs):
+				self.avails.put(net, ev_id, chan, self._parseAvail(lines))
+			
+			return result()
 		
-		return cnt
+		return self._request(cmds, parse, pipeline=True, split=True)
 	
+	def getAvailsAsync(self, events, channels='H%'):
+		"""Asynchronous version of getAvails(). Returns an StpRequest
+		(May raise StpError)
+		"""
+		if type(events) != types.ListType:
+			events = [events]
+		
+		if type(channels) != types.ListType:
+			channels = [channels]
+		
+		net = self.net
+		def result():
+			counts = {}
+			for ev in events:
+				counts[ev['id']] = self._countAvail(self.avails.get(net, ev['id'], channels))
+			
+			return counts
+		
+		return self._availRequest(events, channels, result)
 	
-	def getClosest(self, event, num=1, channels='H%'):
-		"""Returns a list of station-identifiers for the 'num' station(s), that have
-		data available for the given event, closest to the given event.
-		'event' is a dict with Event metadata
-		'num' is an integer >= 1
+	def getAvails(self, events, channels='H%'):
+		"""Request the available seismograms for the given events, on the provided channels, in one round-trip.
+		Only the events & channels that are not in the AvailCache are requested from the datacenter.
+		'events' is a list of dicts with Event metadata
 		'channels' can be a string or a list of strings containg (a) three-letter channel-code(s),
 		or (a) channel-code(s) containing the '%' or '_' wildcards (see the STP manual)
+		Returns a dict with the number of available seismograms, indexed by Event-ID
 		(May raise StpError)
 		"""
-		if (self.stp == None) or (self.stp.returncode != None):
-			raise StpError(1, "Not connected")
-		
-		if not len(self.avail):
-			self.getAvail(event, channels)
-		if not len(self.avail):
-			return []
+		return self.getAvailsAsync(events, channels).result()
+	
+	def getAvailAsync(self, event, channels='H%'):
+		"""Asynchronous version of getAvail(). Returns an StpRequest
+		(May raise StpError)
+		"""
+		if (type(event) != types.DictType) or ('id' not in event):
+			raise StpError(7, "Invalid event '%s'" % str(event))
 		
-		stations = {}
-		for sta in self.avail.keys():
-			if sta not in self.stations[self.net]:
-				if len(self.stations[self.net]):
-					self.errMessage("Warning: Unknown station '%s'. re-fetching stations-list." % sta)
-					
-				self.getStations()
-				if sta not in self.stations[self.net]:
-					raise StpError(5, "Unknown station '%s'" % sta)
-				
-			stations[sta] = self.stations[self.net][sta]
+		if type(channels) != types.ListType:
+			channels = [channels]
 		
-		if num > len(stations):
-			num = len(stations)
+		net = self.net
+		def result():
+			self.avail = self.avails.get(net, event['id'], channels)
+			return self._countAvail(self.avail)
 		
-		positions = numpy.array(stations.values())
-		codes = numpy.array(stations.keys())
-		distances = veclen(positions - numpy.array(event['loc']), axis=1)
+		return self._availRequest([event], channels, result)
+	
+	def getAvail(self, event, channels='H%'):
+		"""Request a list of available seismograms for the given event, on the provided channels, and keep it in StpWrapper.avail
+		(Cached seismograms are not requested again; see AvailCache)
+		'event' is a dict with Event metadata
+		'channels' can be a string or a list of strings containg (a) three-letter channel-code(s),
+		or (a) channel-code(s) containing the '%' or '_' wildcards (see the STP manual)
+		Returns the number of available seismograms
+		(May raise StpError)
+		"""
+		return self.getAvailAsync(event, channels).result()
+	
+	
+	def _closest(self, event, num, channels=None):
+		"""Returns a list of station-identifiers for the 'num' station(s) in StpWrapper.avail closest to the given event.
+		'channels' are the channel(s) StpWrapper.avail was requested for
+		"""
+		if type(channels) == types.ListType:
+			channels = tuple(channels)
 		
-		idxes = distances.argsort()
+		(closest, distances) = self.stations.nearest(self.net, event['loc'], num, self.avail, channels)
 		
 		if (self.verbose & 8) != 0:
-			self.logMessage("Distances:\n%s" % arstr(distances.take(idxes)))
+			self.logMessage("Distances (km):\n%s" % arstr(distances))
+		
+		return closest
+	
+	def getClosestAsync(self, event, num=1, channels='H%'):
+		"""Generator version of getClosest() (see StpTask)
+		"""
+		yield self.getAvailAsync(event, channels)
+		if not len(self.avail):
+			yield []
+			return
 		
-		closest = codes.take(idxes)
+		if self.stations.isStale(self.net):
+			yield self.getStationsAsync()
 		
-		return closest[:num].tolist()
+		unknown = self.stations.unknown(self.net, self.avail.keys())
+		if len(unknown):
+			if len(unknown) <= self.maxlookup:
+				self.errMessage("Warning: Unknown station(s) %s. looking up their locations." % str(unknown))
+				yield self.getStationsAsync(unknown)
+			else:
+				self.errMessage("Warning: %d unknown stations. re-fetching stations-list." % len(unknown))
+				yield self.getStationsAsync()
+			
+			unknown = self.stations.unknown(self.net, unknown)
+			if len(unknown):
+				raise StpError(5, "Unknown station '%s'" % unknown[0])
 		
+		yield self._closest(event, num, channels)
 	
-	def getSeismograms(self, events, stations, channels='H%'):
-		"""Request to download seismograms for the given event, from the given stations, on the given channels.
+	def getClosest(self, event, num=1, channels='H%'):
+		"""Returns a list of station-identifiers for the 'num' station(s), that have
+		data available for the given event, closest to the given event.
 		'event' is a dict with Event metadata
-		'stations' is a list of station-identifiers (strings)
+		'num' is an integer >= 1
 		'channels' can be a string or a list of strings containg (a) three-letter channel-code(s),
 		or (a) channel-code(s) containing the '%' or '_' wildcards (see the STP manual)
 		(May raise StpError)
 		"""
-		if (self.stp == None) or (self.stp.returncode != None):
-			raise StpError(1, "Not connected")
+		return self._runSync(self.getClosestAsync(event, num, channels))
+	
+	
+	def _countSeismograms(self, ev_ids):
+		"""Count the seismograms downloaded for the events with the given IDs
+		Returns a dict of the number of seismograms, indexed by Event-ID
+		"""
+		cnt = {}
+		for ev_id in ev_ids:
+			ev_dir = os.path.join(self.outputdir, ev_id)
+			if os.path.isdir(ev_dir):
+				cnt[ev_id] = len([name for name in os.listdir(ev_dir) if not name.endswith('.evnt')]) # don't count the <ev_id>.evnt file
 		
+		return cnt
+	
+	def _trigCommands(self, events, stations, channels):
+		"""Returns a list of the 'TRIG' commands for downloading the given events' seismograms from the given stations
+		on the given channels (one command per station & channel), and a list of the events' IDs
+		(May raise StpError)
+		"""
 		if type(events) != types.ListType:
 			events = [events]
 		
@@ -610,7 +2562,8 @@ class StpWrapper(object):
 				raise StpError(7, "Invalid event '%s'" % str(ev))
 			
 			ev_str += " %s" % str(ev['id'])
-				
+		
+		cmds = []
 		for station in stations:
 			if (type(station) not in types.StringTypes) or ('.' not in station):
 				raise StpError(5, "Invalid station '%s'" % str(station))
@@ -618,51 +2571,327 @@ class StpWrapper(object):
 			net, sta = station.split('.')
 			
 			for chan in channels:
-				if (type(chan) not in types.StringTypes) or (len(chan) > 3)  or ((len(chan) < 3) and '%' not in chan):
-					raise StpError(6, "Invalid channel '%s'" % str(chan))
-				if (len(chan) == 3) and ((chan[1] not in ('H', 'L', '_', '%')) or (chan[2] not in ('E', 'N', 'Z', '2', '3', '_', '%'))):
-					raise StpError(6, "Invalid channel '%s'" % str(chan))
+				self._checkChannel(chan)
+				cmds.append("TRIG -net %s -sta %s -chan %s %s" % (net, sta, chan, ev_str))
+		
+		return (cmds, ev_str.split())
+	
+	def _windowCommands(self, event, stations, channels):
+		"""Returns a list of the 'WIN' commands for downloading the part of the given event's seismograms, from the given
+		stations on the given channels, that is played back; from 'margin' seconds before the P-wave arrives at the station,
+		until 'margin' seconds after the quake's duration (see dastrigger.magDuration()) has passed since the S-wave arrived,
+		as far as it lies within the station's available (triggered) window. Also returns a list of the event's ID,
+		and the total length (in seconds) of the requested windows, and of the stations' available windows.
+		Each command is 'WIN -net <net> -sta <sta> -chan <chan> <start-time> <end-time>'. 'WIN' is not tied to an event,
+		so its seismograms are saved in the root of the session's download-dir, rather than in the event's dir
+		(see _fetchWindowsAsync())
+		(May raise StpError)
+		"""
+		if (type(event) != types.DictType) or ('id' not in event) or ('time' not in event) or ('loc' not in event):
+			raise StpError(7, "Invalid event '%s'" % str(event))
+		
+		if type(channels) != types.ListType:
+			channels = [channels]
+		
+		if type(stations) != types.ListType:
+			stations = [stations]
+		
+		for chan in channels:
+			self._checkChannel(chan)
+		
+		for station in stations:
+			if (type(station) not in types.StringTypes) or ('.' not in station):
+				raise StpError(5, "Invalid station '%s'" % str(station))
+		
+		try:
+			dists = gcdist(event['loc'], self.stations.locations(self.net, stations))
+		except KeyError, e:
+			raise StpError(5, "Unknown station %s" % str(e))
+		
+		duration = dastrigger.magDuration(max(0., event.get('mag', 0.)))
+		
+		cmds = []
+		needed = 0.
+		available = 0.
+		for (station, dist) in zip(stations, dists):
+			start = event['time'] + dist / p_velocity - self.margin
+			end = event['time'] + dist / s_velocity + duration + self.margin
 			
-				cmd = "TRIG -net %s -sta %s -chan %s %s" % (net, sta, chan, ev_str)
-				self.stp.stdin.write("%s\n" % cmd)
-				
-				line = ""
-				while self.run and (line != None):
-					line = self._readstp()
-					
-					if line == 'Done':
-						break
-					
-				else:
-					return {}
+			waves = self.avail.get(station, [])
+			if len(waves):
+				wstart = min([wave['time'] for wave in waves])
+				wend = max([wave['time'] + wave['dur'] for wave in waves])
+				(start, end) = (max(start, wstart), min(end, wend))
+				if end <= start:
+					(start, end) = (wstart, wend)
+				available += wend - wstart
+			else:
+				available += end - start
+			
+			needed += end - start
+			
+			net, sta = station.split('.')
+			for chan in channels:
+				cmds.append("WIN -net %s -sta %s -chan %s %s %s" % (net, sta, chan, self._timeString(start), self._timeString(end)))
 		
-		# count the seismograms
-		cnt = {}
-		for ev_id in ev_str.split():
-			ev_dir = os.path.join(self.outputdir, ev_id)
-			if os.path.isdir(ev_dir):
-				cnt[ev_id] = max(0, len(os.listdir(ev_dir)) - 1) # don't count the <ev_id>.event file
+		return (cmds, [str(event['id'])], needed, available)
+	
+	def _timeString(self, t):
+		"""Returns the given time (in seconds since the epoch) in the STP time-format; 'YYYY/MM/DD,hh:mm:ss.sss'
+		"""
+		return "%s.%03d" % (time.strftime("%Y/%m/%d,%H:%M:%S", time.localtime(t)), int((t % 1) * 1000))
+	
+	def _windowDir(self, event):
+		"""Returns the working-dir the given event's trimmed seismograms are downloaded into (see _fetchWindowsAsync())
+		"""
+		return os.path.join(self.outputdir, ".win-%s" % str(event['id']))
+	
+	def _fileWindows(self, event, win_dir):
+		"""Move the seismograms that 'WIN' saved in the working-dir 'win_dir' into the given event's dir (where 'TRIG'
+		would have saved them), and remove the working-dir.
+		Returns the number of files moved
+		"""
+		ev_dir = os.path.join(self.outputdir, str(event['id']))
+		moved = 0
+		for name in os.listdir(win_dir):
+			path = os.path.join(win_dir, name)
+			if not os.path.isfile(path):
+				continue
+			
+			if not os.path.isdir(ev_dir):
+				os.makedirs(ev_dir)
+			
+			os.rename(path, os.path.join(ev_dir, name))
+			moved += 1
 		
-		return cnt
+		self._removeWindowDir(win_dir)
+		return moved
+	
+	def _removeWindowDir(self, win_dir):
+		"""Remove a working-dir of trimmed downloads (see _windowDir()), and whatever is left in it
+		"""
+		try:
+			for name in os.listdir(win_dir):
+				os.remove(os.path.join(win_dir, name))
+			os.rmdir(win_dir)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				self.errMessage("Unable to remove dir '%s': %s" % (win_dir, str(e)))
+	
+	def _seismogramCommands(self, events, stations, channels):
+		"""Returns a list of the commands for downloading the given events' seismograms (see fetchSeismograms()),
+		and a list of the events' IDs
+		(May raise StpError)
+		"""
+		self.trimmed = None
+		if self.defaults.get('trim') and (type(events) == types.DictType):
+			(cmds, ev_ids, needed, available) = self._windowCommands(events, stations, channels)
+			self.trimmed = (needed, available)
+			return (cmds, ev_ids)
 		
+		return self._trigCommands(events, stations, channels)
+	
+	def getSeismogramsAsync(self, events, stations, channels='H%'):
+		"""Asynchronous version of getSeismograms(). Returns an StpRequest
+		(May raise StpError)
+		"""
+		(cmds, ev_ids) = self._trigCommands(events, stations, channels)
+		return self._request(cmds, lambda lines: self._countSeismograms(ev_ids))
+	
+	def getSeismograms(self, events, stations, channels='H%'):
+		"""Request to download seismograms for the given event, from the given stations, on the given channels.
+		'event' is a dict with Event metadata
+		'stations' is a list of station-identifiers (strings)
+		'channels' can be a string or a list of strings containg (a) three-letter channel-code(s),
+		or (a) channel-code(s) containing the '%' or '_' wildcards (see the STP manual)
+		(May raise StpError)
+		"""
+		return self.getSeismogramsAsync(events, stations, channels).result()
+	
+	def _helper(self, n, outputdir=None):
+		"""Returns a new StpWrapper, sharing this StpWrapper's settings, for fetching seismograms alongside it.
+		If an 'outputdir' is given, the helper's sessions download into that dir instead, and are not kept in the StpPool
+		"""
+		if outputdir == None:
+			helper = StpWrapper("%s/%d" % (self.name, n), self.qp, self.stations, None, self.outputdir, self.pool, self.driver, self.avails, self.planner)
+		else:
+			helper = StpWrapper("%s/%d" % (self.name, n), self.qp, self.stations, None, outputdir, None, self.driver, self.avails, self.planner)
+		helper.verbose = self.verbose
+		helper.logfd = self.logfd
+		helper.errfd = self.errfd
+		helper.run = self.run
+		helper.processing = self.processing
 		
-	def getStatus(self):
-		"""Request (and parse) the STP client and server status
-		Returns a dict with 'name':<value> pairs
+		return helper
+	
+	def _fetchPartAsync(self, net, cmds):
+		"""Connect to the given network, send the given 'TRIG' commands, and disconnect again (see fetchSeismogramsAsync()).
+		Releases one of the FetchPlanner's fetching sessions for the network's server group when done.
+		Returns the number of seismogram-bytes received, or 'None' if connected through the 'stp' program
 		(May raise StpError)
 		"""
-		if (self.stp == None) or (self.stp.returncode != None):
-			raise StpError(1, "Not connected")
+		try:
+			yield self.connectAsync(net)
+			
+			received = self._received()
+			error = None
+			try:
+				yield self._request(cmds)
+			except (StpError, IOError), e:
+				error = e
+			
+			if received != None:
+				received = self._received() - received
+			
+			yield self.disconnectAsync()
+			if error != None:
+				raise error
 		
-		self.stp.stdin.write("STATUS\n")
+		finally:
+			if self.planner != None:
+				self.planner.release(netgroup[net], 1)
 		
-		status = {}
-		while self.run:
-			line = self._readstp()
+		yield received
+	
+	def fetchSeismogramsAsync(self, events, stations, channels='H%'):
+		"""Generator version of fetchSeismograms() (see StpTask)
+		"""
+		(cmds, ev_ids) = self._seismogramCommands(events, stations, channels)
+		self.helped = 0
+		
+		if self.trimmed != None:
+			yield self._fetchWindowsAsync(events, cmds)
+			yield self._countSeismograms(ev_ids)
+			return
+		
+		if self.planner == None:
+			yield self._request(cmds)
+			yield self._countSeismograms(ev_ids)
+			return
+		
+		# our own session is one of the fetching sessions too; wait for it if the cap is reached
+		net = self.net
+		num = yield self.planner.acquire(netgroup[net], len(cmds))
+		parts = self.planner.plan(cmds, num)
+		tasks = []
+		try:
+			# start a helper StpWrapper for each but the first part, which is fetched over our own session.
+			# Each helper gives back its fetching session when it is done
+			for n in range(1, len(parts)):
+				helper = self._helper(n)
+				task = StpTask(helper._fetchPartAsync(net, parts[n]), "%stask" % helper.name)
+				self.helpers.append(helper)
+				tasks.append((task, parts[n]))
+				self._spawn(task)
 			
-			if (line == 'Done') or (line == None):
-				break
+			error = None
+			try:
+				yield self._request(parts[0])
+			except (StpError, IOError), e:
+				error = e
+			
+			# wait for the helpers (so none is still writing into the event's dir when we fail),
+			# and fetch whatever they failed to fetch ourselves
+			retry = []
+			for (task, part) in tasks:
+				try:
+					received = yield task.finished
+				except (StpError, IOError), e:
+					if not self._isCancelled(self.processing):
+						self.logMessage("Failed to fetch %d seismograms over a parallel session: %s. Fetching them over this session" % (len(part), str(e)))
+						retry.extend(part)
+					continue
+				
+				if received != None:
+					self.helped += received
+			
+			if error != None:
+				raise error
+			
+			if len(retry) and self.run and not self._isCancelled(self.processing):
+				yield self._request(retry)
+		
+		finally:
+			# give back our own fetching session, and those claimed for helpers that were not started
+			self.planner.release(netgroup[net], num - len(tasks))
+			self.helpers = []
+		
+		yield self._countSeismograms(ev_ids)
+	
+	def _fetchWindowsAsync(self, event, cmds):
+		"""Fetch the given 'WIN' commands for the given event (see _windowCommands()) over sessions of their own, which
+		download into a working-dir for the event (see _windowDir()), so they cannot pick up the seismograms fetched for
+		other events. The commands are spread over as many sessions as the FetchPlanner allows, or sent over one session
+		if there is no planner. Then the seismograms are moved into the event's dir (see _fileWindows()).
+		Our own session (which is connected to the outputdir) idles meanwhile.
+		(May raise StpError)
+		"""
+		net = self.net
+		win_dir = self._windowDir(event)
+		self._removeWindowDir(win_dir)	# leftovers of an earlier attempt
+		os.makedirs(win_dir)
+		
+		if self.planner != None:
+			num = yield self.planner.acquire(netgroup[net], len(cmds))
+			parts = self.planner.plan(cmds, num)
+		else:
+			num = 1
+			parts = [cmds]
+		
+		tasks = []
+		try:
+			for n in range(len(parts)):
+				helper = self._helper(n + 1, win_dir)
+				task = StpTask(helper._fetchPartAsync(net, parts[n]), "%stask" % helper.name)
+				self.helpers.append(helper)
+				tasks.append(task)
+				self._spawn(task)
 			
+			# wait for all sessions, so none is still writing into the working-dir
+			error = None
+			for task in tasks:
+				try:
+					received = yield task.finished
+				except (StpError, IOError), e:
+					error = e
+					continue
+				
+				if received != None:
+					self.helped += received
+			
+			if error != None:
+				raise error
+			
+			self._fileWindows(event, win_dir)
+		
+		finally:
+			if self.planner != None:
+				self.planner.release(netgroup[net], num - len(tasks))
+			self.helpers = []
+			self._removeWindowDir(win_dir)
+	
+	def fetchSeismograms(self, events, stations, channels='H%'):
+		"""Download seismograms for the given event, from the given stations, on the given channels, like getSeismograms().
+		If this StpWrapper has a FetchPlanner, the 'TRIG' commands are spread over this StpWrapper's session and (up to
+		the planner's cap for the datacenter, minus its sessions that are already fetching) additional sessions, connected
+		by helper StpWrappers, which download the seismograms into the same output-dir concurrently. When the cap is
+		reached, the fetch waits until the planner has a session to spare.
+		If StpWrapper.defaults['trim'] is set, and 'events' is a single event, only the part of each seismogram that is
+		played back is downloaded (see _windowCommands()). The length of the requested and of the available windows
+		is then kept in 'trimmed', and the seismograms are fetched over sessions of their own (see _fetchWindowsAsync()).
+		(Experimental; the 'WIN' syntax is not yet checked against a real datacenter)
+		Returns a dict of the number of seismograms, indexed by Event-ID
+		(May raise StpError)
+		"""
+		return self._runSync(self.fetchSeismogramsAsync(events, stations, channels))
+	
+	
+	def _parseStatus(self, lines):
+		"""Parse the output of the 'STATUS' command
+		Returns a dict with 'name':<value> pairs
+		"""
+		status = {}
+		for line in lines:
 			i = line.find('=')
 			if i < 0:
 				continue
@@ -671,26 +2900,28 @@ class StpWrapper(object):
 			val = line[i+1:].strip()
 			
 			status[key] = val
-			
+		
 		return status
 	
-		
-	def toggleVerbose(self):
-		"""Toggle the STP client's verbose mode on / off
+	def getStatusAsync(self):
+		"""Asynchronous version of getStatus(). Returns an StpRequest
+		"""
+		return self._request(['STATUS'], self._parseStatus)
+	
+	def getStatus(self):
+		"""Request (and parse) the STP client and server status
+		Returns a dict with 'name':<value> pairs
 		(May raise StpError)
 		"""
-		if (self.stp == None) or (self.stp.returncode != None):
-			raise StpError(1, "Not connected")
-		
-		self.stp.stdin.write("VERBOSE\n")
-		
+		return self.getStatusAsync().result()
+	
+	
+	def _parseVerbose(self, lines):
+		"""Parse the output of the 'VERBOSE' command
+		Returns 'True' if verbose mode is on, 'False' if it is off, or 'None' if unknown
+		"""
 		ret = None
-		while self.run:
-			line = self._readstp()
-			
-			if (line == 'Done') or (line == None):
-				break
-			
+		for line in lines:
 			tokens = line.split()
 			if tokens[0] == 'verbose':
 				if tokens[-1] == 'on':
@@ -699,48 +2930,54 @@ class StpWrapper(object):
 					ret = False
 		
 		return ret
-			
-			
-	def setGainCorr(self, corr=True):
-		"""Enable or disable the gain-correction for downloaded seismograms
-		Returns 'True' (if enabled) or 'False' (if disabled)
+	
+	def toggleVerboseAsync(self):
+		"""Asynchronous version of toggleVerbose(). Returns an StpRequest
+		"""
+		return self._request(['VERBOSE'], self._parseVerbose)
+	
+	def toggleVerbose(self):
+		"""Toggle the STP client's verbose mode on / off
 		(May raise StpError)
 		"""
-		if (self.stp == None) or (self.stp.returncode != None):
-			raise StpError(1, "Not connected")
-		
-		if corr:
-			cmd = 'GAIN ON'
-		else:
-			cmd = 'GAIN OFF'
-		
-		self.stp.stdin.write("%s\n" % cmd)
-		
+		return self.toggleVerboseAsync().result()
+	
+	
+	def _parseGainCorr(self, lines):
+		"""Parse the output of the 'GAIN' command
+		Returns 'True' (if enabled), 'False' (if disabled), or 'None' if unknown
+		"""
 		ret = None
-		while self.run:
-			line = self._readstp()
-			
-			if (line == 'Done') or (line == None):
-				break
-			
+		for line in lines:
 			tokens = line.split()
 			if tokens[0] == 'Correcting':
 				ret = True
 			elif tokens[0] == 'No':
 				ret = False
-			
+		
 		return ret
-			
 	
-	def setFormat(self, format):
-		"""Set the file-format for downlaoded seismograms.
-		The requested 'format' must be one of the strings in the out_fmts global variable
-		Returns the currently set output-format (string)
-		(May raise StpError)
+	def setGainCorrAsync(self, corr=True):
+		"""Asynchronous version of setGainCorr(). Returns an StpRequest
 		"""
-		if (self.stp == None) or (self.stp.returncode != None):
-			raise StpError(1, "Not connected")
+		if corr:
+			cmd = 'GAIN ON'
+		else:
+			cmd = 'GAIN OFF'
 		
+		return self._request([cmd], self._parseGainCorr)
+	
+	def setGainCorr(self, corr=True):
+		"""Enable or disable the gain-correction for downloaded seismograms
+		Returns 'True' (if enabled) or 'False' (if disabled)
+		(May raise StpError)
+		"""
+		return self.setGainCorrAsync(corr).result()
+	
+	
+	def setFormatAsync(self, format):
+		"""Generator version of setFormat() (see StpTask)
+		"""
 		if type(format) in types.StringTypes:
 			uformat = str(format).upper()
 			if uformat in out_fmts:
@@ -751,29 +2988,62 @@ class StpWrapper(object):
 			format = out_fmts[format]
 		else:
 			raise StpError(9, "Invalid output-format '%s'" % str(format))
-			
-		self.stp.stdin.write("%s\n" % format)
 		
-		line = ""
-		while self.run and (line != None):
-			line = self._readstp()
-			
-			if line == 'Done':
-				break
-			
-		return self.getStatus()['Format']
+		yield self._request([format])
+		
+		status = yield self.getStatusAsync()
+		yield status['Format']
 	
+	def setFormat(self, format):
+		"""Set the file-format for downlaoded seismograms.
+		The requested 'format' must be one of the strings in the out_fmts global variable
+		Returns the currently set output-format (string)
+		(May raise StpError)
+		"""
+		return self._runSync(self.setFormatAsync(format))
+
 	def _rmDir(self, ev):
 		"""Remove an empty event-dir from the outputdir tree
 		"""
 		ev_dir = os.path.join(self.outputdir, ev['id'])
-		try:	# try to remove event's dir
-			ls = os.listdir(ev_dir)
-			if (len(ls) == 1) and ls[0].endswith('.evnt'):
-				os.remove(os.path.join(ev_dir, ls[0]))
+		try:	# try to remove event's dir
+			ls = os.listdir(ev_dir)
+			if (len(ls) == 1) and ls[0].endswith('.evnt'):
+				os.remove(os.path.join(ev_dir, ls[0]))
+			os.rmdir(ev_dir)
+		except OSError:		# dir not empty
+			pass
+	
+	def _dirSize(self, ev):
+		"""Returns the number of bytes the files in an event-dir take
+		"""
+		ev_dir = os.path.join(self.outputdir, ev['id'])
+		size = 0
+		try:
+			for f in os.listdir(ev_dir):
+				size += os.path.getsize(os.path.join(ev_dir, f))
+		except OSError:		# no dir
+			pass
+		
+		return size
+	
+	def _removeDir(self, ev):
+		"""Remove an event-dir, and the (partially downloaded) seismograms in it, from the outputdir tree
+		Returns the number of bytes removed
+		"""
+		ev_dir = os.path.join(self.outputdir, ev['id'])
+		size = 0
+		try:
+			for f in os.listdir(ev_dir):
+				path = os.path.join(ev_dir, f)
+				size += os.path.getsize(path)
+				os.remove(path)
 			os.rmdir(ev_dir)
-		except OSError:		# dir not empty
-			pass
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				self.errMessage("Unable to remove dir '%s': %s" % (ev_dir, str(e)))
+		
+		return size
 	
 	def _tdString(self, td):
 		"""Return a string describing the value of a datetime.timedelta as
@@ -833,140 +3103,312 @@ class StpWrapper(object):
 	
 		return out
 	
-	def runStp(self, events, stn_count=3, channels='H%'):
-		"""The main seismogram retreival cycle.
-		Tries to run connect(ev['net']), getEvent(ev), getClosest(ev, stn_count, channels)
-		and getSeismograms(ev, closest_stations, channels) for each event in 'events'
-		If any of these steps yeild no data, the event in question is delegated to a 'retry'
-		list. If the events-list is empty but the retry-list is not, wait a pre-defined period
-		(either 30 sec or 5 min, depending on which step failed) and run the whole sequence again
-		with the events in the retry-list.
-		May reject events depending on event-type (man-made events are rejected) or magnitudes <= 0
-		Will give up on events after the StpWrapper.defaults['retryperiod'] expires
-		(May raise StpError)
+	def _groupByNet(self, events):
+		"""Returns the list of events, grouped per network (in the order in which the networks first appear),
+		so runStp() connects to each network only once per cycle.
+		The events of the network this StpWrapper is connected to (if any) come first.
+		"""
+		groups = {}
+		nets = []
+		if self.net != None:
+			nets.append(self.net)
+		
+		for ev in events:
+			if type(ev) == types.DictType:
+				net = ev.get('net')
+			else:
+				net = None
+			
+			if net not in nets:
+				nets.append(net)
+			groups.setdefault(net, []).append(ev)
+		
+		out = []
+		for net in nets:
+			out.extend(groups.get(net, []))
+		
+		return out
+	
+	def cancel(self, ev_id):
+		"""Cancel the processing of the event with the given ID (e.g. because it is no longer in the DB).
+		Cancellation is cooperative; the command being executed is completed, but no more commands are sent for the event,
+		by this StpWrapper or its helpers. Then its partial downloads are removed (see _cancelEvent()).
+		Returns an StpRequest that completes with a (latency, estimated bytes saved) tuple when the processing has stopped,
+		or with 'None' if the event was done before it could be cancelled
+		"""
+		req = StpRequest()
+		with self.cancel_lock:
+			self.cancelling[ev_id] = (time.time(), req)
+			if self.processing == ev_id:
+				if self.active != None:
+					self.active.cancel()
+				helpers = self.helpers[:]
+			else:
+				helpers = []
+		
+		for helper in helpers:
+			helper.cancel(ev_id)
+		
+		return req
+	
+	def _isCancelled(self, ev_id):
+		"""Returns 'True' if the processing of the event with the given ID is to be cancelled
+		"""
+		with self.cancel_lock:
+			return ev_id in self.cancelling
+	
+	def _cancelEvent(self, ev):
+		"""Stop processing an event that was cancelled (see cancel()); remove its partial downloads, and complete the
+		cancel() request with the time it took to stop, and the estimated number of seismogram-bytes saved
+		(the average size of a downloaded event, minus what was downloaded already)
+		"""
+		with self.cancel_lock:
+			(since, req) = self.cancelling.pop(ev['id'])
+			self.processing = None
+		
+		self.handled.add(ev['id'])
+		
+		partial = self._removeDir(ev)
+		self.avails.drop(ev['net'], ev['id'])
+		
+		with self.totals_lock:
+			if self.totals['downloads'] > 0:
+				est_saved = max(0, (self.totals['download_bytes'] // self.totals['downloads']) - partial)
+			else:
+				est_saved = 0
+		
+		latency = time.time() - since
+		self.logMessage("Cancelled event %s after %.1f sec. Removed %d kB of partial downloads (est. %d kB saved)" % (self._idStr(ev), latency, partial // 1024, est_saved // 1024))
+		req.finish((latency, est_saved))
+	
+	def _dropCancels(self):
+		"""Complete the pending cancel() requests of events that were done before they could be cancelled
+		"""
+		with self.cancel_lock:
+			self.processing = None
+			pending = self.cancelling.values()
+			self.cancelling = {}
+		
+		for (since, req) in pending:
+			req.finish()
+	
+	def _retryLater(self, ev, reason, msg, args):
+		"""Log the message 'msg' about an event that failed for the given reason (see RetryScheduler.policies),
+		and hand the event to the RetryScheduler, to be retried later. 'args' are the arguments to retry the event with.
+		If the event's retry-period has expired, it is rejected instead. If the event was cancelled, or the RetryScheduler
+		is closed, it is dropped.
+		Returns the delay (in seconds) until the next attempt, or 'None' if the event is not retried
 		"""
+		self.handled.add(ev['id'])
+		if self._isCancelled(ev['id']):
+			self._cancelEvent(ev)
+			return None
+		
+		delay = self.retries.schedule(ev, reason, args)
+		if delay == None:
+			if self.retries.closed:
+				self.logMessage("%s. Not retried; shutting down" % msg)
+				return None
+			
+			self.logMessage("%s. Retry-period expired. Giving up" % msg)
+			ev['reason'] = "timed out"
+			self.rejects.append(ev)
+			self.avails.drop(ev['net'], ev['id'])
+			return None
+		
+		self.logMessage("%s. Will retry in %s" % (msg, self._tdString(datetime.timedelta(0, max(1, int(delay))))))
+		return delay
+	
+	def _processAsync(self, events, stn_count, channels):
+		"""Process the given events (see runStp()), without marking this StpWrapper as done afterwards.
+		The IDs of the events that were dealt with (downloaded, rejected, cancelled or handed over to be retried)
+		are kept in 'handled'
+		"""
+		self.handled = set()
+		self.downloaded = {}
+		if (self.stp != None) and (self.stp.poll() != None):
+			self._forgetSession()
+		
 		if self.stp != None:
 			raise StpError(3, "%s Already running. Connected to '%s'" % (self.name, self.net))
 		
 		if type(events) != types.ListType:
 			events = [events]
 		
+		events = self._groupByNet(events)
+		
 		ev_str = ""
 		for ev in events:
 			ev_str += "%s, " % self._idStr(ev)
-			
+		
 		starttime = datetime.datetime.utcnow()
-		endtime = starttime + self.defaults['retryperiod']
 		timestring = starttime.strftime("%b %d %Y - %H:%M:%S UTC")
 		self.logMessage("Started at %s with events [%s]" % (timestring, ev_str[:-2]))
 		
-		self.run = True
-		self.done.clear()
-		self.downloaded = {}
-		while self.run:
-			retry = []
-			while len(events):
-				if not self.run:
-					self.disconnect()
-					break
-				
-				ev = events.pop(0)
-				
-				if (type(ev) != types.DictType) or ('id' not in ev) or ('net' not in ev):
-					raise StpError(7, "Invalid event '%s'" % str(ev))
-				
-				if ev['net'] != self.net:
-					self.disconnect()
+		if type(channels) == types.ListType:
+			args = (stn_count, tuple(channels))
+		else:
+			args = (stn_count, channels)
+		
+		while len(events) and self.run:
+			ev = events.pop(0)
+			
+			if (type(ev) != types.DictType) or ('id' not in ev) or ('net' not in ev):
+				raise StpError(7, "Invalid event '%s'" % str(ev))
+			
+			if ev['net'] != self.net:
+				yield self.disconnectAsync()
 				
-					try:
-						self.connect(ev['net'])
-					except StpError, e:
-						self.logMessage("Failed to connect: %s. Will retry in 30 sec" % str(e))
-						retry.append(ev)
-						delay = 30
-						continue
+				try:
+					yield self.connectAsync(ev['net'])
+				except StpError, e:
+					self._retryLater(ev, 'connect', "Failed to connect: %s" % str(e), args)
+					continue
 				
-				ev_out = self.getEvent(ev)
+				# ask for the available seismograms of all events on this network at once
+				batch = [ev] + [e for e in events if (type(e) == types.DictType) and (e.get('net') == ev['net']) and ('id' in e)]
+				try:
+					yield self.getAvailsAsync(batch, channels)
+				except StpError, e:
+					self.logMessage("Failed to get available seismograms for %d events: %s" % (len(batch), str(e)))
+			
+			with self.cancel_lock:
+				self.processing = ev['id']
+			if self._isCancelled(ev['id']):
+				self._cancelEvent(ev)
+				continue
+			
+			try:
+				ev_out = yield self.getEventAsync(ev)
 				
 				if len(ev_out) == 0:
-					self.logMessage("%s datacenter has no data for event %s (yet). Will retry in 5 min" % (ev['net'], self._idStr(ev)))
-					retry.append(ev)
-					delay = 300
+					self._retryLater(ev, 'noevent', "%s datacenter has no data for event %s (yet)" % (ev['net'], self._idStr(ev)), args)
 					continue
 				
 				elif ev_out['type'] not in ('le', 're', 'ts'):
 					self.logMessage("Event %s is not an earthquake; type = '%s'" % (self._idStr(ev_out), ev_out['type']))
 					ev['reason'] = "man-made event type: %s" % ev_out['type']
 					self.rejects.append(ev)
+					self.handled.add(ev['id'])
+					self.retries.forget(ev['id'])
 					continue
 				
 				if 'retry' not in ev:
 					self.logMessage("Event %s" % self._eventStr(ev_out))
 				
-				cl = self.getClosest(ev_out, stn_count, channels)
+				cl = yield self.getClosestAsync(ev_out, stn_count, channels)
 				if len(cl) == 0:
-					self.logMessage("No stations have data for event %s (yet). Will retry in 5 min" % self._idStr(ev_out))
-					retry.append(ev)
-					delay = 300
+					self._retryLater(ev, 'nostations', "No stations have data for event %s (yet)" % self._idStr(ev_out), args)
 					continue
 				
-				ret = self.getSeismograms(ev_out, cl, channels)
-				if (ev_out['id'] not in ret) or (ret[ev_out['id']] == 0):
-					self.logMessage("No seismograms available for event %s (yet). Will retry in 5 min" % self._idStr(ev_out))
-					self._rmDir(ev_out)
-					retry.append(ev)
-					delay = 300
+				if self._isCancelled(ev['id']):
+					self._cancelEvent(ev)
 					continue
 				
-				self.downloaded.update(ret)
-				timestring = self._tdString(datetime.datetime.utcnow() - datetime.datetime.fromtimestamp(ev_out['time']))
-				self.logMessage("Downloaded %d seismograms for event %s from %d stations, %s after the event" % (ret[ev_out['id']], self._idStr(ev_out), len(cl), timestring))
+				received = self._received()
+				ret = yield self.fetchSeismogramsAsync(ev_out, cl, channels)
+				if received != None:
+					received = self._received() - received + self.helped
 			
-			else:	# the 'else' of the inner 'while' loop. i.e. if len(events) == 0
-				self.disconnect()
-				
-				if not len(retry):
-					break	# break the outer 'while' loop
-					
-				if (datetime.datetime.utcnow() < endtime):
-					tick = 0
-					while (tick < delay) and self.run:
-						tick += 1
-						time.sleep(1)
-					
-					events = []
-					current = self.qp.getAllIds()
-					ev_str = ""
-					for ev in retry:
-						if ev['id'] not in current:
-							ev_str += "%s, " % self._idStr(ev)
-							continue
-						
-						ev['retry'] = True
-						events.append(ev)
-						
-					if len(ev_str):
-						timestring = datetime.datetime.utcnow().strftime("%b %d %Y - %H:%M:%S UTC")
-						self.logMessage("Events [%s] no longer in DB at %s" % (ev_str[:-2], timestring))
-					
-					if not len(events):
-						break	# break the outer 'while' loop
-					
-					continue
+			except StpError, e:
+				if (self.stp != None) and (self.stp.poll() != None):
+					self._forgetSession()
+				self._retryLater(ev, 'error', "Failed to process event %s: %s" % (self._idStr(ev), str(e)), args)
+				continue
+			
+			if self._isCancelled(ev['id']):
+				self._cancelEvent(ev)
+				continue
+			
+			if (ev_out['id'] not in ret) or (ret[ev_out['id']] == 0):
+				self._rmDir(ev_out)
+				self._retryLater(ev, 'noseismograms', "No seismograms available for event %s (yet)" % self._idStr(ev_out), args)
+				continue
+			
+			self.downloaded.update(ret)
+			self.handled.add(ev['id'])
+			self.avails.drop(ev['net'], ev['id'])
+			self.retries.forget(ev['id'])
+			with self.totals_lock:
+				self.totals['downloads'] += 1
+				self.totals['download_bytes'] += self._dirSize(ev_out)
+			timestring = self._tdString(datetime.datetime.utcnow() - datetime.datetime.fromtimestamp(ev_out['time']))
+			msg = "Downloaded %d seismograms for event %s from %d stations, %s after the event" % (ret[ev_out['id']], self._idStr(ev_out), len(cl), timestring)
+			if received != None:
+				msg += " (%d kB)" % (received // 1024)
+			if (self.trimmed != None) and (self.trimmed[1] > 0):
+				msg += ", trimmed to %.0f of %.0f sec (-%.0f%%)" % (self.trimmed[0], self.trimmed[1], 100. * (1. - self.trimmed[0] / self.trimmed[1]))
+			self.logMessage(msg)
+		
+		yield self.disconnectAsync()
+	
+	def runStpAsync(self, events, stn_count=3, channels='H%'):
+		"""Generator version of runStp() (see StpTask)
+		"""
+		self.run = True
+		self.done.clear()
+		try:
+			yield self._processAsync(events, stn_count, channels)
+		
+		finally:
+			self._dropCancels()
+			self.done.set()
+			self.logMessage("Done at %s" % datetime.datetime.utcnow().strftime("%b %d %Y - %H:%M:%S UTC"))
+	
+	def serveAsync(self, queue):
+		"""Generator version of serve() (see StpTask)
+		"""
+		self.run = True
+		self.done.clear()
+		self.logMessage("Started at %s. Waiting for events" % datetime.datetime.utcnow().strftime("%b %d %Y - %H:%M:%S UTC"))
+		try:
+			while self.run:
+				try:
+					(events, args) = yield queue.take(self.name)
+				except StpError:	# the queue was closed
+					break
 				
-				ev_str = ""
-				for ev in retry:
-					ev['reason'] = "timed out"
-					self.rejects.append(ev)
-					ev_str += "%s, " % self._idStr(ev)
-					
-				timestring = endtime.strftime("%b %d %Y - %H:%M:%S UTC")
-				self.logMessage("Retry-period expired at %s. Giving up on events [%s]" % (timestring, ev_str[:-2]))
-				break	# break the outer 'while' loop
+				(stn_count, channels) = args
+				if type(channels) == types.TupleType:
+					channels = list(channels)
 				
-		self.done.set()
-		self.logMessage("Done at %s" % datetime.datetime.utcnow().strftime("%b %d %Y - %H:%M:%S UTC"))
-						
+				try:
+					yield self._processAsync(events, stn_count, channels)
+				except StpError, e:
+					self.errMessage("Error: %s" % str(e))
+					# don't lose the events that were not dealt with
+					for ev in events:
+						if (type(ev) == types.DictType) and ('id' in ev) and ('net' in ev) and (ev['id'] not in self.handled):
+							self._retryLater(ev, 'error', "Event %s was not processed" % self._idStr(ev), args)
+				finally:
+					queue.done([ev['id'] for ev in events], self.downloaded)
+					self._dropCancels()
+		
+		finally:
+			self.done.set()
+			self.logMessage("Done at %s" % datetime.datetime.utcnow().strftime("%b %d %Y - %H:%M:%S UTC"))
+	
+	def runStp(self, events, stn_count=3, channels='H%'):
+		"""The main seismogram retreival cycle.
+		Tries to run connect(ev['net']), getEvent(ev), getClosest(ev, stn_count, channels)
+		and fetchSeismograms(ev, closest_stations, channels) for each event in 'events'
+		If any of these steps yeild no data (or fail), the event in question is handed to the RetryScheduler,
+		with a delay that depends on which step failed (see _retryLater()), and runStp() is done as soon as it has
+		tried all events once. Whoever owns the RetryScheduler processes the events again when they are due.
+		The events are processed grouped per network, and the 'stp' process is disconnected at the end of the cycle
+		(i.e. released into the StpPool, if there is one)
+		May reject events depending on event-type (man-made events are rejected) or magnitudes <= 0
+		The RetryScheduler gives up on events after its retry-period (StpWrapper.defaults['retryperiod']) expires
+		(May raise StpError)
+		"""
+		self._runSync(self.runStpAsync(events, stn_count, channels))
+	
+	def serve(self, queue):
+		"""The worker-cycle. Takes batches of events from the EventQueue 'queue', and processes each batch like runStp() does,
+		until this StpWrapper is stopped, or the queue is closed.
+		"""
+		self._runSync(self.serveAsync(queue))
+	
 	
 	def isDone(self):
 		"""Returns 'True' if the runStp() call has been completed
@@ -975,23 +3417,51 @@ class StpWrapper(object):
 	
 	def start(self, events, stn_count=3, channels='H%'):
 		"""Starts the runStp() method in a new thread.
+		If this StpWrapper has an StpDriver, runStp() is run as an StpTask by the driver instead
 		(May raise StpError)
 		"""
-		if self.thread and self.thread.isAlive():
+		if (self.thread and self.thread.isAlive()) or (self.task and not self.task.done.isSet()):
 			raise StpError(3, "%s Already started" % self.name)
-			
+		
+		if self.driver != None:
+			self.task = StpTask(self.runStpAsync(events, stn_count, channels), "%stask" % self.name)
+			self.driver.spawn(self.task)
+			return
+		
 		self.thread = threading.Thread(None, self.runStp, "%sthread" % self.name, [events, stn_count, channels])
 		self.thread.start()
+	
+	def startServing(self, queue):
+		"""Starts the serve() method in a new thread, or as an StpTask run by the StpDriver, if this StpWrapper has one.
+		(May raise StpError)
+		"""
+		if (self.thread and self.thread.isAlive()) or (self.task and not self.task.done.isSet()):
+			raise StpError(3, "%s Already started" % self.name)
 		
+		if self.driver != None:
+			self.task = StpTask(self.serveAsync(queue), "%stask" % self.name)
+			self.driver.spawn(self.task)
+			return
+		
+		self.thread = threading.Thread(None, self.serve, "%sthread" % self.name, [queue])
+		self.thread.start()
+	
 	def stop(self):
-		"""Stops a running runStp()-process and waits for its thread to finish
+		"""Stops a running runStp()-process and waits for its thread (or StpTask) to finish
 		"""
 		self.run = False
+		for helper in self.helpers:
+			helper.run = False
+		
 		self.logMessage("Stopping")
 		if self.thread and self.thread.isAlive():
 			self.logMessage("Waiting for %s to finish..." % self.thread.getName())
 			self.thread.join()
 		
+		if self.task and not self.task.done.isSet():
+			self.logMessage("Waiting for %s to finish..." % self.task.name)
+			self.task.done.wait()
+
 
 class StpRunner(object):
 	"""Compares the list of events returned by QDMParser.getAll() against the existing subdirs with seismograms in its output-dir
@@ -999,19 +3469,17 @@ class StpRunner(object):
 	"""
 	# Path of the seismograms dir-structure
 	outputdir = "/var/lib/STP"
+	# Path of the dir where the station-lists are kept (see StationCatalog)
+	cachedir = "/var/cache/STP"
 	
-	# a hierarchy of dicts for storing seismic networks' stations' locations
-	stations = {'CI':{}, 'NC':{}}
 	verbose = 0
 	
 	# Default values
 	defaults = {'retryperiod':datetime.timedelta(1),
 				'retainperiod':datetime.timedelta(30)}
 	
-	# a list of running StpWrappers
+	# a list of running StpWrappers (workers)
 	sws = []
-	# a dict of events in process, associated with the StpWrapper that is processing them
-	proc = {}
 	
 	mainthread = None
 	run = True
@@ -1020,18 +3488,22 @@ class StpRunner(object):
 	gcthread = None
 	gcrun = False
 	
-	# default max number of StpWrapper-threads to start
+	# default number of StpWrappers (workers) to start
 	maxthreads = 10
 	
-	def __init__(self, qdm_parser=None, stations=None, logfile=None, errfile=None, outputdir=None):
+	# min time between checks for old seismograms-dirs to remove, in 'auto' mode (sec)
+	cleaninterval = 60
+	
+	def __init__(self, qdm_parser=None, stations=None, logfile=None, errfile=None, outputdir=None, cachedir=None):
 		"""Instantiate an StpRunner
 		'qdmparser' should be a QDMParser instance, or 'None' in which case a QDMParser is instantiated
-		'stations' should be a hierarchy of dicts containing the seismic networks' stations' locations.
-			if not ptovided, the default (empty) stations dict will be used and this will be populated by the first
-			StpWrapper run for each network
+		'stations' should be a StationCatalog, or a hierarchy of dicts containing the seismic networks' stations' locations.
+			if not ptovided, a StationCatalog is created, which loads the station-lists saved in the 'cachedir'.
+			The station-lists are (re-)fetched by the StpWrappers when they are missing or stale
 		'logfile' and 'errfile' should be filenames defining where to log informational- and error-messages.
 		if not provided, sys.stdout and sys.stderr will be used
 		'outputdir' is the root-dir of the seismograms directory-tree. (/var/lib/STP/ per default)
+		'cachedir' is the dir where the station-lists are saved. (/var/cache/STP/ per default)
 		"""
 		if isinstance(qdm_parser, qdmparser.QDMParser):
 			self.qp = qdm_parser
@@ -1099,19 +3571,67 @@ class StpRunner(object):
 			# create outputdir if it doesn't exist
 			os.makedirs(self.outputdir)
 		
-		if type(stations) == types.DictType:
-			# copy provided stations
-			for net in netgroup.keys():
-				if (net in stations) and (type(stations[net]) == types.DictType):
-					self.stations[net] = stations[net]
+		if cachedir:
+			self.cachedir = cachedir
+		
+		if isinstance(stations, StationCatalog):
+			self.stations = stations
+		else:
+			# create a StationCatalog, with the provided stations, or the station-lists saved in the cachedir
+			self.stations = StationCatalog(self.cachedir, stations=stations)
+			if type(stations) != types.DictType:
+				try:
+					for (net, count) in self.stations.load().items():
+						self.logMessage("Loaded %d stations for net '%s'" % (count, net))
+				except (IOError, ValueError, IndexError), e:
+					self.errMessage("Unable to load saved station-lists: %s" % str(e))
 				
 		# a lock for guaranteeing atomic manipulations of the list of StpWrappers
 		self.sws_lock = threading.Lock()
 		
+		# spreads each event's seismogram-downloads over several sessions, shared by all StpWrappers (see setParallel())
+		self.planner = FetchPlanner()
+		
+		# a pool of connected 'stp' processes, shared by all StpWrappers. It keeps enough idle sessions for a parallel fetch
+		self.pool = StpPool(max(StpPool.maxidle, self.planner.maxfetch))
+		
+		# a cache of the seismograms available per event, shared by all StpWrappers
+		self.avails = AvailCache()
+		
+		# schedules the events to retry, for all StpWrappers (see retryDue())
+		self.retries = RetryScheduler(self.defaults['retryperiod'])
+		
+		# the queue of events to process, from which the StpWrappers take their work (see runStp())
+		self.queue = EventQueue()
+		
+		# the IDs of the events currently in the DB, and the time at which the events that have seismograms-dirs but are no
+		# longer in the DB left it, as told by the QDMParser (see _dbChanged())
+		self.current = set()
+		self.old = {}
+		self.cleaned = 0
+		self.runargs = None
+		self.index_lock = threading.Lock()
+		
+		# the number of events cancelled (see _dbChanged()) while queued, waiting to be retried, or in process, the total time
+		# (in seconds) it took to stop processing them, and an estimate of the seismogram-bytes this saved; the average size
+		# of a downloaded event (minus what was downloaded already, for events in process)
+		self.cancels = {'queued':0, 'retry':0, 'inflight':0, 'latency':0., 'est_saved':0}
+		self.cancels_lock = threading.Lock()
+		
+		# the events with seismograms-dirs are done. Until the DB says otherwise, they are old
+		have = os.listdir(self.outputdir)
+		self.queue.completed.update(have)
+		for ev_id in have:
+			self.old[ev_id] = time.time()
+		
+		# the StpDriver that runs all StpWrappers in one thread (see setMultiplex())
+		self.driver = None
+		
+		
 		# keep track of the number of known stations on each network
 		self.stn_count = {}
 		for net in netgroup.keys():
-			self.stn_count[net] = len(self.stations[net])
+			self.stn_count[net] = self.stations.count(net)
 					
 	def logMessage(self, msg):
 		"""Write a message, prefixed by 'STPRunner: " to the log-file-object
@@ -1166,6 +3686,42 @@ class StpRunner(object):
 		elif 'gaincorr' in self.defaults:
 			del self.defaults['gaincorr']
 
+	def setTrim(self, trim):
+		"""Enable or disable downloading only the part of each seismogram that is played back, for future StpWrappers
+		(Experimental; see StpWrapper.fetchSeismograms())
+		"""
+		if trim:
+			self.defaults['trim'] = True
+		elif 'trim' in self.defaults:
+			del self.defaults['trim']
+	
+	def setParallel(self, num, group=None):
+		"""Have the StpWrappers download each event's seismograms over at most 'num' concurrent sessions per datacenter
+		(i.e. STP server group), or over the given server group only, if 'group' is not 'None'. Setting 'num' to 1
+		downloads the seismograms one after the other over a single session
+		"""
+		if num < 1:
+			raise ValueError("Invalid number of parallel sessions: %s" % str(num))
+		
+		if group == None:
+			self.planner.maxfetch = num
+		elif group in netgroup.values():
+			self.planner.caps[group] = num
+		else:
+			raise ValueError("Unrecognized STP server group: '%s'" % str(group))
+		
+		self.pool.maxidle = max(self.pool.maxidle, num)
+	
+	def setMultiplex(self, multiplex):
+		"""Enable or disable running future StpWrappers from a single StpDriver-thread, rather than each in its own thread
+		"""
+		if multiplex and (self.driver == None):
+			self.driver = StpDriver()
+			self.driver.logfd = self.logfd
+			self.driver.errfd = self.errfd
+		elif not multiplex:
+			self.driver = None
+	
 	def _parsePeriod(self, period):
 		"""Parse a time-preiod spec (string) and return a datetime.timedelta object
 		"""
@@ -1200,6 +3756,7 @@ class StpRunner(object):
 		by one of 's', 'm', 'h', 'd' or 'w' (if no letter present, 'd' for days is assumed)
 		"""
 		self.defaults['retryperiod'] = self._parsePeriod(period)
+		self.retries.period = self.defaults['retryperiod']
 				
 	def setRetainPeriod(self, period):
 		"""Set the period of time to retain downloaded seismograms for events that
@@ -1269,69 +3826,197 @@ class StpRunner(object):
 	
 	
 	def runStp(self, events, stn_count=3, channels='H%'):
-		"""Creates and runs an StpWrapper instance.
-		First checks the number of running StpWrappers against StpRunner.maxthreads,
-		and creates a unique instance-name (STP[n]) for the new StpWrapper
-		The provided arguments are passed to the StpWrapper.runStp() method
-		This StpRunner's 'verbose', 'outputdir', 'logfd' and 'errfd' members are inherited by the new StpWrapper
+		"""Queues the given events in the EventQueue, to be processed by the pool of StpWrappers (see startWorkers()).
+		The 'stn_count' and 'channels' arguments are passed to the StpWrapper that processes the events (see StpWrapper.serve())
+		Events that are queued or in process already are not queued again.
+		Returns 'True' if the events were queued, or 'False' if the StpRunner is stopping
 		"""
 		if type(events) != types.ListType:
 			events = [events]
 		
-		numthreads = len(self.sws)
-		if numthreads >= self.maxthreads:
-			ev_str = ""
-			for ev in events:
-				ev_str += "%s, " % self._idStr(ev)
-			
-			self.errMessage("Warning: Maximum number of STP's (%d) already  running. Waiting with events [%s]" % (self.maxthreads, ev_str[:-2]))
-			return
+		if type(channels) == types.ListType:
+			args = (stn_count, tuple(channels))
+		else:
+			args = (stn_count, channels)
 		
-		halfthreads = self.maxthreads // 2
-		if (numthreads >= halfthreads):
-			minevents = 2 + ((numthreads - halfthreads) * 2)
-			if len(events) < minevents:
-				self.logMessage("%d STP's already  running. Need at least %d events before starting another." % (numthreads, minevents))
-				return
+		if not self.startWorkers():
+			return False
+		
+		num = self.queue.put(events, args)
+		
+		if (self.verbose & 16) != 0:
+			self.logMessage("Queued %d of %d events. Waiting: %d, Processing: %s" % (num, len(events), len(self.queue), str(self.queue.inflight)))
 		
+		return True
+	
+	def startWorkers(self):
+		"""Creates and starts the StpWrappers (workers) that process the events in the EventQueue, up to StpRunner.maxthreads
+		of them, each with a unique instance-name (STP[n]). Workers that have exited are replaced.
+		This StpRunner's 'verbose', 'outputdir', 'logfd' and 'errfd' members are inherited by the new StpWrappers
+		Returns 'False' if the StpRunner is stopping
+		"""
 		with self.sws_lock:
-			if numthreads > 0:
-				idxs = []
-				for sw in self.sws:
-					idxs.append(int(sw.name[4:-1]))
+			if self.queue.closed:	# the StpRunner is stopping
+				return False
+			
+			idxs = []
+			for sw in self.sws:
+				idxs.append(int(sw.name[4:-1]))
+			
+			for n in range(1, self.maxthreads + 1):
+				if n in idxs:
+					continue
 				
-				for n in range(1, self.maxthreads + 1):
-					if n not in idxs:
-						break
+				if self.driver != None:
+					self.driver.start()
 				
-				else:
-					ev_str = ""
-					for ev in events:
-						ev_str += "%s, " % self._idStr(ev)
-					
-					self.errMessage("Warning: Cannot find free STP index (i <= %d). Waiting with events [%s]" % (self.maxthreads, ev_str[:-2]))
-					return
-					
-				name = "STP[%d]" % n
-			else:
-				name = "STP[1]"
+				sw = self._newWrapper("STP[%d]" % n)
+				sw.verbose = self.verbose
+				sw.logfd = self.logfd
+				sw.errfd = self.errfd
+				
+				sw.outputdir = self.outputdir
 				
-			sw = StpWrapper(name, self.qp, self.stations, self.defaults)
+				sw.startServing(self.queue)
+				self.sws.append(sw)
+		
+		return True
+	
+	def _newWrapper(self, name):
+		"""Returns a new StpWrapper (worker) with the given instance-name, sharing this StpRunner's resources
+		"""
+		return StpWrapper(name, self.qp, self.stations, self.defaults, pool=self.pool, driver=self.driver,
+				avails=self.avails, planner=self.planner, retries=self.retries)
+	
+	def retryDue(self):
+		"""Queue the events that are due to be retried (see RetryScheduler), with the arguments they were processed with.
+		Events that are no longer in the DB are dropped.
+		"""
+		due = self.retries.due()
+		if not len(due):
+			return
+		
+		current = self.qp.getAllIds()
+		batches = {}
+		ev_str = ""
+		for (ev, args) in due:
+			if ev['id'] not in current:
+				self.retries.forget(ev['id'])
+				self.avails.drop(ev['net'], ev['id'])
+				ev_str += "%s, " % self._idStr(ev)
+				continue
 			
-			sw.verbose = self.verbose
-			sw.logfd = self.logfd
-			sw.errfd = self.errfd
+			ev['retry'] = True
+			batches.setdefault(args, []).append(ev)
+		
+		if len(ev_str):
+			timestring = datetime.datetime.utcnow().strftime("%b %d %Y - %H:%M:%S UTC")
+			self.logMessage("Events [%s] no longer in DB at %s" % (ev_str[:-2], timestring))
+		
+		for ((stn_count, channels), events) in batches.items():
+			if type(channels) == types.TupleType:
+				channels = list(channels)
 			
-			sw.outputdir = self.outputdir
+			self.runStp(events, stn_count, channels)
+	
+	def state(self, ev_id):
+		"""Returns the state of the event with the given ID; 'queued' or 'inflight' (see EventQueue.state()),
+		'retry' (failed, waiting to be retried), 'done' (downloaded) or 'None' (new)
+		"""
+		if ev_id in self.retries:
+			return 'retry'
+		
+		return self.queue.state(ev_id)
+	
+	def _dbChanged(self, added, removed):
+		"""Called by the QDMParser after each parse that changed the DB (see QDMParser.subscribe()).
+		Queues the added (or replaced) events that are new, or all added events if runForever() was called with 'force' == True.
+		Events that were removed from the DB are cancelled (see cancel()), and their seismograms-dirs become old (see cleanOld())
+		"""
+		(num_sta, channels, force) = self.runargs
+		get_events = []
+		with self.index_lock:
+			for ev in removed:
+				self.current.discard(ev['id'])
+				self.old[ev['id']] = time.time()
+				self.cancel(ev)
 			
-			for ev in events:
-				self.proc[ev['id']] = name
-				
-			sw.start(events, stn_count, channels)
-			self.sws.append(sw)
+			for ev in added:
+				self.current.add(ev['id'])
+				self.old.pop(ev['id'], None)
+				if force or (self.state(ev['id']) == None):
+					get_events.append(ev)
 		
-		if (self.verbose & 16) != 0:
-			self.logMessage("Processing: %s" % str(self.proc))
+		if len(get_events):
+			self.runStp(get_events, num_sta, channels)
+	
+	def cancel(self, ev):
+		"""Stop working on an event; take it out of the RetryScheduler or the EventQueue, or have the worker processing it
+		cancel it (see StpWrapper.cancel()). The cancellations are counted in 'cancels'
+		"""
+		if self.retries.forget(ev['id']):
+			state = 'retry'
+		else:
+			(state, name) = self.queue.cancel(ev['id'])
+		
+		if state == None:
+			return
+		
+		self.avails.drop(ev['net'], ev['id'])
+		if state == 'inflight':
+			with self.sws_lock:
+				sws = [sw for sw in self.sws if sw.name == name]
+			
+			for sw in sws:
+				self.logMessage("Event %s no longer in DB. Cancelling it on %s" % (self._idStr(ev), sw.name))
+				sw.cancel(ev['id']).addCallback(self._cancelled)
+			return
+		
+		est_saved = self._eventBytes()
+		with self.cancels_lock:
+			self.cancels[state] += 1
+			self.cancels['est_saved'] += est_saved
+		
+		self.logMessage("Event %s no longer in DB. Cancelled (est. %d kB saved)" % (self._idStr(ev), est_saved // 1024))
+	
+	def _cancelled(self, req):
+		"""Count the cancellation of an event in process, when the StpRequest returned by StpWrapper.cancel() completes
+		"""
+		if req.value == None:
+			return
+		
+		(latency, est_saved) = req.value
+		with self.cancels_lock:
+			self.cancels['inflight'] += 1
+			self.cancels['latency'] += latency
+			self.cancels['est_saved'] += est_saved
+	
+	def _eventBytes(self):
+		"""Returns the average number of seismogram-bytes a downloaded event takes on disk, or 0 if none were downloaded
+		"""
+		with StpWrapper.totals_lock:
+			if StpWrapper.totals['downloads'] > 0:
+				return StpWrapper.totals['download_bytes'] // StpWrapper.totals['downloads']
+		
+		return 0
+	
+	def cleanOld(self):
+		"""Remove the seismograms-dirs of the events that left the DB (see _dbChanged()) which are older than the
+		current DB by StpRunner.defaults['retainperiod']
+		"""
+		self.cleaned = time.time()
+		if self.defaults['retainperiod'] < datetime.timedelta(0):
+			return
+		
+		with self.index_lock:
+			old_events = [ev_id for ev_id in self.old.keys() if ev_id not in self.current]
+		
+		removed = self.cleanDirs(old_events)
+		with self.index_lock:
+			for ev_id in removed:
+				self.old.pop(ev_id, None)
+		
+		self.queue.forget(removed)
 		
 	def checkEvents(self, events, stn_count=3, channels='H%'):
 		"""Check the given events' IDs against the existing events' dir-names in the outputdir.
@@ -1345,7 +4030,7 @@ class StpRunner(object):
 		
 		get_events = []
 		for ev in events:
-			if (ev['id'] not in have) and (ev['id'] not in self.proc):
+			if (ev['id'] not in have) and (ev['id'] not in self.queue) and (ev['id'] not in self.retries):
 				get_events.append(ev)
 			
 		if len(get_events):
@@ -1365,7 +4050,7 @@ class StpRunner(object):
 		get_events = []
 		old_events = have[:]
 		for ev in events:
-			if (ev['id'] not in have) and (ev['id'] not in self.proc):
+			if (ev['id'] not in have) and (ev['id'] not in self.queue) and (ev['id'] not in self.retries):
 				get_events.append(ev)
 			if ev['id'] in have:
 				old_events.remove(ev['id'])
@@ -1383,28 +4068,41 @@ class StpRunner(object):
 		"""
 		ls = os.listdir(ev_dir)
 		for f in ls:
-			os.remove(f)
+			os.remove(os.path.join(ev_dir, f))
 		os.rmdir(ev_dir)
 	
 	def cleanDirs(self, old_events):
 		"""Remove the subdirs of given old_events which are older than the current DB by
 		StpRunner.defaults['retainperiod'] from the outputdir tree
+		Returns a list of the IDs of the events whose subdirs are gone
 		"""
 		mtime = datetime.datetime.fromtimestamp(self.qp.mtime)
+		removed = []
 		for ev_id in old_events:
 			ev_dir = os.path.join(self.outputdir, ev_id)
-			age = mtime - datetime.datetime.fromtimestamp(os.stat(ev_dir)[stat.ST_MTIME])
-			if age > self.defaults['retainperiod']:
-				self._rmDir(ev_dir)
-				self.logMessage("Removed seismograms-dir for old event %s after %s" % (ev_id, self._tdString(age)))
+			try:
+				age = mtime - datetime.datetime.fromtimestamp(os.stat(ev_dir)[stat.ST_MTIME])
+				if age > self.defaults['retainperiod']:
+					self._rmDir(ev_dir)
+					self.logMessage("Removed seismograms-dir for old event %s after %s" % (ev_id, self._tdString(age)))
+					removed.append(ev_id)
+			except OSError, e:
+				if e.errno == errno.ENOENT:
+					removed.append(ev_id)
+				else:
+					self.errMessage("Unable to remove seismograms-dir for old event %s: %s" % (ev_id, str(e)))
+		
+		return removed
 	
 	def garbageCollect(self):
 		"""MainLoop of the GarbageCollector-thread.
 		Handles the collection and blacklisting of rejected events,
 		Removes StpWrappers that are done from the list of currently running StpWrappers
+		Queues the events that are due to be retried, and keeps running as long as there are events in the EventQueue,
+		or events to retry (unless the StpRunner is stopped). Then stops the StpWrappers
 		"""
 		self.logMessage("Started at %s" % datetime.datetime.utcnow().strftime("%b %d %Y - %H:%M:%S UTC"))
-		while (self.gcrun or self.qp.run or len(self.sws)):
+		while (self.gcrun or self.qp.run or self.queue.busy() or (self.run and len(self.retries))):
 			for sw in reversed(self.sws):
 				ev_str = ""
 				while len(sw.rejects):
@@ -1416,32 +4114,46 @@ class StpRunner(object):
 					
 				if sw.isDone():
 					with self.sws_lock:
-						for (id, name) in self.proc.items():
-							if name == sw.name:
-								del self.proc[id]
-						
 						self.sws.remove(sw)
-					
-					if (self.verbose & 16) != 0:
-						self.logMessage("Processing: %s" % str(self.proc))
 				elif sw.connected:
 					# try to kill any 'stp' subprocess that has remained connected for 15 minutes
 					if (sw.connected + datetime.timedelta(0, 0, 0, 0, 15)) < datetime.datetime.utcnow():
+						if getattr(sw.stp, 'pid', None) == None:
+							self.errMessage("Breaking stuck STP session %s" % str(sw.stp))
+							sw.stp.terminate()
+							continue
+						
 						for sig in ("-HUP", "-INT", "-TERM", "-KILL"):
 							if subprocess.call(["kill", sig, "%d" % sw.stp.pid]) == 0:
 								break
 						else:
 							self.errMessage("Error: Failed to kill stuck 'stp' process with PID %d" % sw.stp.pid)
-							
+			
+			# close idle 'stp' processes that have exited, or have not been used for a while
+			self.pool.expire()
+			self.avails.expire()
+			
+			if self.run:
+				self.retryDue()
+				if (self.runargs != None) and (time.time() - self.cleaned > self.cleaninterval):
+					self.cleanOld()
 				
 			if (self.verbose & 4) != 0:
 				for net in netgroup.keys():
-					if self.stn_count[net] != len(self.stations[net]):
-						self.stn_count[net] = len(self.stations[net])
+					if self.stn_count[net] != self.stations.count(net):
+						self.stn_count[net] = self.stations.count(net)
 						self.logMessage("Net '%s' now has %d stations" % (net, self.stn_count[net]))
 			
 			time.sleep(1)
-			
+		
+		self.queue.close()
+		for sw in reversed(self.sws):
+			if not sw.isDone():
+				sw.stop()
+		
+		if self.driver != None:
+			self.driver.stop()
+		self.pool.closeAll()
 		self.logMessage("Done at %s" % datetime.datetime.utcnow().strftime("%b %d %Y - %H:%M:%S UTC"))
 
 	def start(self, mainthread_bg=False, num_sta=3, channels='H%', force=False):
@@ -1469,7 +4181,13 @@ class StpRunner(object):
 		Stops the QDMParser and waits for its thread to finish
 		If the runForever() method is running, stops it (and waits for its thread to finish, if any)
 		Waits 2 seconds, then stops the GarbageCollector and waits for its thread to finish.
+		Finally, stops the StpDriver (if any), and exits all idle 'stp' processes in the StpPool
+		The events waiting to be retried are dropped, and no more StpWrappers are started
 		"""
+		with self.sws_lock:
+			self.retries.close()
+			self.queue.close()
+		
 		for sw in reversed(self.sws):
 			sw.stop()
 		
@@ -1488,6 +4206,10 @@ class StpRunner(object):
 			if self.gcthread != None:
 				self.gcthread.join()
 				self.gcthread = None
+		
+		if self.driver != None:
+			self.driver.stop()
+		self.pool.closeAll()
 
 	def runOnceForMag(self, mags, num_sta=3, channels='H%', force=False):
 		"""Look-up the given magnitudes in the DB and call checkEvents() with the resulting
@@ -1526,14 +4248,20 @@ class StpRunner(object):
 		
 	def runForever(self, num_sta=3, channels='H%', force=False):
 		"""MainLoop for the 'auto' mode
-		Wait for the DB to be updated, then call runOnceForAll(), passing it the provided arguments.
-		Repeat.
+		Subscribe to the QDMParser's changes, so the events that are added to the DB are queued as soon as it is parsed
+		(see _dbChanged()), with the provided arguments. Then wait until stopped.
 		"""
+		self.runargs = (num_sta, channels, force)
+		self.qp.subscribe(self._dbChanged)
+		
+		# catch up with the events parsed before subscribing
+		self._dbChanged(self.qp.getAll(), [])
+		
 		while self.run:
 			self.qp.wait(1)
-			
-			if self.qp.isReady():
-				self.runOnceForAll(num_sta, channels, force)
+		
+		self.qp.unsubscribe(self._dbChanged)
+		self.runargs = None
 		
 		if self.gcrun or self.qp.run:
 			self.stop()
@@ -1560,6 +4288,8 @@ if __name__ == '__main__':
 					help="set verbosity (a bitmask) [default = 0]")
 	op.add_option("-d", "--outputdir", action='store', type='string', dest='outputdir', metavar='DIR',
 					help="save seismograms in DIR. (DIR will be created if it doesn't exist) [default = /var/lib/STP]")
+	op.add_option("-C", "--cachedir", action='store', type='string', dest='cachedir', metavar='DIR',
+					help="keep the station-lists in DIR [default = /var/cache/STP]")
 	op.add_option("-m", "--mag", action='append', type='float', dest='mag', 
 					help="run once for magnitude MAG")
 	op.add_option("-a", "--all", action='store_true', dest='all', 
@@ -1567,7 +4297,13 @@ if __name__ == '__main__':
 	op.add_option("-u", "--auto", action='store_true', dest='auto', 
 					help="automatically keep getting seismograms for new events (implies '-a')")
 	op.add_option("-t", "--threads", action='store', type='int', dest='num_thr', metavar='N',
-					help="run at most N STP-threads (N >= 2) [default = 10]")
+					help="run a pool of N STP-workers (N >= 2) [default = 10]")
+	op.add_option("-x", "--multiplex", action='store_true', dest='multiplex', 
+					help="run all STP-sessions from one thread, rather than one thread per session")
+	op.add_option("-p", "--parallel", action='store', type='int', dest='parallel', metavar='N',
+					help="download each event's seismograms over at most N concurrent sessions per datacenter [default = 3]")
+	op.add_option("-T", "--trim", action='store_true', dest='trim',
+					help="(experimental) download only the part of each seismogram that is played back, around the P- and S-wave arrivals")
 	op.add_option("-f", "--force", action='store_true', dest='force', 
 					help="(re)download seismograms even if they exist")
 	op.add_option("-s", "--stations", action='store', type='int', dest='num_sta', metavar='N',
@@ -1586,12 +4322,13 @@ if __name__ == '__main__':
 	op.set_defaults(retper='1d')
 	op.set_defaults(keepper='30d')
 	op.set_defaults(outputdir='/var/lib/STP')
+	op.set_defaults(cachedir='/var/cache/STP')
 	
 	# Parse command-line options
 	(opts, args) = op.parse_args()
 	
 	# Create StpRunner
-	sr = StpRunner(outputdir=opts.outputdir)
+	sr = StpRunner(outputdir=opts.outputdir, cachedir=opts.cachedir)
 	
 	if opts.verbose != None:
 		# Parse verbosity argument
@@ -1617,6 +4354,15 @@ if __name__ == '__main__':
 	else:
 		raise ValueError("Invalid number-of-threads argument: %s" % str(opts.num_thr))
 	
+	if opts.multiplex:
+		sr.setMultiplex(True)
+	
+	if opts.parallel != None:
+		sr.setParallel(opts.parallel)
+	
+	if opts.trim:
+		sr.setTrim(True)
+	
 	# set retry- and retain-periods
 	sr.setRetryPeriod(opts.retper)
 	sr.setRetainPeriod(opts.keepper)
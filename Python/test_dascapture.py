@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+###
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Unit-tests for the trigger-captures of the DASReader (see dascapture.py), and their play-back with a ReplaySource
+# (see dassource.py).
+# Run with 'python -m unittest test_dascapture' from this dir.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+
+import os, shutil, tempfile, unittest
+import numpy
+
+import dascapture, dassource
+
+
+class CaptureTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		# 1 second before and 2 seconds after each trigger, at 10 sps
+		self.cap = dascapture.Capture(2, 10., self.dir, pre=1., post=2.)
+		self.count = 0
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def _feed(self, n, blocksize=5):
+		# store 'n' samples per channel; each sample is its own sample-index, plus 1000 x the channel-number
+		for i in range(n // blocksize):
+			block = numpy.arange(self.count, self.count + blocksize) + numpy.array([[0], [1000]])
+			self.cap.store(0, block)
+			self.cap.advance(blocksize)
+			self.count += blocksize
+
+	def _files(self):
+		return sorted([os.path.join(self.dir, name) for name in os.listdir(self.dir)])
+
+	def testCapture(self):
+		"""The samples from 'pre' before until 'post' after the trigger are written, with the trigger's metadata
+		"""
+		self.cap.start()
+		self._feed(25)
+		self.cap.trigger({'time':1214870400.25, 'ch':1, 'mag':1.5})
+		self._feed(35)
+		self.cap.stop()
+
+		files = self._files()
+		self.assertEqual(len(files), 1)
+		self.assertTrue(os.path.basename(files[0]).endswith("-250-ch1.dat"))
+		self.assertEqual((self.cap.written, self.cap.lost), (1, 0))
+
+		fd = open(files[0], 'rb')
+		try:
+			header = dascapture.readHeader(fd)
+			samples = numpy.fromfile(fd, dtype='<u2').reshape((-1, 2))
+		finally:
+			fd.close()
+
+		self.assertEqual(header['num_ch'], '2')
+		self.assertEqual(float(header['sps']), 10.)
+		self.assertEqual(header['samples'], '30')
+		self.assertEqual(header['trigger_sample'], '10')
+		self.assertEqual(float(header['mag']), 1.5)
+		self.assertEqual(samples[:, 0].tolist(), range(15, 45))
+		self.assertEqual(samples[:, 1].tolist(), range(1015, 1045))
+
+	def testStop(self):
+		"""A capture still waiting for its 'post' samples is written with the samples captured so far
+		"""
+		self.cap.start()
+		self._feed(10)
+		self.cap.trigger({'time':1214870400., 'ch':0})
+		self._feed(5)
+		self.cap.stop()
+
+		files = self._files()
+		self.assertEqual(len(files), 1)
+		fd = open(files[0], 'rb')
+		try:
+			self.assertEqual(dascapture.readHeader(fd)['samples'], '15')
+		finally:
+			fd.close()
+
+	def testOverwritten(self):
+		"""A capture whose part of the ring was overwritten before it was written is dropped
+		"""
+		self._feed(10)
+		self.cap.trigger({'time':1214870400., 'ch':0})
+		self._feed(20)
+		(start, end, meta, slabs) = self.cap.queue.get_nowait()
+		self._feed(60)
+		self.cap._write(start, end, meta, slabs)
+		self.assertEqual((self.cap.written, self.cap.lost), (0, 1))
+		self.assertEqual(self._files(), [])
+
+	def testReplay(self):
+		"""A ReplaySource plays a capture-file back, with the channel-count and sample-rate of its header
+		"""
+		self.cap.start()
+		self._feed(25)
+		self.cap.trigger({'time':1214870400., 'ch':0})
+		self._feed(35)
+		self.cap.stop()
+
+		src = dassource.ReplaySource(self._files()[0], inputs=1, sps=100., speed=0)
+		try:
+			self.assertEqual(src.num_ch, 2)
+			self.assertEqual(src.sps, 10.)
+			out = numpy.zeros((src.num_ch, 10), dtype='int')
+			self.assertTrue(src.read(out))
+			self.assertEqual(out[0].tolist(), range(15, 25))
+			self.assertEqual(out[1].tolist(), range(1015, 1025))
+			self.assertTrue(src.read(out))
+			self.assertTrue(src.read(out))
+			self.assertFalse(src.read(out))
+		finally:
+			src.close()
+
+	def testReplaySampleFile(self):
+		"""A sample-file without a header is played back with the given channel-count and sample-rate
+		"""
+		filename = os.path.join(self.dir, 'samples.dat')
+		numpy.arange(40, dtype='<u2').tofile(filename)
+		src = dassource.ReplaySource(filename, inputs=4, sps=50., speed=0, loop=True)
+		try:
+			self.assertEqual(src.header, None)
+			self.assertEqual((src.num_ch, src.sps), (4, 50.))
+			out = numpy.zeros((4, 15), dtype='int')
+			self.assertTrue(src.read(out))
+			self.assertEqual(out[:, 0].tolist(), [0, 1, 2, 3])
+			# it loops around after 10 frames
+			self.assertEqual(out[:, 10].tolist(), [0, 1, 2, 3])
+		finally:
+			src.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
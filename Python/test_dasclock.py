@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+###
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Unit-tests for the sample-timing of the DASReader (see dasclock.py), fed with synthetic block time-stamps.
+# Run with 'python -m unittest test_dasclock' from this dir.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+
+import time, unittest
+import numpy
+
+import dasclock
+
+
+class SampleClockTest(unittest.TestCase):
+
+	def _feed(self, clock, rate, blocks, blocksize=10, start=0, t0=5000., offset=1.2e9, jitter=0., seed=1):
+		# add the time-stamps of 'blocks' blocks, sampled at 'rate', read with up to 'jitter' seconds of delay
+		rnd = numpy.random.RandomState(seed)
+		for k in range(blocks):
+			index = start + (k + 1) * blocksize - 1
+			mono = t0 + index / rate + rnd.uniform(0., jitter)
+			clock.add(index, mono, mono + offset)
+
+	def testNominal(self):
+		"""Before any block is fitted, the clock runs at the nominal rate
+		"""
+		clock = dasclock.SampleClock(100.)
+		clock.update()
+		self.assertEqual(clock.rate, 100.)
+		self.assertEqual(clock.drift(), 0.)
+
+	def testRate(self):
+		"""The true sample-rate and its drift are recovered from the time-stamps
+		"""
+		clock = dasclock.SampleClock(100., 64)
+		self._feed(clock, 100.01, 64)
+		clock.update()
+		self.assertAlmostEqual(clock.rate, 100.01, 6)
+		self.assertAlmostEqual(clock.drift(), 100., 2)
+
+	def testJitter(self):
+		"""The fit over the whole window averages out the jitter of the read-times
+		"""
+		clock = dasclock.SampleClock(100., 64)
+		self._feed(clock, 99.98, 64, jitter=0.005)
+		clock.update()
+		self.assertTrue(abs(clock.rate - 99.98) < 0.01, clock.rate)
+
+	def testSampleTimes(self):
+		"""The times of the samples follow from the fitted line; the wall-clock time keeps the median offset
+		"""
+		clock = dasclock.SampleClock(100.)
+		self._feed(clock, 100., 20)
+		clock.update()
+		self.assertAlmostEqual(clock.monoTime(199), 5000. + 1.99, 6)
+		self.assertAlmostEqual(clock.wallTime(199), 1.2e9 + 5000. + 1.99, 3)
+		times = clock.monoTime(numpy.array([0., 100.]))
+		self.assertAlmostEqual(times[1] - times[0], 1., 6)
+
+	def testWindow(self):
+		"""Only the last 'window' blocks are fitted, so the estimate follows a change of rate
+		"""
+		clock = dasclock.SampleClock(100., 16)
+		self._feed(clock, 100., 16)
+		self._feed(clock, 101., 16, start=160, t0=5000. + 160 / 100. - 160 / 101.)
+		clock.update()
+		self.assertEqual(clock.count, 16)
+		self.assertAlmostEqual(clock.rate, 101., 6)
+
+	def testOneBlock(self):
+		"""A single block gives no slope; the rate stays as it was
+		"""
+		clock = dasclock.SampleClock(100.)
+		clock.add(9, 10., 20.)
+		clock.update()
+		self.assertEqual(clock.rate, 100.)
+		self.assertAlmostEqual(clock.monoTime(9), 10., 6)
+		self.assertAlmostEqual(clock.wallTime(9), 20., 6)
+
+	def testMonotonic(self):
+		t = dasclock.monotonic()
+		time.sleep(0.01)
+		self.assertTrue(dasclock.monotonic() > t)
+
+
+if __name__ == '__main__':
+	unittest.main()
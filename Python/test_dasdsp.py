@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+###
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Unit-tests for the block-wise filtering of the DASReader (see dasdsp.py), against sample-by-sample filtering.
+# Run with 'python -m unittest test_dasdsp' from this dir.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+
+import unittest
+import numpy
+
+import dasdsp
+
+
+def filterSamples(sections, x):
+	"""Filter the samples 'x' (an array of shape (num_ch x n)) sample by sample, from rest, through the cascade of
+	biquad-sections, each in transposed direct-form II. Returns the filtered samples
+	"""
+	y = numpy.array(x, dtype='float')
+	for (b, a) in sections:
+		(z1, z2) = (numpy.zeros(y.shape[0]), numpy.zeros(y.shape[0]))
+		for i in range(y.shape[1]):
+			xi = y[:, i].copy()
+			y[:, i] = b[0] * xi + z1
+			z1 = b[1] * xi - a[1] * y[:, i] + z2
+			z2 = b[2] * xi - a[2] * y[:, i]
+
+	return y
+
+
+class BlockFilterTest(unittest.TestCase):
+
+	def setUp(self):
+		self.sections = dasdsp.design(100., highpass_fc=1., lowpass_fc=20., notch_f0=10.)
+		self.x = numpy.random.RandomState(1).normal(0., 100., (3, 120))
+
+	def testSampleBySample(self):
+		"""From rest, the block-wise output equals the sample-by-sample output
+		"""
+		bf = dasdsp.BlockFilter(self.sections, 3)
+		bf.reset()
+		y = numpy.hstack([bf.process(self.x[:, i:i + 10]) for i in range(0, 120, 10)])
+		self.assertTrue(numpy.allclose(y, filterSamples(self.sections, self.x), atol=1e-6))
+
+	def testBlockSizes(self):
+		"""The filter-state carries over from block to block, whatever the block-sizes
+		"""
+		bf = dasdsp.BlockFilter(self.sections, 3)
+		bf.reset()
+		whole = bf.process(self.x)
+
+		bf.reset()
+		parts = numpy.hstack([bf.process(self.x[:, i:j]) for (i, j) in ((0, 7), (7, 40), (40, 41), (41, 120))])
+		self.assertTrue(numpy.allclose(whole, parts, atol=1e-6))
+
+	def testSteadyState(self):
+		"""On the first block, the state is set to the steady-state of the first samples; a DC-offset causes no transient
+		"""
+		bf = dasdsp.BlockFilter(dasdsp.design(100., highpass_fc=1.), 2)
+		y = bf.process(numpy.ones((2, 50)) * 2048.)
+		self.assertTrue(numpy.allclose(y, 0., atol=1e-6))
+
+		bf = dasdsp.BlockFilter(dasdsp.design(100., lowpass_fc=20.), 2)
+		y = bf.process(numpy.ones((2, 50)) * 2048.)
+		self.assertTrue(numpy.allclose(y, 2048., atol=1e-6))
+
+	def testNoSections(self):
+		self.assertRaises(ValueError, dasdsp.BlockFilter, [])
+
+
+class DesignTest(unittest.TestCase):
+
+	def testNyquist(self):
+		"""A high-pass or notch-frequency at or above Nyquist is rejected; a low-pass cut-off there is ignored
+		"""
+		self.assertRaises(ValueError, dasdsp.design, 100., highpass_fc=50.)
+		self.assertRaises(ValueError, dasdsp.design, 100., notch_f0=60.)
+		self.assertEqual(dasdsp.design(100., lowpass_fc=50.), [])
+		self.assertEqual(len(dasdsp.design(100., highpass_fc=1., lowpass_fc=49., notch_f0=10.)), 3)
+
+	def testGain(self):
+		"""The sections have unity gain in their pass-band, and none at the notch-frequency
+		"""
+		fs = 100.
+		for (sections, f, gain) in ((dasdsp.design(fs, lowpass_fc=20.), 0., 1.), (dasdsp.design(fs, highpass_fc=1.), fs / 2, 1.),
+				(dasdsp.design(fs, notch_f0=10.), 10., 0.)):
+			(b, a) = sections[0]
+			zi = numpy.exp(-2j * numpy.pi * f / fs * numpy.arange(3))
+			self.assertAlmostEqual(abs(numpy.dot(b, zi) / numpy.dot(a, zi)), gain, 6)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+###
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Unit-tests for the Reader- and Analysis-loops of the DASReader (see dasreader.py), fed from counting sample-sources.
+# Run with 'python -m unittest test_dasreader' from this dir.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+
+import threading, time, unittest
+import numpy
+
+import dasreader, dassource, dasclock
+
+
+class CountingSource(dassource.SampleSource):
+	"""A sample-source whose samples are their own sample-index, on all channels. Runs out after 'limit' samples
+	"""
+	def __init__(self, inputs=1, limit=None):
+		dassource.SampleSource.__init__(self, inputs, speed=0)
+		self.t = 0
+		self.limit = limit
+
+	def read(self, out):
+		n = out.shape[1]
+		if (self.limit != None) and (self.t + n > self.limit):
+			return False
+
+		out[:] = numpy.arange(self.t, self.t + n)
+		self.t += n
+		return True
+
+
+class LockstepTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dr = dasreader.DASReader(source=[CountingSource(2), CountingSource(3)], bufsize=10, blocksize=10)
+		self.dr.run = True
+
+	def _read(self, card, drop=False):
+		# read a block from the given source, as its Reader-thread would. If 'drop', the block is dropped again
+		dr = self.dr
+		i = dr.free[card].get_nowait()
+		dr.sources[card].read(dr.blocks[card][i])
+		dr._stamp(card, i)
+		if drop:
+			dr.free[card].put(i)
+		else:
+			dr.filled[card].put(i)
+
+	def testInStep(self):
+		for n in range(2):
+			self._read(0)
+			self._read(1)
+
+		for n in range(2):
+			held = self.dr._takeBlocks()
+			self.assertEqual(self.dr.blocks[0][held[0]][0, 0], self.dr.blocks[1][held[1]][0, 0])
+			for card in range(2):
+				self.dr.free[card].put(held[card])
+
+		self.assertEqual(self.dr.getDropped(), [0, 0])
+
+	def testSkipToNewest(self):
+		"""When one source dropped a block, the other source's older block is skipped, so the channels stay in step
+		"""
+		self._read(0, True)
+		self._read(0)
+		self._read(1)
+		self._read(1)
+
+		held = self.dr._takeBlocks()
+		self.assertEqual(self.dr.blocks[0][held[0]][0, 0], 10)
+		self.assertEqual(self.dr.blocks[1][held[1]][0, 0], 10)
+		self.assertEqual(self.dr.getDropped(), [0, 1])
+		self.assertEqual(self.dr.filled[1].qsize(), 0)
+
+	def testStopping(self):
+		self._read(0)
+		self.dr.run = False
+		self.assertEqual(self.dr._takeBlocks(), None)
+
+	def testZeroInterval(self):
+		"""A source that returns blocks within the clock's resolution does not give an infinite sample-rate
+		"""
+		dr = dasreader.DASReader(source=CountingSource(1, 100), bufsize=10, blocksize=10)
+		dr.logfd = open('/dev/null', 'w')
+		monotonic = dasclock.monotonic
+		dasclock.monotonic = lambda: 1000.
+		try:
+			dr.run = True
+			dr._readLoop(0)
+		finally:
+			dasclock.monotonic = monotonic
+			dr.logfd.close()
+
+		self.assertFalse(numpy.isinf(dr.card_sps).any())
+		self.assertFalse(numpy.isinf(dr.sps))
+
+
+class CycleTest(unittest.TestCase):
+	"""Threads (and processes) waiting for read-cycles do not hide them from each other
+	"""
+	def testWaiters(self):
+		dr = dasreader.DASReader(source=CountingSource(1))
+		woke = []
+		waiter = threading.Thread(None, lambda: woke.append(dr.waitCycle(0, 5)))
+		waiter.start()
+		time.sleep(0.1)
+
+		dr._cycleDone()
+		self.assertTrue(dr.isReady())
+		dr.waitMag(0.1)	# a second consumer waits for the next cycle
+		waiter.join(5)
+		self.assertEqual(woke, [1])
+		self.assertFalse(dr.isReady())
+
+		# a cycle completed in the meantime is not waited for
+		dr._cycleDone()
+		self.assertEqual(dr.waitCycle(1, 5), 2)
+
+	def testProcess(self):
+		"""The read-cycle count is shared with the parent-process, whose waitMag() leaves the child's Trigger-thread alone
+		"""
+		if dasreader.multiprocessing == None:
+			return
+
+		src = dassource.SyntheticSource(2, sps=1000., interval=0, seed=1)
+		dp = dasreader.DASProcess(source=src, bufsize=20, blocksize=10)
+		dp.logfd = open('/dev/null', 'w')
+		dp.setTrigFunc(lambda ch, mag, dur: None)
+		dp.start()
+		try:
+			for n in range(20):
+				dp.waitMag(2)
+			seen = dp.cycles
+			self.assertTrue(seen > 0)
+			self.assertTrue(dp.waitCycle(seen, 2) > seen)
+		finally:
+			dp.stop()
+			dp.logfd.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
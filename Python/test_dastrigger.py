@@ -0,0 +1,238 @@
+#!/usr/bin/python
+
+###
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Unit-tests for the trigger-logic of the DASReader (see dastrigger.py), fed with synthetic pseudo-magnitudes.
+# Run with 'python -m unittest test_dastrigger' from this dir.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+
+import os, tempfile, unittest
+import numpy
+
+import dastrigger
+from dastrigger import ARMED, TRIGGERED, HOLDOFF
+
+# a magnitude with a duration of 10 seconds (see dastrigger.magDuration())
+MAG10 = 1.17
+
+
+class TriggerStateTest(unittest.TestCase):
+
+	def setUp(self):
+		self.ts = dastrigger.TriggerState(3)
+
+	def testCycle(self):
+		"""ARMED -> TRIGGERED -> HOLDOFF -> ARMED
+		"""
+		self.assertTrue(self.ts.isArmed())
+
+		(fired, duration) = self.ts.update(numpy.array([MAG10, 0., 0.]), 0., 1., 0.5)
+		self.assertEqual(list(fired), [0])
+		self.assertAlmostEqual(duration[0], 10., 6)
+		self.assertEqual(list(self.ts.state), [TRIGGERED, ARMED, ARMED])
+
+		# still loud, and the duration has passed
+		(fired, duration) = self.ts.update(numpy.array([MAG10, 0., 0.]), 10., 1., 0.5)
+		self.assertEqual(len(fired), 0)
+		self.assertEqual(list(self.ts.state), [HOLDOFF, ARMED, ARMED])
+
+		# calmed down
+		(fired, duration) = self.ts.update(numpy.array([0.4, 0., 0.]), 11., 1., 0.5)
+		self.assertEqual(len(fired), 0)
+		self.assertTrue(self.ts.isArmed())
+
+		# and fires again
+		(fired, duration) = self.ts.update(numpy.array([MAG10, 0., 0.]), 12., 1., 0.5)
+		self.assertEqual(list(fired), [0])
+
+	def testHysteresis(self):
+		"""A channel in HOLDOFF is only re-armed below the 'off' threshold, not below the 'on' threshold
+		"""
+		self.ts.update(numpy.array([MAG10, 0., 0.]), 0., 1., 0.5)
+		self.ts.update(numpy.array([0.8, 0., 0.]), 10., 1., 0.5)
+		self.assertEqual(self.ts.state[0], HOLDOFF)
+
+		# between 'off' and 'on'; stays in HOLDOFF, and does not fire when it rises again
+		self.ts.update(numpy.array([0.7, 0., 0.]), 11., 1., 0.5)
+		self.assertEqual(self.ts.state[0], HOLDOFF)
+		(fired, duration) = self.ts.update(numpy.array([MAG10, 0., 0.]), 12., 1., 0.5)
+		self.assertEqual(len(fired), 0)
+
+		self.ts.update(numpy.array([0.5, 0., 0.]), 13., 1., 0.5)
+		self.assertEqual(self.ts.state[0], HOLDOFF)
+		self.ts.update(numpy.array([0.49, 0., 0.]), 14., 1., 0.5)
+		self.assertEqual(self.ts.state[0], ARMED)
+
+	def testHoldoffDuration(self):
+		"""A TRIGGERED channel stays TRIGGERED (even when quiet) until its magnitude's duration has passed
+		"""
+		self.ts.update(numpy.array([MAG10, 0., 0.]), 100., 1., 0.5)
+		for now in (101., 105., 109.9):
+			(fired, duration) = self.ts.update(numpy.array([0., 0., 0.]), now, 1., 0.5)
+			self.assertEqual(self.ts.state[0], TRIGGERED)
+
+		# quiet when the duration has passed; HOLDOFF and re-armed in the same update
+		self.ts.update(numpy.array([0., 0., 0.]), 110., 1., 0.5)
+		self.assertEqual(self.ts.state[0], ARMED)
+
+		# a bigger quake lasts longer
+		self.ts.update(numpy.array([0., 2., 0.]), 200., 1., 0.5)
+		self.assertAlmostEqual(self.ts.end[1], 200. + dastrigger.magDuration(2.), 6)
+		self.ts.update(numpy.array([0., 0., 0.]), 210., 1., 0.5)
+		self.assertEqual(self.ts.state[1], TRIGGERED)
+
+	def testThresholds(self):
+		"""Scalar thresholds apply to all channels, per-channel thresholds to each channel
+		"""
+		mag = numpy.array([0.6, 1.1, 2.1])
+		(fired, duration) = self.ts.update(mag, 0., 1., 0.5)
+		self.assertEqual(list(fired), [1, 2])
+
+		self.ts.reset()
+		(fired, duration) = self.ts.update(mag, 1., numpy.array([0.5, 1.5, 2.]), numpy.array([0.2, 1., 1.]))
+		self.assertEqual(list(fired), [0, 2])
+		self.assertEqual(list(self.ts.state), [TRIGGERED, ARMED, TRIGGERED])
+
+		# the magnitude must exceed the threshold
+		self.ts.reset()
+		(fired, duration) = self.ts.update(mag, 2., numpy.array([0.6, 1.1, 2.1]), 0.5)
+		self.assertEqual(len(fired), 0)
+
+	def testDeterministic(self):
+		"""The same magnitudes give the same results
+		"""
+		rnd = numpy.random.RandomState(0)
+		mags = rnd.uniform(0., 2., size=(200, 3))
+		results = []
+		for n in range(2):
+			ts = dastrigger.TriggerState(3)
+			out = []
+			for (t, mag) in enumerate(mags):
+				(fired, duration) = ts.update(mag, float(t), 1.5, 0.5)
+				out.append((list(fired), list(duration), list(ts.state)))
+			results.append(out)
+
+		self.assertEqual(results[0], results[1])
+
+
+class CoincidenceTest(unittest.TestCase):
+
+	def setUp(self):
+		self.ts = dastrigger.TriggerState(4)
+		self.co = dastrigger.Coincidence(4, k=2, channels=[0, 1, 2], window=1.)
+
+	def _update(self, mag, now):
+		mag = numpy.array(mag)
+		(fired, duration) = self.ts.update(mag, now, 1., 0.5)
+		return self.co.update(fired, mag, now, self.ts.state)
+
+	def testInvalidCount(self):
+		self.assertRaises(ValueError, dastrigger.Coincidence, 4, 0)
+		self.assertRaises(ValueError, dastrigger.Coincidence, 4, 4, [0, 1, 2])
+
+	def testInvalidChannels(self):
+		self.assertRaises(ValueError, dastrigger.Coincidence, 4, 2, [0, 4])
+		# a negative channel-number does not wrap around to the last channel
+		self.assertRaises(ValueError, dastrigger.Coincidence, 4, 2, [0, -1])
+
+	def testKofN(self):
+		"""An event needs 'k' of the configured channels, within the window
+		"""
+		# one channel is not enough, nor is an unconfigured channel
+		self.assertEqual(self._update([MAG10, 0., 0., MAG10], 0.), None)
+
+		# a second one within the window is
+		event = self._update([MAG10, 2., 0., 0.], 0.5)
+		self.assertNotEqual(event, None)
+		(channels, mags, agg, duration) = event
+		self.assertEqual(list(channels), [0, 1])
+		self.assertAlmostEqual(agg, (MAG10 + 2.) / 2., 6)
+		self.assertAlmostEqual(duration, dastrigger.magDuration(agg), 6)
+
+	def testWindow(self):
+		"""Channels that fired further apart than the window do not coincide
+		"""
+		self.assertEqual(self._update([MAG10, 0., 0., 0.], 0.), None)
+		self.assertEqual(self._update([0., MAG10, 0., 0.], 1.5), None)
+		self.assertNotEqual(self._update([0., 0., MAG10, 0.], 2.), None)
+
+	def testReportedOnce(self):
+		"""No new event is declared until the event's duration has passed, and all configured channels are re-armed
+		"""
+		event = self._update([2., 2., 0., 0.], 0.)
+		self.assertNotEqual(event, None)
+		end = event[3]
+
+		# a third channel fires during the event
+		self.assertEqual(self._update([0., 0., MAG10, 0.], 1.), None)
+		self.assertEqual(self._update([0., 0., 0., 0.], 2.), None)
+
+		# all quiet and re-armed after the event
+		self.assertEqual(self._update([0., 0., 0., 0.], end + 20.), None)
+		self.assertTrue(self.ts.isArmed())
+		self.assertNotEqual(self._update([MAG10, MAG10, 0., 0.], end + 21.), None)
+
+
+class NoiseFloorTest(unittest.TestCase):
+
+	def setUp(self):
+		self.noise = numpy.zeros(shape=(3,), dtype='float')
+		self.nf = dastrigger.NoiseFloor(self.noise, k=3., rate=0.01, floor=0.05)
+
+	def testFirstUpdate(self):
+		"""Channels without an estimate take their first magnitude
+		"""
+		self.nf.update(numpy.array([0.1, 0.2, 0.3]))
+		self.assertTrue(numpy.allclose(self.noise, [0.1, 0.2, 0.3]))
+
+	def testConvergence(self):
+		"""The estimate converges on the median of the magnitudes, and follows changes of the ambient noise
+		"""
+		rnd = numpy.random.RandomState(1)
+		self.noise[:] = 1.
+		for n in range(2000):
+			self.nf.update(rnd.uniform(0.1, 0.3, size=3))
+		self.assertTrue(numpy.allclose(self.noise, 0.2, atol=0.03), self.noise)
+
+		for n in range(2000):
+			self.nf.update(rnd.uniform(0.3, 0.5, size=3))
+		self.assertTrue(numpy.allclose(self.noise, 0.4, atol=0.05), self.noise)
+
+	def testMask(self):
+		"""Only the masked channels are updated
+		"""
+		self.noise[:] = 0.2
+		self.nf.update(numpy.array([1., 1., 1.]), numpy.array([True, False, True]))
+		self.assertTrue(self.noise[0] > 0.2)
+		self.assertEqual(self.noise[1], 0.2)
+
+	def testLevel(self):
+		"""The trigger-level is k x noise, but never below the floor
+		"""
+		self.noise[:] = [0.001, 0.1, 1.]
+		self.assertTrue(numpy.allclose(self.nf.level(), [0.05, 0.3, 3.]))
+
+	def testSaveLoad(self):
+		self.noise[:] = [0.1, 0.2, 0.3]
+		(fd, filename) = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			self.nf.save(filename)
+			other = dastrigger.NoiseFloor(numpy.zeros(shape=(3,), dtype='float'))
+			self.assertTrue(other.load(filename))
+			self.assertTrue(numpy.allclose(other.noise, self.noise))
+
+			# the wrong number of channels
+			other = dastrigger.NoiseFloor(numpy.zeros(shape=(4,), dtype='float'))
+			self.assertFalse(other.load(filename))
+		finally:
+			os.remove(filename)
+
+		self.assertFalse(self.nf.load(filename))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,487 @@
+#!/usr/bin/python
+### _*_ coding: utf-8 _*_
+#
+# Parkfield Interventional Earth-Quake Fieldwork
+#
+# Unit-tests for the StpWrapper workers of the StpRunner (see stprunner.py), run against stand-in STP servers
+# (see stpclient.py) with failure-injection.
+# Run with 'python -m unittest test_stprunner' from this dir.
+#
+#	Stock, V2_Lab Rotterdam, June 2008
+###
+from __future__ import with_statement
+
+import qdmparser, stprunner, stpclient, stpbench
+
+import os, time, datetime, shutil, tempfile, random, threading, unittest, StringIO
+
+
+class WorkerTest(unittest.TestCase):
+	"""Runs StpWrappers against stand-in STP servers, on synthetic events
+	"""
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp()
+		self.bench = stpbench.StpBench(os.path.join(self.workdir, 'bench'), True)
+		self.bench.addEvents(10)
+		self.qp = qdmparser.QDMParser(self.bench.inputfile, self.bench.blacklistfile)
+		self.qp.parse()
+		
+		self.servers = {}
+		self.srvs = []
+		for (net, group) in (('CI', 'scedc'), ('NC', 'ncedc')):
+			srv = stpclient.StpServer(('localhost', 0), net, group, wavesize=1024)
+			srv.rnd = random.Random(net)
+			self.servers[group] = srv.start()
+			self.srvs.append(srv)
+		
+		self.log = stpbench.BenchLog()
+		self.err = StringIO.StringIO()
+	
+	def tearDown(self):
+		for srv in self.srvs:
+			srv.stop()
+		shutil.rmtree(self.workdir)
+	
+	def _wrapper(self, name, **kwargs):
+		sw = stpbench.NativeWrapper(name, self.qp, stprunner.StationCatalog(), None, self.bench.outputdir, servers=self.servers, **kwargs)
+		sw.logfd = self.log
+		sw.errfd = self.err
+		return sw
+	
+	def testDeadSession(self):
+		"""A session that has died is forgotten by disconnect(), so the StpWrapper can be used again
+		"""
+		sw = self._wrapper("STP[t]", pool=stprunner.StpPool())
+		sw.connect('CI')
+		sw.stp.wait()	# the connection ends
+		sw.disconnect()
+		self.assertEqual(sw.stp, None)
+		self.assertEqual(sw.net, None)
+		
+		ev = self.qp.getAll()[0]
+		sw.runStp([ev], 3, 'H%')
+		self.assertTrue(ev['id'] in sw.downloaded)
+		self.assertEqual(sw.stp, None)
+	
+	def testServeWithFailures(self):
+		"""A worker that keeps losing its sessions goes on taking work, and no event is lost; each is either downloaded,
+		or handed to the RetryScheduler until it is
+		"""
+		for srv in self.srvs:
+			srv.failrate = 0.2
+		
+		retries = stprunner.RetryScheduler()
+		retries.policies = dict([(reason, (0.1, 1., 0.1)) for reason in stprunner.RetryScheduler.policies.keys()])
+		queue = stprunner.EventQueue()
+		sw = self._wrapper("STP[1]", pool=stprunner.StpPool(), retries=retries)
+		sw.startServing(queue)
+		try:
+			events = self.qp.getAll()
+			queue.put(events, (3, 'H%'))
+			end = time.time() + 60
+			while (queue.busy() or len(retries)) and (time.time() < end):
+				for (ev, args) in retries.due():
+					queue.put([ev], args)
+				time.sleep(0.1)
+		finally:
+			queue.close()
+			sw.stop()
+		
+		self.assertFalse("Already running" in self.err.getvalue(), self.err.getvalue())
+		for ev in events:
+			self.assertEqual(queue.state(ev['id']), 'done', "event %s was lost" % ev['id'])
+	
+	def testAlreadyRunning(self):
+		"""A worker whose batch fails before it starts (because it is still connected) hands the batch back, and goes on
+		"""
+		retries = stprunner.RetryScheduler()
+		queue = stprunner.EventQueue()
+		sw = self._wrapper("STP[1]", retries=retries)
+		sw.connect('CI')
+		sw.startServing(queue)
+		try:
+			events = self.qp.getAll()
+			queue.put(events[:1], (3, 'H%'))
+			end = time.time() + 10
+			while (queue.busy() or not len(retries)) and (time.time() < end):
+				time.sleep(0.05)
+			
+			self.assertEqual(queue.state(events[0]['id']), None)
+			self.assertEqual(len(retries), 1)
+			self.assertTrue(sw.thread.isAlive())
+			
+			# it takes the next batch, once it is disconnected
+			sw.disconnect()
+			queue.put(events[1:2], (3, 'H%'))
+			end = time.time() + 30
+			while queue.busy() and (time.time() < end):
+				time.sleep(0.05)
+			self.assertEqual(queue.state(events[1]['id']), 'done')
+		finally:
+			queue.close()
+			sw.stop()
+		
+		self.assertTrue("Already running" in self.err.getvalue())
+	
+	def testSlowConnect(self):
+		"""A slow connect to an StpServer does not hold up the other sessions run by the StpDriver
+		"""
+		driver = stprunner.StpDriver()
+		driver.start()
+		connect = stpclient.StpClient.__init__
+		def slowConnect(client, host, port, *args):
+			if port == self.servers['scedc'][1]:
+				time.sleep(2)
+			connect(client, host, port, *args)
+		
+		stpclient.StpClient.__init__ = slowConnect
+		try:
+			slow = self._wrapper("STP[1]", driver=driver)
+			fast = self._wrapper("STP[2]", driver=driver)
+			tasks = [stprunner.StpTask(slow.connectAsync('CI'), "slow"), stprunner.StpTask(fast.connectAsync('NC'), "fast")]
+			t = time.time()
+			for task in tasks:
+				driver.spawn(task)
+			
+			tasks[1].finished.result(10)
+			self.assertTrue(time.time() - t < 1., "the fast connect took %.1f sec" % (time.time() - t))
+			tasks[0].finished.result(10)
+			self.assertEqual(slow.net, 'CI')
+		finally:
+			stpclient.StpClient.__init__ = connect
+			driver.stop()
+	
+	def testCancel(self):
+		"""A queued event, an event waiting to be retried and an event in process can each be cancelled; the cancellations
+		are counted, and the partial downloads of the event in process are removed
+		"""
+		for srv in self.srvs:
+			srv.wavesize = 8192
+			srv.rate = 16384
+		
+		runner = stpbench.NativeRunner(self.qp, stprunner.StationCatalog(), outputdir=self.bench.outputdir)
+		runner.logfd = self.log
+		runner.errfd = self.err
+		runner.maxthreads = 1
+		for (group, (host, port)) in self.servers.items():
+			runner.setServer(group, host, port)
+		
+		try:
+			events = self.qp.getAll()[:3]
+			runner.runStp(events[:2], 3, 'H%')
+			end = time.time() + 10
+			while (len(runner.queue.inflight) == 0) and (time.time() < end):
+				time.sleep(0.05)
+			
+			inflight = [ev for ev in events[:2] if runner.state(ev['id']) == 'inflight']
+			queued = [ev for ev in events[:2] if runner.state(ev['id']) == 'queued']
+			self.assertEqual((len(inflight), len(queued)), (1, 1))
+			waiting = events[2]
+			runner.retries.schedule(waiting, 'nodata', (3, 'H%'))
+			self.assertEqual(runner.state(waiting['id']), 'retry')
+			
+			# wait for the download of the event in process to start
+			ev_dir = os.path.join(self.bench.outputdir, inflight[0]['id'])
+			end = time.time() + 10
+			while not (os.path.isdir(ev_dir) and len(os.listdir(ev_dir))) and (time.time() < end):
+				time.sleep(0.05)
+			self.assertTrue(os.path.isdir(ev_dir))
+			
+			est_saved = runner._eventBytes()
+			runner.cancel(queued[0])
+			runner.cancel(waiting)
+			self.assertEqual(runner.cancels['queued'], 1)
+			self.assertEqual(runner.cancels['retry'], 1)
+			self.assertEqual(runner.cancels['est_saved'], 2 * est_saved)
+			
+			runner.cancel(inflight[0])
+			end = time.time() + 30
+			while (runner.cancels['inflight'] == 0) and (time.time() < end):
+				time.sleep(0.05)
+			
+			self.assertEqual(runner.cancels['inflight'], 1)
+			self.assertTrue(runner.cancels['latency'] > 0.)
+			self.assertTrue(runner.cancels['est_saved'] >= 2 * est_saved)
+			self.assertFalse(os.path.exists(ev_dir))
+			for ev in events:
+				self.assertEqual(runner.state(ev['id']), None)
+		finally:
+			runner.stop()
+
+
+
+class RetrySchedulerTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.retries = stprunner.RetryScheduler(datetime.timedelta(0, 3600))
+		self.retries.policies = {'error':(10., 2., 100.), 'noevent':(300., 1.5, 3600.)}
+		self.retries.jitter = 0.
+		self.ev = {'id':'ci0001', 'net':'CI'}
+	
+	def testBackoff(self):
+		"""The delay grows by the policy's factor with each failure, up to its max
+		"""
+		delays = [self.retries.schedule(self.ev, 'error') for n in range(6)]
+		self.assertEqual(delays, [10., 20., 40., 80., 100., 100.])
+		self.assertEqual(len(self.retries), 1)
+	
+	def testPolicies(self):
+		"""Each reason has its own policy; unknown reasons are treated as errors
+		"""
+		self.assertEqual(self.retries.schedule(self.ev, 'noevent'), 300.)
+		self.assertEqual(self.retries.schedule({'id':'ci0002'}, 'unknown'), 10.)
+	
+	def testJitter(self):
+		self.retries.jitter = 0.1
+		self.retries.rnd = random.Random(1)
+		delays = [self.retries.schedule({'id':'ci%04d' % n}, 'noevent') for n in range(100)]
+		self.assertTrue(min(delays) >= 270.)
+		self.assertTrue(max(delays) <= 330.)
+		self.assertTrue(len(set(delays)) > 90)
+	
+	def testPeriod(self):
+		"""The delay is cut short at the end of the retry-period, after which the event is given up on
+		"""
+		now = time.time
+		t = now()
+		try:
+			time.time = lambda: t
+			self.assertEqual(self.retries.schedule(self.ev, 'noevent'), 300.)
+			time.time = lambda: t + 3500.
+			self.assertAlmostEqual(self.retries.schedule(self.ev, 'noevent'), 100., 6)
+			time.time = lambda: t + 3600.
+			self.assertEqual(self.retries.schedule(self.ev, 'noevent'), None)
+			# a new failure starts a new period
+			self.assertEqual(self.retries.schedule(self.ev, 'noevent'), 300.)
+		finally:
+			time.time = now
+	
+	def testDue(self):
+		self.retries.policies['error'] = (0.05, 2., 1.)
+		self.retries.schedule(self.ev, 'error', (3, 'H%'))
+		self.retries.schedule({'id':'ci0002'}, 'noevent')
+		self.assertEqual(self.retries.due(), [])
+		time.sleep(0.1)
+		self.assertEqual(self.retries.due(), [(self.ev, (3, 'H%'))])
+		self.assertEqual(self.retries.due(), [])
+		self.assertTrue(self.retries.forget('ci0002'))
+		self.assertFalse(self.retries.forget('ci0002'))
+	
+	def testClosed(self):
+		"""A closed scheduler does not take events, and says so
+		"""
+		self.retries.close()
+		self.assertEqual(self.retries.schedule(self.ev, 'error'), None)
+		self.assertEqual(len(self.retries), 0)
+
+
+class EventQueueTest(unittest.TestCase):
+	
+	def testPriority(self):
+		"""Events rank by their own time, not by their age when they were queued
+		"""
+		queue = stprunner.EventQueue()
+		now = time.time
+		t = now()
+		try:
+			time.time = lambda: t
+			queue.put([{'id':'ci0001', 'net':'CI', 'time':t, 'mag':1.}])
+			# queued three hours later, but half an hour more recent
+			time.time = lambda: t + 3 * 3600.
+			queue.put([{'id':'ci0002', 'net':'CI', 'time':t + 1800., 'mag':1.}])
+		finally:
+			time.time = now
+		
+		queue.batch = 1
+		(events, args) = queue.take("STP[1]").result(1)
+		self.assertEqual(events[0]['id'], 'ci0002')
+		
+		# a magnitude ranks above half an hour
+		queue.put([{'id':'ci0003', 'net':'CI', 'time':t + 1800., 'mag':1.}, {'id':'ci0004', 'net':'CI', 'time':t, 'mag':2.}])
+		self.assertEqual([queue.take("STP[1]").result(1)[0][0]['id'] for n in range(3)], ['ci0004', 'ci0003', 'ci0001'])
+		queue.close()
+
+
+class StationCatalogTest(unittest.TestCase):
+	
+	def testMemo(self):
+		"""Memoised results are only reused for the same set of candidate stations, not another set of the same size
+		"""
+		catalog = stprunner.StationCatalog()
+		catalog.update('CI', {'CI.A':(36.0, -120.0), 'CI.B':(36.1, -120.0), 'CI.C':(36.2, -120.0), 'CI.D':(36.3, -120.0)}, True)
+		loc = (36.0, -120.0)
+		self.assertEqual(catalog.nearest('CI', loc, 1, set(['CI.B', 'CI.C']), 'H%')[0], ['CI.B'])
+		# all of the memoised stations are candidates again, but so is a nearer one
+		self.assertEqual(catalog.nearest('CI', loc, 1, set(['CI.A', 'CI.B']), 'H%')[0], ['CI.A'])
+		self.assertEqual(catalog.nearest('CI', loc, 2, set(['CI.A', 'CI.C']), 'H%')[0], ['CI.A', 'CI.C'])
+		self.assertEqual(catalog.nearest('CI', loc, 2, set(['CI.B', 'CI.D']), 'H%')[0], ['CI.B', 'CI.D'])
+		# the same candidates, as a dict
+		self.assertEqual(catalog.nearest('CI', loc, 2, {'CI.D':[], 'CI.B':[]}, 'H%')[0], ['CI.B', 'CI.D'])
+		self.assertEqual(catalog.nearest('CI', loc, 2)[0], ['CI.A', 'CI.B'])
+
+
+class FetchPlannerTest(unittest.TestCase):
+	
+	def testCap(self):
+		"""Every fetch, with the fetching StpWrapper's own session, counts against the cap, and waits when it is reached
+		"""
+		planner = stprunner.FetchPlanner(3)
+		self.assertEqual(planner.acquire('scedc', 2).result(0), 2)
+		self.assertEqual(planner.acquire('scedc', 5).result(0), 1)
+		self.assertEqual(planner.busy['scedc'], 3)
+		
+		first = planner.acquire('scedc', 2)
+		second = planner.acquire('scedc', 1)
+		self.assertFalse(first.isDone())
+		self.assertEqual(planner.busy['scedc'], 3)
+		# other server groups have caps of their own
+		self.assertEqual(planner.acquire('ncedc', 1).result(0), 1)
+		
+		# the waiting fetches get the released sessions in turn
+		planner.release('scedc', 1)
+		self.assertEqual(first.result(0), 1)
+		self.assertFalse(second.isDone())
+		planner.release('scedc', 2)
+		self.assertEqual(second.result(0), 1)
+		self.assertEqual(planner.busy['scedc'], 2)
+	
+	def testWorkers(self):
+		"""Concurrent fetches never have more sessions than the cap
+		"""
+		planner = stprunner.FetchPlanner(2)
+		peak = [0]
+		lock = threading.Lock()
+		def fetch():
+			for n in range(20):
+				num = planner.acquire('scedc', 2).result(10)
+				with lock:
+					peak[0] = max(peak[0], planner.busy['scedc'])
+				time.sleep(0.001)
+				planner.release('scedc', num)
+		
+		threads = [threading.Thread(target=fetch) for n in range(5)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		
+		self.assertEqual(peak[0], 2)
+		self.assertEqual(planner.busy['scedc'], 0)
+
+
+class WindowTest(unittest.TestCase):
+	"""The windows of trimmed downloads (see StpWrapper._windowCommands())
+	"""
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp()
+		self.bench = stpbench.StpBench(os.path.join(self.workdir, 'bench'), True)
+		self.outputdir = self.bench.outputdir
+		qp = qdmparser.QDMParser(self.bench.inputfile, self.bench.blacklistfile)
+		catalog = stprunner.StationCatalog()
+		# one station at the epicenter, one 35 km (~0.3148 degrees) north of it
+		catalog.update('CI', {'CI.NEAR':(36.0, -120.0), 'CI.FAR':(36.0 + 35. / 111.195, -120.0)}, True)
+		self.srv = stpclient.StpServer(('localhost', 0), 'CI', 'scedc', wavesize=1024)
+		address = self.srv.start()
+		self.sw = stpbench.NativeWrapper("STP[w]", qp, catalog, None, self.outputdir, servers={'scedc':address, 'ncedc':address})
+		self.sw.net = 'CI'
+		self.sw.avail = {}
+		self.sw.margin = 5.
+		self.ev = {'id':'ci0001', 'time':1000000000., 'loc':(36.0, -120.0), 'mag':1.17} # a duration of 10 sec
+	
+	def tearDown(self):
+		self.srv.stop()
+		shutil.rmtree(self.workdir)
+	
+	def _windows(self, cmds):
+		# the (start, end) times of the 'WIN' commands
+		return [tuple([time.mktime(time.strptime(tok[:19], "%Y/%m/%d,%H:%M:%S")) + float(tok[19:] or 0)
+						for tok in cmd.split()[-2:]]) for cmd in cmds]
+	
+	def testWindows(self):
+		"""From 'margin' before the P-wave arrival until 'margin' after the quake's duration after the S-wave arrival
+		"""
+		(cmds, ev_ids, needed, available) = self.sw._windowCommands(self.ev, ['CI.NEAR', 'CI.FAR'], 'HHZ')
+		self.assertEqual(ev_ids, ['ci0001'])
+		self.assertEqual(cmds[0].split()[:7], ['WIN', '-net', 'CI', '-sta', 'NEAR', '-chan', 'HHZ'])
+		self.assertFalse('ci0001' in cmds[0])
+		
+		((start0, end0), (start1, end1)) = self._windows(cmds)
+		t = self.ev['time']
+		self.assertAlmostEqual(start0, t - 5., 2)
+		self.assertAlmostEqual(end0, t + 10. + 5., 2)
+		self.assertAlmostEqual(start1, t + 35. / stprunner.p_velocity - 5., 1)
+		self.assertAlmostEqual(end1, t + 35. / stprunner.s_velocity + 10. + 5., 1)
+		self.assertAlmostEqual(needed, (end0 - start0) + (end1 - start1), 1)
+		self.assertAlmostEqual(available, needed, 6)
+	
+	def testAvailable(self):
+		"""Windows are clipped to the station's available window, or take all of it if they don't overlap it
+		"""
+		t = self.ev['time']
+		self.sw.avail = {'CI.NEAR':[{'time':t + 2., 'dur':60.}], 'CI.FAR':[{'time':t + 100., 'dur':60.}]}
+		(cmds, ev_ids, needed, available) = self.sw._windowCommands(self.ev, ['CI.NEAR', 'CI.FAR'], ['HHZ', 'HHN'])
+		self.assertEqual(len(cmds), 4)
+		
+		windows = self._windows(cmds)
+		self.assertAlmostEqual(windows[0][0], t + 2., 2)
+		self.assertAlmostEqual(windows[0][1], t + 15., 2)
+		self.assertEqual(windows[0], windows[1])
+		self.assertAlmostEqual(windows[2][0], t + 100., 2)
+		self.assertAlmostEqual(windows[2][1], t + 160., 2)
+		self.assertAlmostEqual(needed, 13. + 60., 1)
+		self.assertAlmostEqual(available, 120., 6)
+	
+	def testInvalid(self):
+		self.assertRaises(stprunner.StpError, self.sw._windowCommands, {'id':'ci0001'}, ['CI.NEAR'], 'HHZ')
+		self.assertRaises(stprunner.StpError, self.sw._windowCommands, self.ev, ['CI.NONE'], 'HHZ')
+		self.assertRaises(stprunner.StpError, self.sw._windowCommands, self.ev, ['NEAR'], 'HHZ')
+	
+	def testStandIn(self):
+		"""The stand-in server saves 'WIN' seismograms in the root of the session's dir; they are moved into the event's dir
+		"""
+		self.sw.defaults = {'trim':True}
+		self.sw.logfd = stpbench.BenchLog()
+		self.sw.connect('CI')
+		code = sorted(self.srv.stations.keys())[0]
+		self.sw.stations.update('CI', {code:self.srv.stations[code]})
+		ev = self.sw.getEvent({'id':'ci0001', 'net':'CI'})
+		ret = self.sw.fetchSeismograms(ev, [code], 'HH%')
+		self.sw.disconnect()
+		
+		self.assertEqual(ret, {'ci0001':3})
+		self.assertEqual(len(os.listdir(os.path.join(self.outputdir, 'ci0001'))), 3)
+		self.assertEqual(os.listdir(self.outputdir), ['ci0001'])
+		self.assertTrue(self.sw.trimmed[0] > 0)
+	
+	def testOverlapping(self):
+		"""Two workers fetching trimmed seismograms from the same station at the same time each get their own event's
+		"""
+		self.srv.delay = 0.2
+		code = sorted(self.srv.stations.keys())[0]
+		self.sw.stations.update('CI', {code:self.srv.stations[code]})
+		other = stpbench.NativeWrapper("STP[o]", self.sw.qp, self.sw.stations, None, self.outputdir, servers=self.sw.servers)
+		
+		rets = {}
+		def fetch(sw, ev_id):
+			sw.defaults = {'trim':True}
+			sw.logfd = stpbench.BenchLog()
+			sw.connect('CI')
+			ev = sw.getEvent({'id':ev_id, 'net':'CI'})
+			rets.update(sw.fetchSeismograms(ev, [code], 'HH%'))
+			sw.disconnect()
+		
+		threads = [threading.Thread(None, fetch, None, args) for args in ((self.sw, 'ci0001'), (other, 'ci0002'))]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join(30)
+		
+		self.assertEqual(rets, {'ci0001':3, 'ci0002':3})
+		self.assertEqual(sorted(os.listdir(self.outputdir)), ['ci0001', 'ci0002'])
+		files = [set(os.listdir(os.path.join(self.outputdir, ev_id))) for ev_id in ('ci0001', 'ci0002')]
+		self.assertEqual([len(names) for names in files], [3, 3])
+		self.assertFalse(files[0] & files[1])
+
+
+if __name__ == '__main__':
+	unittest.main()